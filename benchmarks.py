@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2010-2015, 2degrees Limited.
+# All Rights Reserved.
+#
+# This file is part of wsgi-xsendfile <http://pythonhosted.org/xsendfile/>,
+# which is subject to the provisions of the BSD at
+# <http://dev.2degreesnetwork.com/p/2degrees-license.html>. A copy of the
+# license should accompany this distribution. THIS SOFTWARE IS PROVIDED "AS IS"
+# AND ANY AND ALL EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST
+# INFRINGEMENT, AND FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Benchmark suite for wsgi-xsendfile.
+
+Run ``python benchmarks.py`` to run all the benchmarks, or pass the names of
+the benchmarks to run as arguments.
+
+"""
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import Timer
+from wsgiref.util import setup_testing_defaults
+
+from xsendfile import AuthTokenApplication
+from xsendfile import SQLiteTokenUsageStore
+from xsendfile import TokenConfig
+from xsendfile import XSendfileApplication
+
+
+_ROOT_DIR = path.dirname(path.abspath(__file__))
+_PROTECTED_DIR = path.join(_ROOT_DIR, "test-fixtures", "protected-directory")
+
+_SECRET = "s3cr3t"
+
+_BENCHMARKS = []
+
+
+def benchmark(benchmark_function):
+    """
+    Register ``benchmark_function``.
+
+    The function must return the callable to be timed and a callable to clean
+    up after the benchmark, if any.
+
+    """
+    _BENCHMARKS.append(benchmark_function)
+    return benchmark_function
+
+
+# { Benchmarks
+
+
+@benchmark
+def auth_token_request():
+    token_config = TokenConfig(_SECRET)
+    app = AuthTokenApplication(_PROTECTED_DIR, token_config)
+    url_path = token_config.get_url_path("foo.txt")
+    return lambda: _call_app(app, url_path), None
+
+
+@benchmark
+def auth_token_request_with_forged_token():
+    token_config = TokenConfig(_SECRET)
+    app = AuthTokenApplication(_PROTECTED_DIR, token_config)
+    url_path = "/" + "0" * 32 + token_config.get_url_path("foo.txt")[33:]
+    return lambda: _call_app(app, url_path), None
+
+
+@benchmark
+def auth_token_request_with_usage_store():
+    temporary_directory = mkdtemp()
+    database_path = path.join(temporary_directory, "tokens.sqlite")
+    token_usage_store = SQLiteTokenUsageStore(database_path, sys.maxsize)
+
+    token_config = TokenConfig(_SECRET)
+    app = AuthTokenApplication(
+        _PROTECTED_DIR,
+        token_config,
+        token_usage_store=token_usage_store,
+    )
+    url_path = token_config.get_url_path("foo.txt")
+    return lambda: _call_app(app, url_path), lambda: rmtree(temporary_directory)
+
+
+@benchmark
+def deep_path_resolution_with_openat2():
+    app, relative_file_path, clean_up = _make_deep_tree_app()
+    if app._root_directory_descriptor is None:
+        clean_up()
+        raise _UnsupportedBenchmark("openat2() is not available")
+    return lambda: app._lookup_file(relative_file_path), clean_up
+
+
+@benchmark
+def deep_path_resolution_with_realpath():
+    app, relative_file_path, clean_up = _make_deep_tree_app()
+    app._root_directory_descriptor = None
+    return lambda: app._lookup_file(relative_file_path), clean_up
+
+
+@benchmark
+def interpreter_startup():
+    return lambda: _run_python("pass"), None
+
+
+@benchmark
+def import_xsendfile():
+    return lambda: _run_python("import xsendfile"), None
+
+
+# }
+
+
+class _UnsupportedBenchmark(Exception):
+    pass
+
+
+def _make_deep_tree_app(depth=20):
+    temporary_directory = path.realpath(mkdtemp())
+    relative_directory_path = path.join(*["level-%s" % i for i in range(depth)])
+    os.makedirs(path.join(temporary_directory, relative_directory_path))
+
+    relative_file_path = "/" + path.join(relative_directory_path, "foo.txt")
+    with open(temporary_directory + relative_file_path, "w") as file_:
+        file_.write("foo")
+
+    app = XSendfileApplication(temporary_directory)
+    return app, relative_file_path, lambda: rmtree(temporary_directory)
+
+
+def _run_python(code):
+    subprocess.check_call([sys.executable, "-c", code], cwd=_ROOT_DIR)
+
+
+def _call_app(app, path_info):
+    environ = {'PATH_INFO': path_info}
+    setup_testing_defaults(environ)
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    for _ in app(environ, start_response):
+        pass
+
+
+def main(benchmark_names):
+    benchmark_functions = [
+        f for f in _BENCHMARKS
+        if not benchmark_names or f.__name__ in benchmark_names
+    ]
+    for benchmark_function in benchmark_functions:
+        try:
+            timed_function, clean_up = benchmark_function()
+        except _UnsupportedBenchmark as exc:
+            print("%s: skipped (%s)" % (benchmark_function.__name__, exc))
+            continue
+
+        try:
+            timer = Timer(timed_function)
+            iterations = timer.autorange()[0] if hasattr(timer, "autorange") \
+                else 1000
+            best_time = min(timer.repeat(3, iterations)) / iterations
+        finally:
+            if clean_up:
+                clean_up()
+
+        print("%s: %.2f usec per call" % (
+            benchmark_function.__name__,
+            best_time * 1e6,
+        ))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,551 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2010-2015, 2degrees Limited.
+# All Rights Reserved.
+#
+# This file is part of wsgi-xsendfile <http://pythonhosted.org/xsendfile/>,
+# which is subject to the provisions of the BSD at
+# <http://dev.2degreesnetwork.com/p/2degrees-license.html>. A copy of the
+# license should accompany this distribution. THIS SOFTWARE IS PROVIDED "AS IS"
+# AND ANY AND ALL EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST
+# INFRINGEMENT, AND FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Load-test harness for wsgi-xsendfile.
+
+Run ``python loadtest.py run`` to serve a generated file tree with a local WSGI
+server while concurrent clients request it, and ``python loadtest.py compare``
+to compare the results of two runs saved with ``--output``.
+
+"""
+from __future__ import print_function
+
+import json
+import math
+import os
+import random
+import signal
+import sys
+import threading
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer
+from wsgiref.simple_server import WSGIRequestHandler
+from wsgiref.simple_server import WSGIServer
+from wsgiref.simple_server import make_server
+
+from six.moves.http_client import HTTPConnection
+from six.moves.http_client import HTTPException
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import quote
+
+from xsendfile import AuthTokenApplication
+from xsendfile import DirectSendfile
+from xsendfile import NginxSendfile
+from xsendfile import SizeAwareSendfile
+from xsendfile import TokenConfig
+from xsendfile import XSendfile
+from xsendfile import XSendfileApplication
+
+
+_SECRET = "s3cr3t"
+
+_TOKEN_TIMEOUT = 3600
+
+_FILE_SENDER_FACTORIES = {
+    'standard': XSendfile,
+    'nginx': NginxSendfile,
+    'serve': lambda: "serve",
+    'direct': lambda: DirectSendfile(content_cache_size=16 * 1024 * 1024),
+    'size-aware': SizeAwareSendfile,
+}
+
+# The share of the requests for each outcome, and the status expected:
+_OUTCOMES_BY_APPLICATION = {
+    'xsendfile': [
+        ("valid", 95, 200),
+        ("missing", 5, 404),
+    ],
+    'auth-token': [
+        ("valid", 85, 200),
+        ("expired", 5, 410),
+        ("forged", 5, 404),
+        ("missing", 5, 404),
+    ],
+}
+
+_PERCENTILES = (("p50", 0.5), ("p99", 0.99), ("p999", 0.999))
+
+
+# { Command line
+
+
+def main(arguments=None):
+    parser = ArgumentParser(prog="python loadtest.py")
+    subparsers = parser.add_subparsers(dest="command")
+
+    run_parser = subparsers.add_parser("run", help="Run a load test.")
+    run_parser.add_argument(
+        "--application",
+        choices=sorted(_OUTCOMES_BY_APPLICATION),
+        default="auth-token",
+    )
+    run_parser.add_argument(
+        "--sender",
+        choices=sorted(_FILE_SENDER_FACTORIES),
+        default="standard",
+    )
+    run_parser.add_argument(
+        "--server",
+        choices=("threaded", "pre-fork"),
+        default="threaded",
+    )
+    run_parser.add_argument("--workers", type=int, default=4)
+    run_parser.add_argument("--concurrency", type=int, default=16)
+    run_parser.add_argument("--duration", type=float, default=10)
+    run_parser.add_argument("--file-count", type=int, default=1000)
+    run_parser.add_argument("--file-size", type=int, default=4096)
+    run_parser.add_argument("--output")
+
+    compare_parser = subparsers.add_parser(
+        "compare",
+        help="Compare the results of two load tests.",
+    )
+    compare_parser.add_argument("baseline_results")
+    compare_parser.add_argument("new_results")
+
+    arguments = parser.parse_args(arguments)
+
+    if arguments.command == "run":
+        results = run_load_test(
+            arguments.application,
+            arguments.sender,
+            arguments.server,
+            arguments.workers,
+            arguments.concurrency,
+            arguments.duration,
+            arguments.file_count,
+            arguments.file_size,
+        )
+        _print_results(results)
+        if arguments.output:
+            with open(arguments.output, "w") as output_file:
+                json.dump(results, output_file, indent=2, sort_keys=True)
+
+    elif arguments.command == "compare":
+        with open(arguments.baseline_results) as baseline_results_file:
+            baseline_results = json.load(baseline_results_file)
+        with open(arguments.new_results) as new_results_file:
+            new_results = json.load(new_results_file)
+        _print_comparison(baseline_results, new_results)
+
+    else:
+        parser.print_usage()
+
+
+# }
+
+
+def run_load_test(application_name, sender_name, server_mode, worker_count,
+                  concurrency, duration, file_count, file_size):
+    """
+    Serve a generated file tree and request it from ``concurrency`` threads
+    during ``duration`` seconds.
+
+    :return: The configuration of the run and the throughput and latency
+        percentiles for each outcome, in a JSON-serializable dictionary.
+
+    """
+    root_directory = os.path.realpath(mkdtemp())
+    try:
+        relative_file_paths = \
+            _make_file_tree(root_directory, file_count, file_size)
+
+        token_config = TokenConfig(_SECRET, timeout=_TOKEN_TIMEOUT)
+        app = _make_application(
+            application_name,
+            sender_name,
+            root_directory,
+            token_config,
+        )
+        requests = _make_requests(
+            application_name,
+            token_config,
+            relative_file_paths,
+        )
+
+        port, stop_server = _start_server(app, server_mode, worker_count)
+        try:
+            samples, elapsed_time = \
+                _run_clients(port, requests, concurrency, duration)
+        finally:
+            stop_server()
+    finally:
+        rmtree(root_directory)
+
+    results = {
+        'configuration': {
+            'application': application_name,
+            'sender': sender_name,
+            'server': server_mode,
+            'workers': worker_count if server_mode == "pre-fork" else 1,
+            'concurrency': concurrency,
+            'duration': duration,
+            'file_count': file_count,
+            'file_size': file_size,
+            'python': sys.version.split()[0],
+            'date': datetime.now().isoformat(),
+        },
+        'elapsed_time': elapsed_time,
+        'outcomes': _summarize_samples(samples, elapsed_time),
+    }
+    return results
+
+
+# { File tree and requests
+
+
+def _make_file_tree(root_directory, file_count, file_size):
+    contents = os.urandom(file_size)
+
+    relative_file_paths = []
+    for file_index in range(file_count):
+        relative_file_path = "directory-%02d/file-%05d.bin" % (
+            file_index % 16,
+            file_index,
+        )
+        absolute_file_path = os.path.join(root_directory, relative_file_path)
+        directory_path = os.path.dirname(absolute_file_path)
+        if not os.path.isdir(directory_path):
+            os.mkdir(directory_path)
+
+        with open(absolute_file_path, "wb") as file_:
+            file_.write(contents)
+
+        relative_file_paths.append(relative_file_path)
+
+    return relative_file_paths
+
+
+def _make_application(application_name, sender_name, root_directory,
+                      token_config):
+    file_sender = _FILE_SENDER_FACTORIES[sender_name]()
+    if application_name == "auth-token":
+        app = AuthTokenApplication(root_directory, token_config, file_sender)
+    else:
+        app = XSendfileApplication(root_directory, file_sender)
+    return app
+
+
+def _make_requests(application_name, token_config, relative_file_paths):
+    """
+    Return the outcomes to request with their share of the requests, the
+    status expected and the URL paths to pick from.
+
+    """
+    expired_token_time = datetime.now() - timedelta(seconds=2 * _TOKEN_TIMEOUT)
+    missing_file_paths = [
+        "missing/" + relative_file_path
+        for relative_file_path in relative_file_paths
+    ]
+
+    if application_name == "auth-token":
+        url_paths_by_outcome = {
+            'valid': [
+                token_config.get_url_path(relative_file_path)
+                for relative_file_path in relative_file_paths
+            ],
+            'expired': [
+                token_config._generate_url_path(
+                    relative_file_path,
+                    expired_token_time,
+                )
+                for relative_file_path in relative_file_paths
+            ],
+            'forged': [
+                _forge_url_path(token_config.get_url_path(relative_file_path))
+                for relative_file_path in relative_file_paths
+            ],
+            'missing': [
+                token_config.get_url_path(missing_file_path)
+                for missing_file_path in missing_file_paths
+            ],
+        }
+    else:
+        url_paths_by_outcome = {
+            'valid': ["/" + quote(p) for p in relative_file_paths],
+            'missing': ["/" + quote(p) for p in missing_file_paths],
+        }
+
+    requests = [
+        (outcome, weight, expected_status, url_paths_by_outcome[outcome])
+        for outcome, weight, expected_status
+        in _OUTCOMES_BY_APPLICATION[application_name]
+    ]
+    return requests
+
+
+def _forge_url_path(url_path):
+    digest, rest_of_url_path = url_path[1:].split("-", 1)
+    return "/%s-%s" % ("0" * len(digest), rest_of_url_path)
+
+
+# }
+
+
+# { Server
+
+
+class _WSGIServer(WSGIServer):
+
+    # The default backlog of 5 connections makes clients wait for SYN retries:
+    request_queue_size = 1024
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, _WSGIServer):
+
+    daemon_threads = True
+
+
+class _QuietWSGIRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start_server(app, server_mode, worker_count):
+    """
+    Start serving ``app`` on an ephemeral port.
+
+    :return: The port and a callable to stop the server.
+
+    """
+    if server_mode == "threaded":
+        server_class = _ThreadingWSGIServer
+    else:
+        server_class = _WSGIServer
+
+    server = make_server(
+        "127.0.0.1",
+        0,
+        app,
+        server_class,
+        _QuietWSGIRequestHandler,
+    )
+    port = server.server_port
+
+    if server_mode == "threaded":
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        def stop_server():
+            server.shutdown()
+            server.server_close()
+
+    else:
+        # The workers accept the connections on the same listening socket:
+        worker_pids = []
+        for _ in range(worker_count):
+            worker_pid = os.fork()
+            if worker_pid == 0:  # pragma:no cover
+                try:
+                    server.serve_forever()
+                finally:
+                    os._exit(0)
+            worker_pids.append(worker_pid)
+
+        def stop_server():
+            for worker_pid in worker_pids:
+                os.kill(worker_pid, signal.SIGTERM)
+                os.waitpid(worker_pid, 0)
+            server.server_close()
+
+    return port, stop_server
+
+
+# }
+
+
+# { Clients
+
+
+def _run_clients(port, requests, concurrency, duration):
+    """
+    Request the URL paths in ``requests`` from ``concurrency`` threads until
+    ``duration`` seconds have elapsed.
+
+    :return: The outcome, whether the status was the expected one and the
+        latency of each request, and the time actually elapsed.
+
+    """
+    weighted_requests = []
+    for outcome, weight, expected_status, url_paths in requests:
+        weighted_requests.extend(
+            [(outcome, expected_status, url_paths)] * weight,
+        )
+
+    samples_by_client = [[] for _ in range(concurrency)]
+    start_time = default_timer()
+    deadline = start_time + duration
+
+    def run_client(samples):
+        random_generator = random.Random()
+        while default_timer() < deadline:
+            outcome, expected_status, url_paths = \
+                random_generator.choice(weighted_requests)
+            url_path = random_generator.choice(url_paths)
+
+            request_start_time = default_timer()
+            status = _request(port, url_path)
+            latency = default_timer() - request_start_time
+
+            samples.append((outcome, status == expected_status, latency))
+
+    client_threads = [
+        threading.Thread(target=run_client, args=(samples,))
+        for samples in samples_by_client
+    ]
+    for client_thread in client_threads:
+        client_thread.start()
+    for client_thread in client_threads:
+        client_thread.join()
+
+    elapsed_time = default_timer() - start_time
+
+    samples = []
+    for client_samples in samples_by_client:
+        samples.extend(client_samples)
+    return samples, elapsed_time
+
+
+def _request(port, url_path):
+    connection = HTTPConnection("127.0.0.1", port)
+    try:
+        connection.request("GET", url_path)
+        response = connection.getresponse()
+        if not _is_offloaded(response):
+            response.read()
+        status = response.status
+    except (HTTPException, IOError, OSError):
+        status = None
+    finally:
+        connection.close()
+    return status
+
+
+def _is_offloaded(response):
+    # There's no Web server in front to send the file, so the body is empty
+    # despite the Content-Length:
+    return response.getheader("X-Sendfile") or \
+        response.getheader("X-Accel-Redirect")
+
+
+# }
+
+
+# { Reports
+
+
+def _summarize_samples(samples, elapsed_time):
+    latencies_by_outcome = {}
+    error_counts_by_outcome = {}
+    for outcome, is_expected_status, latency in samples:
+        latencies_by_outcome.setdefault(outcome, []).append(latency)
+        error_counts_by_outcome.setdefault(outcome, 0)
+        if not is_expected_status:
+            error_counts_by_outcome[outcome] += 1
+
+    summaries_by_outcome = {}
+    for outcome, latencies in latencies_by_outcome.items():
+        latencies.sort()
+        summary = {
+            'requests': len(latencies),
+            'errors': error_counts_by_outcome[outcome],
+            'throughput': len(latencies) / elapsed_time,
+        }
+        for percentile_name, percentile in _PERCENTILES:
+            summary[percentile_name] = \
+                _get_percentile(latencies, percentile) * 1000
+        summaries_by_outcome[outcome] = summary
+
+    return summaries_by_outcome
+
+
+def _get_percentile(sorted_values, percentile):
+    # Nearest-rank method, ignoring the error of the multiplication:
+    rank = int(math.ceil(round(percentile * len(sorted_values), 9))) - 1
+    rank = min(max(rank, 0), len(sorted_values) - 1)
+    return sorted_values[rank]
+
+
+def _print_results(results):
+    configuration = results['configuration']
+    print(
+        "%(application)s application with %(sender)s sender on %(server)s "
+        "server (%(concurrency)s clients, %(file_count)s files of "
+        "%(file_size)s bytes)" % configuration
+    )
+    print("%-8s %9s %7s %10s %9s %9s %9s" % (
+        "outcome",
+        "requests",
+        "errors",
+        "req/s",
+        "p50 ms",
+        "p99 ms",
+        "p999 ms",
+    ))
+    for outcome, summary in sorted(results['outcomes'].items()):
+        print("%-8s %9d %7d %10.1f %9.2f %9.2f %9.2f" % (
+            outcome,
+            summary['requests'],
+            summary['errors'],
+            summary['throughput'],
+            summary['p50'],
+            summary['p99'],
+            summary['p999'],
+        ))
+
+
+def _print_comparison(baseline_results, new_results):
+    print("%-8s %-10s %10s %10s %8s" % (
+        "outcome",
+        "metric",
+        "baseline",
+        "new",
+        "change",
+    ))
+    metric_names = ["throughput"] + [name for name, _ in _PERCENTILES]
+    for outcome, new_summary in sorted(new_results['outcomes'].items()):
+        baseline_summary = baseline_results['outcomes'].get(outcome)
+        if baseline_summary is None:
+            continue
+
+        for metric_name in metric_names:
+            baseline_value = baseline_summary[metric_name]
+            new_value = new_summary[metric_name]
+            if baseline_value:
+                change = "%+.1f%%" % (
+                    (new_value - baseline_value) * 100.0 / baseline_value
+                )
+            else:
+                change = "n/a"
+            print("%-8s %-10s %10.2f %10.2f %8s" % (
+                outcome,
+                metric_name,
+                baseline_value,
+                new_value,
+                change,
+            ))
+
+
+# }
+
+
+if __name__ == "__main__":
+    main()
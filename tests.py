@@ -17,24 +17,73 @@
 Unit test suite for wsgi-xsendfile.
 
 """
+import base64
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
 from contextlib import closing
+from io import BytesIO
+from zipfile import ZipFile
 from datetime import datetime, timedelta
+from email.utils import formatdate
 from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
 from time import mktime
+from time import sleep
+from time import time as get_current_time
 
 from nose.tools import assert_false, assert_raises, eq_, ok_
 from pytz import utc as UTC
+from six import StringIO
 from six.moves.urllib.parse import quote
 from webtest import TestApp, TestRequest, TestResponse
 
+import loadtest
+import xsendfile
+from xsendfile import AccessLogMiddleware
 from xsendfile import AuthTokenApplication
+from xsendfile import BadCacheFileError
 from xsendfile import BadRootError
 from xsendfile import BadSenderError
+from xsendfile import BandwidthScheduler
+from xsendfile import CachePolicy
+from xsendfile import ContentDigestStore
+from xsendfile import ContentTypeResolver
+from xsendfile import DirectSendfile
+from xsendfile import FileSystemGuard
+from xsendfile import FileSystemUnavailableError
+from xsendfile import FileSystemWatcher
+from xsendfile import HotFileTracker
 from xsendfile import NginxSendfile
+from xsendfile import NginxSendfileTemporary
+from xsendfile import ProfilingMiddleware
+from xsendfile import SQLiteTokenUsageStore
+from xsendfile import SharedMetadataCache
+from xsendfile import SizeAwareSendfile
 from xsendfile import TokenConfig
+from xsendfile import TokenRevocationList
+from xsendfile import TokenUsageStoreUnavailableError
+from xsendfile import UnionXSendfileApplication
 from xsendfile import XSendfile
 from xsendfile import XSendfileApplication
+from xsendfile import XSendfileMiddleware
+from xsendfile import XSendfileTemporary
+from xsendfile import ZipArchiveApplication
+from xsendfile import get_hot_paths_from_access_log
+from xsendfile import main
+from xsendfile import prewarm
 from xsendfile import _BuiltinHashWrapper
+from xsendfile import _ContentDigest
+from xsendfile import _ErrorResponse
+from xsendfile import _FileContentCache
+from xsendfile import _FileDescriptorCache
+from xsendfile import _decode_path
+from xsendfile import _encode_path
+from xsendfile import _get_decoded_path_info
 
 
 # Short-cuts to directories in the fixtures:
@@ -171,6 +220,19 @@ class TestXSendfileConstructor(object):
         # }
 
 
+class TestImport(object):
+    """Tests for the import of the module."""
+
+    def test_paste_not_imported(self):
+        """Paste is only imported when the ``serve`` sender is used."""
+        command = [
+            sys.executable,
+            "-c",
+            "import sys, xsendfile; sys.exit('paste.fileapp' in sys.modules)",
+        ]
+        eq_(subprocess.call(command, cwd=_ROOT_DIR or None), 0)
+
+
 class TestXSendfileRequests(object):
     """Unit tests for the requests sent to the X-Sendfile application."""
 
@@ -250,12 +312,20 @@ class TestXSendfileRequests(object):
             path.join(_PROTECTED_DIR, url_encoded_path.lstrip("/")))
 
     def test_existing_file_with_method_other_than_get(self):
-        """Only GET requests are supported."""
-        # Methods OPTIONS, HEAD, TRACE and CONNECT are not supported by WebTest:
+        """Only GET and HEAD requests are supported."""
+        # Methods OPTIONS, TRACE and CONNECT are not supported by WebTest:
         for http_method_name in ("post", "put", "delete"):
             http_method = getattr(self.app, http_method_name)
             response = http_method("/foo.txt", status=405)
             ok_("X-Sendfile" not in response.headers)
+            eq_(response.headers['Allow'], "GET, HEAD")
+
+    def test_existing_file_with_head_method(self):
+        response = self.app.head("/foo.txt", status=200)
+        eq_(
+            response.headers['X-Sendfile'],
+            path.join(_PROTECTED_DIR, "foo.txt"),
+        )
 
     def test_existing_file_with_redundant_slashes(self):
         """Redundant slashes must be removed from the file name."""
@@ -266,113 +336,2708 @@ class TestXSendfileRequests(object):
             path.join(_PROTECTED_SUB_DIR, "baz.txt"))
 
 
-# { Tests for the file serving applications:
+class TestPathCodec(object):
+    """Unit tests for the decoding and encoding of URL paths."""
+
+    def test_ascii_path(self):
+        eq_(_decode_path("/sub-directory/baz.txt"), u"/sub-directory/baz.txt")
+        eq_(_encode_path(u"/sub-directory/baz.txt"), "/sub-directory/baz.txt")
+
+    def test_escaped_ascii_path(self):
+        eq_(_decode_path("/file%20with%20spaces.txt"), u"/file with spaces.txt")
+        eq_(_encode_path(u"/file with spaces.txt"), "/file%20with%20spaces.txt")
+
+    def test_non_ascii_path(self):
+        for file_name in (_NON_ASCII_FILE_NAME, _NON_LATIN1_FILE_NAME):
+            path_encoded = _encode_path(u"/" + file_name)
+            eq_(path_encoded, quote((u"/" + file_name).encode("utf8")))
+
+            # Percent-encoded:
+            eq_(_decode_path(path_encoded), u"/" + file_name)
+
+            # As set by the WSGI server:
+            eq_(_decode_path(_get_wsgi_path(file_name)), u"/" + file_name)
+
+    def test_memoized_path(self):
+        path_encoded = _get_wsgi_path(_NON_LATIN1_FILE_NAME)
+        eq_(_decode_path(path_encoded), _decode_path(path_encoded))
+
+    def test_invalid_utf8(self):
+        assert_raises(UnicodeDecodeError, _decode_path, "/%FF.txt")
+
+    def test_decoded_path_info_in_environ(self):
+        """PATH_INFO is decoded once unless it's changed."""
+        environ = {'PATH_INFO': _get_wsgi_path(_NON_ASCII_FILE_NAME)}
+        eq_(_get_decoded_path_info(environ), u"/" + _NON_ASCII_FILE_NAME)
+
+        environ['xsendfile.decoded_path_info'] = \
+            (environ['PATH_INFO'], u"/memoized.txt")
+        eq_(_get_decoded_path_info(environ), u"/memoized.txt")
+
+        environ['PATH_INFO'] = "/foo.txt"
+        eq_(_get_decoded_path_info(environ), u"/foo.txt")
+
+
+def _get_wsgi_path(file_name):
+    path_bytes = (u"/" + file_name).encode("utf8")
+    if bytes is str:
+        # Python 2:
+        return path_bytes
+    return path_bytes.decode("latin1")
+
+
+class TestErrorResponse(object):
+    """Unit tests for the error responses."""
+
+    def setUp(self):
+        error_response = _ErrorResponse(
+            "405 Method Not Allowed",
+            "Not allowed.",
+            [("Allow", "GET")],
+        )
+        self.app = _TestApp(error_response)
+
+    def test_plain_text(self):
+        response = self.app.get("/", status=405)
+
+        eq_(response.content_type, "text/plain")
+        eq_(response.body, b"405 Method Not Allowed\n\nNot allowed.\n")
+        eq_(response.content_length, len(response.body))
+        eq_(response.headers['Allow'], "GET")
+
+    def test_html(self):
+        headers = {'Accept': "text/html,application/xhtml+xml;q=0.9"}
+        for _ in range(2):
+            response = self.app.get("/", headers=headers, status=405)
+
+            eq_(response.content_type, "text/html")
+            ok_(b"<h1>405 Method Not Allowed</h1>" in response.body)
+            eq_(response.content_length, len(response.body))
+            eq_(response.headers['Allow'], "GET")
+
+    def test_unknown_accept_header(self):
+        headers = {'Accept': "image/png"}
+        response = self.app.get("/", headers=headers, status=405)
+        eq_(response.content_type, "text/plain")
+
+
+class TestXSendfileRequestsWithPortableResolution(TestXSendfileRequests):
+    """
+    Unit tests for the requests sent to an application which can't resolve
+    paths with ``openat2()``.
+
+    """
+
+    def setUp(self):
+        app = XSendfileApplication(_PROTECTED_DIR)
+        app._root_directory_descriptor = None
+        self.app = _TestApp(app)
+
+
+class TestSiblingDirectories(object):
+    """
+    Directories whose path starts with the path to the root directory are
+    outside of the root directory.
+
+    """
+
+    def setUp(self):
+        self.temporary_directory = path.realpath(mkdtemp())
+        self.root_directory = path.join(self.temporary_directory, "root")
+        sibling_directory = path.join(self.temporary_directory, "root-other")
+        os.mkdir(self.root_directory)
+        os.mkdir(sibling_directory)
+        with open(path.join(sibling_directory, "foo.txt"), "w") as file_:
+            file_.write("foo")
+
+    def tearDown(self):
+        rmtree(self.temporary_directory)
+
+    def test_sibling_directory(self):
+        app = _TestApp(XSendfileApplication(self.root_directory))
+        app.get("/../root-other/foo.txt", status=403)
+
+    def test_sibling_directory_with_portable_resolution(self):
+        app = XSendfileApplication(self.root_directory)
+        app._root_directory_descriptor = None
+        _TestApp(app).get("/../root-other/foo.txt", status=403)
+
+
+class TestUnionXSendfileRequests(TestXSendfileRequests):
+    """
+    Unit tests for the requests sent to a union application with a single
+    root directory.
+
+    """
+
+    def setUp(self):
+        self.app = _TestApp(UnionXSendfileApplication([_PROTECTED_DIR]))
+
+
+class TestUnionXSendfileApplication(object):
+    """Unit tests for the union of several root directories."""
+
+    def setUp(self):
+        self.temporary_directory = path.realpath(mkdtemp())
+        self.first_root_directory = \
+            path.join(self.temporary_directory, "first")
+        self.second_root_directory = \
+            path.join(self.temporary_directory, "second")
+        for root_directory in (
+                self.first_root_directory, self.second_root_directory):
+            os.mkdir(root_directory)
+            os.mkdir(path.join(root_directory, "sub-directory"))
+
+        self._write_file(self.first_root_directory, "shared.txt")
+        self._write_file(self.second_root_directory, "shared.txt")
+        self._write_file(self.second_root_directory, "second.txt")
+        self._write_file(self.second_root_directory, "sub-directory/baz.txt")
+        self._write_file(self.temporary_directory, "outside.txt")
+
+        self.union_app = UnionXSendfileApplication(
+            [self.first_root_directory, self.second_root_directory],
+        )
+        self.app = _TestApp(self.union_app)
+
+    def tearDown(self):
+        rmtree(self.temporary_directory)
+
+    def test_no_root_directories(self):
+        assert_raises(BadRootError, UnionXSendfileApplication, [])
+
+    def test_invalid_root_directory(self):
+        assert_raises(
+            BadRootError,
+            UnionXSendfileApplication,
+            [self.first_root_directory, "relative-directory"],
+        )
+
+    def test_precedence(self):
+        """The file in the first root directory is served."""
+        response = self.app.get("/shared.txt", status=200)
+        eq_(
+            response.headers['X-Sendfile'],
+            path.join(self.first_root_directory, "shared.txt"),
+        )
+
+    def test_file_in_second_root_directory(self):
+        response = self.app.get("/second.txt", status=200)
+        eq_(
+            response.headers['X-Sendfile'],
+            path.join(self.second_root_directory, "second.txt"),
+        )
+
+    def test_file_in_sub_directory(self):
+        """Directories present in several volumes are merged."""
+        response = self.app.get("/sub-directory/../sub-directory/baz.txt")
+        eq_(
+            response.headers['X-Sendfile'],
+            path.join(self.second_root_directory, "sub-directory", "baz.txt"),
+        )
+
+    def test_non_existing_file(self):
+        self.app.get("/does-not-exist.txt", status=404)
+
+    def test_file_outside_of_roots(self):
+        self.app.get("/../outside.txt", status=403)
+        self.app.get("/sub-directory/../../second/second.txt", status=403)
+
+    def test_symbolic_link_outside_of_root(self):
+        """Symbolic links can't escape the root directory of their volume."""
+        os.symlink(
+            path.join(self.first_root_directory, "shared.txt"),
+            path.join(self.second_root_directory, "link.txt"),
+        )
+        self.union_app.refresh_index()
+
+        self.app.get("/link.txt", status=403)
+
+    def test_added_file(self):
+        """New files are served before the index is refreshed."""
+        self._write_file(self.second_root_directory, "sub-directory/new.txt")
+        expected_file_path = \
+            path.join(self.second_root_directory, "sub-directory", "new.txt")
+
+        response = self.app.get("/sub-directory/new.txt", status=200)
+        eq_(response.headers['X-Sendfile'], expected_file_path)
+
+        self.union_app.refresh_index()
+
+        response = self.app.get("/sub-directory/new.txt", status=200)
+        eq_(response.headers['X-Sendfile'], expected_file_path)
+
+    def test_added_file_precedence(self):
+        """New files missing from the index are found in the first volume."""
+        self._write_file(self.first_root_directory, "new.txt")
+        self._write_file(self.second_root_directory, "new.txt")
+
+        response = self.app.get("/new.txt", status=200)
+        eq_(
+            response.headers['X-Sendfile'],
+            path.join(self.first_root_directory, "new.txt"),
+        )
+
+    def test_removed_file(self):
+        """Removed files are served from the next volume that has them."""
+        os.remove(path.join(self.first_root_directory, "shared.txt"))
+        self.union_app.refresh_index()
+
+        response = self.app.get("/shared.txt", status=200)
+        eq_(
+            response.headers['X-Sendfile'],
+            path.join(self.second_root_directory, "shared.txt"),
+        )
+
+    def test_removed_directory(self):
+        rmtree(path.join(self.second_root_directory, "sub-directory"))
+        self.union_app.refresh_index()
+
+        self.app.get("/sub-directory/baz.txt", status=404)
+        eq_(list(self.union_app._directory_listings[1]), [""])
+
+    @staticmethod
+    def _write_file(directory, relative_file_path):
+        with open(path.join(directory, relative_file_path), "w") as file_:
+            file_.write(relative_file_path)
+
+
+class TestXSendfileRequestsWithMetadataCache(TestXSendfileRequests):
+    """Unit tests for the requests sent to an application with a cache."""
+
+    def setUp(self):
+        self.metadata_cache = SharedMetadataCache()
+        app = XSendfileApplication(
+            _PROTECTED_DIR,
+            metadata_cache=self.metadata_cache,
+        )
+        self.app = _TestApp(app)
+
+    def test_cached_file(self):
+        """Files are resolved from the cache once they've been requested."""
+        self.app.get("/foo.txt", status=200)
+
+        cache_key = _PROTECTED_DIR + "\0/foo.txt"
+        absolute_file_path, file_stat = self.metadata_cache.get(cache_key)
+        eq_(absolute_file_path, path.join(_PROTECTED_DIR, "foo.txt"))
+        eq_(file_stat.st_size, 11)
+
+    def test_cached_non_existing_file(self):
+        """Files which don't exist are cached too."""
+        self.app.get("/does-not-exist.png", status=404)
+
+        cache_key = _PROTECTED_DIR + "\0/does-not-exist.png"
+        eq_(
+            self.metadata_cache.get(cache_key),
+            (path.join(_PROTECTED_DIR, "does-not-exist.png"), None),
+        )
+
+
+class TestCachePolicy(object):
+    """Unit tests for the rules that set the caching headers."""
+
+    def setUp(self):
+        self.policy = CachePolicy()
+
+    def test_no_rules(self):
+        eq_(self.policy.get_headers("/foo.txt", "text/plain"), [])
+
+    def test_path_prefix(self):
+        self.policy.add_rule(60, path_prefix="/sub-directory/")
+
+        eq_(self.policy.get_headers("/foo.txt", "text/plain"), [])
+
+        headers = \
+            dict(self.policy.get_headers("/sub-directory/baz.txt", "text/plain"))
+        eq_(headers['Cache-Control'], "public, max-age=60")
+        ok_(headers['Expires'].endswith(" GMT"))
+
+    def test_path_prefix_segments(self):
+        """Path prefixes only match whole segments."""
+        self.policy.add_rule(60, path_prefix="/sub-directory")
+
+        for file_path in ("/sub-directory-2/a.txt", "/sub-directory.txt"):
+            eq_(self.policy.get_headers(file_path, "text/plain"), [])
+        eq_(
+            len(self.policy.get_headers("/sub-directory/a.txt", "text/plain")),
+            2,
+        )
+
+    def test_path_aliases(self):
+        """Paths are normalized before they're matched."""
+        self.policy.add_rule(0, path_prefix="/private/", is_private=True)
+        self.policy.add_rule(3600, path_prefix="/public/")
+
+        for file_path in (
+                "/public/../private/secret.txt",
+                "//private/secret.txt",
+                "/./private//secret.txt",
+                "/../private/secret.txt"):
+            headers = dict(self.policy.get_headers(file_path, "text/plain"))
+            eq_(headers['Cache-Control'], "private, max-age=0, no-cache")
+
+        eq_(self.policy.get_headers("/private/../foo.txt", "text/plain"), [])
+
+    def test_mime_type(self):
+        self.policy.add_rule(60, mime_type="text/plain")
+
+        eq_(self.policy.get_headers("/binary-file.png", "image/png"), [])
+        eq_(len(self.policy.get_headers("/foo.txt", "text/plain")), 2)
+
+    def test_major_mime_type(self):
+        self.policy.add_rule(60, mime_type="image/*")
+
+        eq_(self.policy.get_headers("/foo.txt", "text/plain"), [])
+        eq_(len(self.policy.get_headers("/binary-file.png", "image/png")), 2)
+
+    def test_file_sender(self):
+        file_sender = XSendfile()
+        self.policy.add_rule(60, file_sender=file_sender)
+
+        eq_(self.policy.get_headers("/foo.txt", "text/plain", XSendfile()), [])
+        eq_(
+            len(self.policy.get_headers("/foo.txt", "text/plain", file_sender)),
+            2,
+        )
+
+    def test_first_matching_rule(self):
+        self.policy.add_rule(60, mime_type="text/plain", is_private=True)
+        self.policy.add_rule(3600, is_immutable=True)
+
+        headers = dict(self.policy.get_headers("/foo.txt", "text/plain"))
+        eq_(headers['Cache-Control'], "private, max-age=60")
+
+        headers = dict(self.policy.get_headers("/binary-file.png", "image/png"))
+        eq_(headers['Cache-Control'], "public, max-age=3600, immutable")
+
+    def test_revalidation(self):
+        self.policy.add_rule(0)
+
+        headers = dict(self.policy.get_headers("/foo.txt", "text/plain"))
+        eq_(headers['Cache-Control'], "public, max-age=0, no-cache")
+
+    def test_deadline(self):
+        """The max-age is capped to the remaining lifetime of the URL."""
+        self.policy.add_rule(3600)
+        deadline = datetime.now() + timedelta(seconds=100)
+
+        headers = dict(
+            self.policy.get_headers("/foo.txt", "text/plain", None, deadline),
+        )
+        max_age = int(headers['Cache-Control'].split("=")[1])
+        ok_(90 <= max_age <= 100)
+
+    def test_expired_deadline(self):
+        self.policy.add_rule(3600)
+        deadline = datetime.now() - timedelta(seconds=100)
+
+        headers = dict(
+            self.policy.get_headers("/foo.txt", "text/plain", None, deadline),
+        )
+        eq_(headers['Cache-Control'], "public, max-age=0")
+
+
+class TestXSendfileRequestsWithCachePolicy(object):
+    """Acceptance tests for the caching headers of the files served."""
+
+    def setUp(self):
+        cache_policy = CachePolicy()
+        cache_policy.add_rule(60, path_prefix="/sub-directory/")
+        self.app = _TestApp(
+            XSendfileApplication(_PROTECTED_DIR, cache_policy=cache_policy),
+        )
+
+    def test_matching_file(self):
+        response = self.app.get("/" + _SUB_DIRECTORY_FILE, status=200)
+        eq_(response.headers['Cache-Control'], "public, max-age=60")
+        ok_("Expires" in response.headers)
+
+    def test_non_matching_file(self):
+        response = self.app.get("/foo.txt", status=200)
+        ok_("Cache-Control" not in response.headers)
+
+    def test_aliased_file(self):
+        """Files requested through aliases get the rules of their own path."""
+        cache_policy = CachePolicy()
+        cache_policy.add_rule(
+            0,
+            path_prefix="/sub-directory/",
+            is_private=True,
+        )
+        cache_policy.add_rule(31536000)
+        app = _TestApp(
+            XSendfileApplication(_PROTECTED_DIR, cache_policy=cache_policy),
+        )
+
+        response = app.get("/./sub-directory/baz.txt", status=200)
+        eq_(
+            response.headers['Cache-Control'],
+            "private, max-age=0, no-cache",
+        )
+
+    def test_error_response(self):
+        response = self.app.get("/sub-directory/nope.txt", status=404)
+        ok_("Cache-Control" not in response.headers)
+
+    def test_sender_headers(self):
+        """Caching headers set by the file sender are kept."""
+        cache_policy = CachePolicy()
+        cache_policy.add_rule(60)
+        app = _TestApp(XSendfileApplication(
+            _PROTECTED_DIR,
+            _CachingSender(),
+            cache_policy=cache_policy,
+        ))
+
+        response = app.get("/foo.txt", status=200)
+        eq_(response.headers['Cache-Control'], "no-store")
+
+
+class _CachingSender(object):
+
+    def __call__(self, environ, start_response):
+        start_response("200 OK", [("Cache-Control", "no-store")])
+        return [b""]
+
+
+class TestContentDigestStore(object):
+    """Unit tests for the store of the digests of the files."""
+
+    def setUp(self):
+        self.temporary_directory = path.realpath(mkdtemp())
+        self.file_path = path.join(self.temporary_directory, "foo.txt")
+        self.sidecar_directory = path.join(self.temporary_directory, ".digests")
+        os.mkdir(self.sidecar_directory)
+        self._write_file(b"Lorem ipsum")
+
+    def tearDown(self):
+        rmtree(self.temporary_directory)
+
+    def test_computed_digest(self):
+        store = ContentDigestStore()
+        eq_(self._get_digest(store), hashlib.sha256(b"Lorem ipsum").hexdigest())
+
+    def test_stored_digest(self):
+        """Digests are computed once for each version of the file."""
+        store = ContentDigestStore(compute_missing=False)
+        eq_(self._get_digest(store), None)
+
+        store.update(self.file_path)
+        eq_(self._get_digest(store), hashlib.sha256(b"Lorem ipsum").hexdigest())
+
+    def test_stale_digest(self):
+        store = ContentDigestStore()
+        self._get_digest(store)
+
+        self._write_file(b"Lorem ipsum dolor")
+        eq_(
+            self._get_digest(store),
+            hashlib.sha256(b"Lorem ipsum dolor").hexdigest(),
+        )
+
+    def test_sidecar_directory(self):
+        """Digests are stored aside when extended attributes are missing."""
+        store = ContentDigestStore(
+            "md5",
+            self.sidecar_directory,
+            compute_missing=False,
+        )
+        with _WithoutExtendedAttributes():
+            store.update(self.file_path)
+            eq_(len(os.listdir(self.sidecar_directory)), 1)
+            eq_(self._get_digest(store), hashlib.md5(b"Lorem ipsum").hexdigest())
+
+    def test_without_persistence(self):
+        """Digests that can't be persisted are kept in memory."""
+        store = ContentDigestStore(compute_missing=False)
+        expected_digest = hashlib.sha256(b"Lorem ipsum").hexdigest()
+        with _WithoutExtendedAttributes():
+            store.update(self.file_path)
+            eq_(self._get_digest(store), expected_digest)
+
+            other_store = ContentDigestStore(compute_missing=False)
+            eq_(self._get_digest(other_store), None)
+
+    def test_hashing_once_without_persistence(self):
+        store = ContentDigestStore()
+        update_file_paths = []
+        original_update = store.update
+
+        def update(file_path):
+            update_file_paths.append(file_path)
+            return original_update(file_path)
+
+        store.update = update
+        with _WithoutExtendedAttributes():
+            for _ in range(3):
+                self._get_digest(store)
+
+        eq_(update_file_paths, [self.file_path])
+        ok_(store._has_reported_persistence_failure)
+
+    def test_large_file(self):
+        """Large files are hashed in the background."""
+        store = ContentDigestStore(max_inline_file_size=4)
+        eq_(self._get_digest(store), None)
+
+        for _ in range(100):
+            if self._get_digest(store) is not None:
+                break
+            sleep(0.01)
+        expected_digest = hashlib.sha256(b"Lorem ipsum").hexdigest()
+        eq_(self._get_digest(store), expected_digest)
+        eq_(store._pending_file_paths, set())
+
+    def test_headers(self):
+        store = ContentDigestStore()
+        app = XSendfileApplication(
+            self.temporary_directory,
+            content_digest_store=store,
+        )
+        response = _TestApp(app).get("/foo.txt", status=200)
+
+        digest = hashlib.sha256(b"Lorem ipsum")
+        digest_base64 = base64.b64encode(digest.digest()).decode("ascii")
+        eq_(response.headers['ETag'], '"%s"' % digest.hexdigest())
+        eq_(response.headers['Digest'], "sha-256=" + digest_base64)
+        eq_(response.headers['Content-Digest'], "sha-256=:%s:" % digest_base64)
+
+    def test_headers_from_direct_sender(self):
+        store = ContentDigestStore("sha1")
+        app = XSendfileApplication(
+            self.temporary_directory,
+            DirectSendfile(content_cache_size=4096),
+            content_digest_store=store,
+        )
+        response = _TestApp(app).get("/foo.txt", status=200)
+
+        digest = hashlib.sha1(b"Lorem ipsum")
+        eq_(response.headers['ETag'], '"%s"' % digest.hexdigest())
+        ok_("Digest" not in response.headers)
+
+    def test_command_line(self):
+        arguments = [
+            "digest",
+            self.temporary_directory,
+            "--sidecar-directory",
+            self.sidecar_directory,
+        ]
+        output = _call_main(arguments)
+        eq_(output, "Computed the digests of 1 files\n")
+
+        output = _call_main(arguments)
+        eq_(output, "Computed the digests of 0 files\n")
+
+    def _write_file(self, contents):
+        with open(self.file_path, "wb") as file_:
+            file_.write(contents)
+        # Make sure the modification time changes:
+        file_stat = os.stat(self.file_path)
+        os.utime(self.file_path, (file_stat.st_atime, file_stat.st_mtime + 1))
+
+    def _get_digest(self, store):
+        return store.get_digest(self.file_path, os.stat(self.file_path))
+
+
+class _WithoutExtendedAttributes(object):
+
+    def __enter__(self):
+        self.original_functions = {}
+        for function_name in ("getxattr", "setxattr"):
+            if hasattr(os, function_name):
+                self.original_functions[function_name] = \
+                    getattr(os, function_name)
+                delattr(os, function_name)
+
+    def __exit__(self, *exc_info):
+        for function_name, function in self.original_functions.items():
+            setattr(os, function_name, function)
+
+
+def _call_main(arguments):
+    original_stdout = sys.stdout
+    sys.stdout = output = StringIO()
+    try:
+        main(arguments)
+    finally:
+        sys.stdout = original_stdout
+    return output.getvalue()
+
+
+class TestXSendfileRequestsWithFileSystemGuard(TestXSendfileRequests):
+    """Unit tests for the requests sent to an application with a guard."""
+
+    def setUp(self):
+        app = XSendfileApplication(
+            _PROTECTED_DIR,
+            file_system_guard=FileSystemGuard(),
+        )
+        self.app = _TestApp(app)
+
+    def test_stalled_file_system(self):
+        """A 503 response is given when the lookup doesn't complete in time."""
+        file_system_guard = FileSystemGuard(timeout=0.01, retry_after=7)
+        app = XSendfileApplication(
+            _PROTECTED_DIR,
+            file_system_guard=file_system_guard,
+        )
+        release_event = threading.Event()
+        original_lookup_file = app._lookup_file_unguarded
+
+        def stalled_lookup_file(relative_file_path):
+            release_event.wait(5)
+            return original_lookup_file(relative_file_path)
+
+        app._lookup_file_unguarded = stalled_lookup_file
+        try:
+            response = _TestApp(app).get("/foo.txt", status=503)
+        finally:
+            release_event.set()
+
+        eq_(response.headers['Retry-After'], "7")
+
+
+class TestStalledFileSystem(object):
+    """Acceptance tests for the applications whose file system is stalled."""
+
+    def setUp(self):
+        self.release_event = threading.Event()
+        self.file_system_guard = FileSystemGuard(timeout=0.01, retry_after=7)
+
+    def tearDown(self):
+        self.release_event.set()
+
+    def test_prewarming(self):
+        """Files whose lookup fails are skipped."""
+        app = self._stall(XSendfileApplication(
+            _PROTECTED_DIR,
+            file_system_guard=self.file_system_guard,
+        ))
+        eq_(prewarm(app, ["foo.txt"]), 0)
+
+    def test_middleware(self):
+        """Files whose lookup fails are sent by the application itself."""
+        file_path = path.join(_PROTECTED_DIR, "foo.txt")
+        middleware = XSendfileMiddleware(
+            _FileApp(file_path),
+            _PROTECTED_DIR,
+            file_system_guard=self.file_system_guard,
+        )
+        self._stall(middleware._file_application)
+
+        response = _TestApp(middleware).get("/", status=200)
+
+        ok_("X-Sendfile" not in response.headers)
+        eq_(response.body, b"Lorem ipsum")
+
+    def test_archive(self):
+        app = self._stall(ZipArchiveApplication(
+            _PROTECTED_DIR,
+            file_system_guard=self.file_system_guard,
+        ))
+        response = _TestApp(app).get(
+            "/documents.zip",
+            {'file': "foo.txt"},
+            status=503,
+        )
+        eq_(response.headers['Retry-After'], "7")
+
+    def test_union(self):
+        app = self._stall(UnionXSendfileApplication(
+            [_PROTECTED_DIR, _PROTECTED_SUB_DIR],
+            file_system_guard=self.file_system_guard,
+        ))
+        response = _TestApp(app).get("/foo.txt", status=503)
+        eq_(response.headers['Retry-After'], "7")
+
+    def _stall(self, app):
+        original_lookup_file = app._lookup_file_unguarded
+
+        def stalled_lookup_file(relative_file_path):
+            self.release_event.wait(5)
+            return original_lookup_file(relative_file_path)
+
+        app._lookup_file_unguarded = stalled_lookup_file
+        return app
+
+
+class TestFileSystemGuard(object):
+    """Unit tests for the guard of the file system calls."""
+
+    def setUp(self):
+        self.release_event = threading.Event()
+
+    def tearDown(self):
+        self.release_event.set()
+
+    def stall(self):
+        self.release_event.wait(5)
+
+    def test_successful_call(self):
+        file_system_guard = FileSystemGuard()
+        eq_(file_system_guard.call(path.join, "/srv", "foo.txt"), "/srv/foo.txt")
+
+    def test_exception(self):
+        """Exceptions raised by the call are propagated."""
+        file_system_guard = FileSystemGuard()
+        assert_raises(OSError, file_system_guard.call, os.stat, "/nope/nope")
+
+    def test_fork(self):
+        """Each process gets its own queue of calls."""
+        file_system_guard = FileSystemGuard()
+        file_system_guard.call(path.join, "/srv", "foo.txt")
+        calls = file_system_guard._calls
+
+        # As seen from a forked process:
+        file_system_guard._process_id = None
+        file_system_guard.call(path.join, "/srv", "foo.txt")
+        ok_(file_system_guard._calls is not calls)
+
+    def test_unexpected_exception(self):
+        """Unexpected errors are raised in the calling thread."""
+        file_system_guard = FileSystemGuard(worker_count=1)
+
+        original_stderr = sys.stderr
+        sys.stderr = error_output = StringIO()
+        try:
+            assert_raises(KeyError, file_system_guard.call, dict().pop, "foo")
+            file_path = file_system_guard.call(path.join, "/srv", "foo.txt")
+        finally:
+            sys.stderr = original_stderr
+
+        eq_(file_path, "/srv/foo.txt")
+        eq_(error_output.getvalue(), "")
+
+    def test_failed_call_during_probe(self):
+        """Calls which raise an error don't resume the calls."""
+        file_system_guard = FileSystemGuard(
+            timeout=0.01,
+            failure_threshold=1,
+            retry_after=0,
+        )
+        assert_raises(
+            FileSystemUnavailableError,
+            file_system_guard.call,
+            self.stall,
+        )
+
+        assert_raises(KeyError, file_system_guard.call, dict().pop, "foo")
+        ok_(file_system_guard.is_open)
+
+        # Another probe can be made:
+        eq_(file_system_guard.call(path.join, "/srv"), "/srv")
+        assert_false(file_system_guard.is_open)
+
+    def test_timeout(self):
+        file_system_guard = FileSystemGuard(timeout=0.01)
+        assert_raises(
+            FileSystemUnavailableError,
+            file_system_guard.call,
+            self.stall,
+        )
+        assert_false(file_system_guard.is_open)
+
+    def test_full_queue(self):
+        """Calls fail fast when all the threads are stuck."""
+        file_system_guard = FileSystemGuard(
+            timeout=0.01,
+            worker_count=1,
+            queue_size=1,
+            failure_threshold=10,
+        )
+        for _ in range(2):
+            assert_raises(
+                FileSystemUnavailableError,
+                file_system_guard.call,
+                self.stall,
+            )
+
+        assert_raises(
+            FileSystemUnavailableError,
+            file_system_guard.call,
+            path.join,
+            "/srv",
+        )
+
+    def test_circuit_breaker(self):
+        """Calls are stopped after repeated failures until the retry time."""
+        file_system_guard = FileSystemGuard(
+            timeout=0.01,
+            failure_threshold=2,
+            retry_after=60,
+        )
+        for _ in range(2):
+            assert_raises(
+                FileSystemUnavailableError,
+                file_system_guard.call,
+                self.stall,
+            )
+        ok_(file_system_guard.is_open)
+
+        assert_raises(
+            FileSystemUnavailableError,
+            file_system_guard.call,
+            path.join,
+            "/srv",
+        )
+
+    def test_recovery(self):
+        """Calls are resumed once a probe succeeds."""
+        file_system_guard = FileSystemGuard(
+            timeout=0.01,
+            failure_threshold=1,
+            retry_after=0,
+        )
+        assert_raises(
+            FileSystemUnavailableError,
+            file_system_guard.call,
+            self.stall,
+        )
+        ok_(file_system_guard.is_open)
+
+        eq_(file_system_guard.call(path.join, "/srv"), "/srv")
+        assert_false(file_system_guard.is_open)
+
+    def test_failed_probe(self):
+        file_system_guard = FileSystemGuard(
+            timeout=0.01,
+            failure_threshold=3,
+            retry_after=0,
+        )
+        for _ in range(3):
+            assert_raises(
+                FileSystemUnavailableError,
+                file_system_guard.call,
+                self.stall,
+            )
+
+        # A single failure of the probe stops the calls again:
+        file_system_guard._retry_after = 60
+        file_system_guard._opening_time = 0
+        assert_raises(
+            FileSystemUnavailableError,
+            file_system_guard.call,
+            self.stall,
+        )
+        ok_(file_system_guard.is_open)
+        assert_raises(
+            FileSystemUnavailableError,
+            file_system_guard.call,
+            path.join,
+            "/srv",
+        )
+
+
+class TestContentTypeResolver(object):
+    """Unit tests for the resolver of the MIME types of the files."""
+
+    def setUp(self):
+        self.resolver = ContentTypeResolver()
+
+    def test_known_extension(self):
+        eq_(self.resolver.resolve("/foo.txt"), ("text/plain", None))
+
+    def test_upper_case_extension(self):
+        eq_(self.resolver.resolve("/foo.PNG"), ("image/png", None))
+
+    def test_encoding(self):
+        eq_(
+            self.resolver.resolve("/foo.tar.gz"),
+            ("application/x-tar", "gzip"),
+        )
+        eq_(self.resolver.resolve("/foo.gz"), (None, "gzip"))
+
+    def test_compound_extension_alias(self):
+        eq_(
+            self.resolver.resolve("/foo.tgz"),
+            ("application/x-tar", "gzip"),
+        )
+
+    def test_upper_case_compound_extension(self):
+        eq_(
+            self.resolver.resolve("/foo.TGZ"),
+            ("application/x-tar", "gzip"),
+        )
+        eq_(
+            self.resolver.resolve("/foo.TAR.GZ"),
+            ("application/x-tar", "gzip"),
+        )
+
+    def test_several_extensions(self):
+        eq_(self.resolver.resolve("/foo.bar.html"), ("text/html", None))
+
+    def test_unknown_extension(self):
+        eq_(self.resolver.resolve("/foo.unknown"), (None, None))
+        eq_(self.resolver.resolve("/foo"), (None, None))
+
+        ok_(".unknown" in self.resolver._memoized_content_types)
+
+    def test_mime_types(self):
+        resolver = ContentTypeResolver({".log": "text/plain", ".TXT": "a/b"})
+        eq_(resolver.resolve("/foo.log"), ("text/plain", None))
+        eq_(resolver.resolve("/foo.LOG"), ("text/plain", None))
+        eq_(resolver.resolve("/foo.txt"), ("a/b", None))
+
+    def test_system_types(self):
+        resolver = ContentTypeResolver(use_system_types=True)
+        eq_(resolver.resolve("/foo.txt"), ("text/plain", None))
+
+    def test_import(self):
+        """The files of the host are not read when the module is imported."""
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                "-c",
+                "import mimetypes, xsendfile; print(mimetypes.inited)",
+            ],
+            cwd=path.dirname(path.abspath(xsendfile.__file__)),
+        )
+        eq_(output.strip(), b"False")
+
+    def test_unsniffed_unknown_extension(self):
+        file_path = path.join(_PROTECTED_DIR, "binary-file.png")
+        eq_(self.resolver.resolve(file_path + "~"), (None, None))
+
+
+class TestContentTypeSniffing(object):
+    """Unit tests for the sniffing of the files with unknown extensions."""
+
+    def setUp(self):
+        self.temporary_directory = path.realpath(mkdtemp())
+        self.file_path = path.join(self.temporary_directory, "image")
+        self.resolver = ContentTypeResolver(sniff_unknown_types=True)
+
+    def tearDown(self):
+        rmtree(self.temporary_directory)
+
+    def test_known_signature(self):
+        self._write_file(b"\x89PNG\r\n\x1a\n\0\0\0\rIHDR")
+        eq_(self.resolver.resolve(self.file_path), ("image/png", None))
+
+    def test_unknown_signature(self):
+        self._write_file(b"foo")
+        eq_(self.resolver.resolve(self.file_path), (None, None))
+
+    def test_cached_result(self):
+        """Files are only sniffed again if they change."""
+        self._write_file(b"%PDF-1.4")
+        file_stat = os.stat(self.file_path)
+        eq_(
+            self.resolver.resolve(self.file_path, file_stat),
+            ("application/pdf", None),
+        )
+
+        self._write_file(b"GIF89a..")
+        eq_(
+            self.resolver.resolve(self.file_path, file_stat),
+            ("application/pdf", None),
+        )
+
+        os.utime(self.file_path, (0, 0))
+        eq_(self.resolver.resolve(self.file_path), ("image/gif", None))
+
+    def test_known_extension(self):
+        """Files are not sniffed if their extension is known."""
+        file_path = self.file_path + ".txt"
+        eq_(self.resolver.resolve(file_path), ("text/plain", None))
+
+    def test_missing_file(self):
+        eq_(self.resolver.resolve(self.file_path), (None, None))
+
+    def test_application(self):
+        self._write_file(b"GIF87a")
+        app = _TestApp(XSendfileApplication(
+            self.temporary_directory,
+            content_type_resolver=ContentTypeResolver(
+                {".txt": "text/x-custom"},
+                sniff_unknown_types=True,
+            ),
+        ))
+
+        eq_(app.get("/image", status=200).content_type, "image/gif")
+
+    def _write_file(self, file_contents):
+        with open(self.file_path, "wb") as file_:
+            file_.write(file_contents)
+
+
+class TestXSendfileRequestsWithContentTypeResolver(object):
+    """Unit tests for the requests to an application with MIME types."""
+
+    def test_mime_types(self):
+        app = _TestApp(XSendfileApplication(
+            _PROTECTED_DIR,
+            content_type_resolver=ContentTypeResolver(
+                {".txt": "text/x-custom"},
+            ),
+        ))
+
+        eq_(app.get("/foo.txt", status=200).content_type, "text/x-custom")
+
+    def test_mime_types_in_direct_sendfile(self):
+        app = _TestApp(XSendfileApplication(
+            _PROTECTED_DIR,
+            DirectSendfile(),
+            content_type_resolver=ContentTypeResolver(
+                {".txt": "text/x-custom"},
+            ),
+        ))
+
+        eq_(app.get("/foo.txt", status=200).content_type, "text/x-custom")
+
+
+class TestFileSystemWatcher(object):
+    """Unit tests for the watcher that invalidates the metadata cache."""
+
+    def setUp(self):
+        self.temporary_directory = path.realpath(mkdtemp())
+        self.root_directory = path.join(self.temporary_directory, "root")
+        os.mkdir(self.root_directory)
+        os.mkdir(path.join(self.root_directory, "sub-directory"))
+        self._write_file("foo.txt", "foo")
+        self._write_file("sub-directory/bar.txt", "bar")
+
+        self.metadata_cache = SharedMetadataCache(timeout=3600)
+        self.application = XSendfileApplication(
+            self.root_directory,
+            metadata_cache=self.metadata_cache,
+        )
+        self.app = _TestApp(self.application)
+        self.watcher = FileSystemWatcher(self.application)
+        self.watcher.process_events()
+
+    def tearDown(self):
+        rmtree(self.temporary_directory)
+
+    def test_modified_file(self):
+        self.app.get("/foo.txt", status=200)
+        self._write_file("foo.txt", "foo bar")
+        ok_(self._is_cached("/foo.txt"))
+
+        ok_(0 < self.watcher.process_events())
+
+        assert_false(self._is_cached("/foo.txt"))
+
+    def test_created_file(self):
+        """Entries for files that didn't exist are invalidated too."""
+        self.app.get("/new.txt", status=404)
+        self._write_file("new.txt", "new")
+
+        self.watcher.process_events()
+
+        self.app.get("/new.txt", status=200)
+
+    def test_deleted_file(self):
+        self.app.get("/sub-directory/bar.txt", status=200)
+        os.remove(path.join(self.root_directory, "sub-directory", "bar.txt"))
+
+        self.watcher.process_events()
+
+        self.app.get("/sub-directory/bar.txt", status=404)
+
+    def test_moved_file(self):
+        self.app.get("/foo.txt", status=200)
+        self.app.get("/moved.txt", status=404)
+        os.rename(
+            path.join(self.root_directory, "foo.txt"),
+            path.join(self.root_directory, "moved.txt"),
+        )
+
+        self.watcher.process_events()
+
+        self.app.get("/foo.txt", status=404)
+        self.app.get("/moved.txt", status=200)
+
+    def test_aliased_paths(self):
+        """Requests for aliases of a path see the invalidations too."""
+        aliases = (
+            "/./sub-directory/bar.txt",
+            "//sub-directory//bar.txt",
+            "/foo.txt/../sub-directory/bar.txt",
+        )
+        for alias in aliases:
+            self.app.get(alias, status=200)
+        ok_(self._is_cached("/sub-directory/bar.txt"))
+
+        os.remove(path.join(self.root_directory, "sub-directory", "bar.txt"))
+        self.watcher.process_events()
+
+        for alias in aliases:
+            self.app.get(alias, status=404)
+
+    def test_symbolic_link_to_directory(self):
+        """Files reached through links to directories are not cached."""
+        os.symlink("sub-directory", path.join(self.root_directory, "link"))
+        self.app.get("/link/bar.txt", status=200)
+        assert_false(self._is_cached("/link/bar.txt"))
+
+        os.remove(path.join(self.root_directory, "sub-directory", "bar.txt"))
+        self.watcher.process_events()
+
+        self.app.get("/link/bar.txt", status=404)
+
+    def test_unrelated_entries(self):
+        """Only the entries for the files that changed are invalidated."""
+        self.app.get("/foo.txt", status=200)
+        self._write_file("sub-directory/bar.txt", "baz")
+
+        self.watcher.process_events()
+
+        ok_(self._is_cached("/foo.txt"))
+
+    def test_created_directory(self):
+        """New directories are watched."""
+        os.mkdir(path.join(self.root_directory, "new-directory"))
+        self.watcher.process_events()
+        self.app.get("/new-directory/new.txt", status=404)
+
+        self._write_file("new-directory/new.txt", "new")
+        self.watcher.process_events()
+
+        self.app.get("/new-directory/new.txt", status=200)
+
+    def test_files_created_with_directory(self):
+        """
+        Files created in a new directory before it's watched are not served
+        from stale entries.
+
+        """
+        self.app.get("/a/b/c.txt", status=404)
+        os.makedirs(path.join(self.root_directory, "a", "b"))
+        self._write_file("a/b/c.txt", "c")
+
+        self.watcher.process_events()
+
+        self.app.get("/a/b/c.txt", status=200)
+
+    def test_moved_directory(self):
+        """The whole cache is cleared when a directory is moved."""
+        self.app.get("/foo.txt", status=200)
+        self.app.get("/sub-directory/bar.txt", status=200)
+        os.rename(
+            path.join(self.root_directory, "sub-directory"),
+            path.join(self.root_directory, "other-directory"),
+        )
+
+        self.watcher.process_events()
+
+        assert_false(self._is_cached("/foo.txt"))
+        self.app.get("/sub-directory/bar.txt", status=404)
+        self.app.get("/other-directory/bar.txt", status=200)
+
+        # The moved directory is still watched under its new name:
+        self._write_file("other-directory/bar.txt", "bar baz")
+        self.watcher.process_events()
+        assert_false(self._is_cached("/other-directory/bar.txt"))
+
+    def test_no_events(self):
+        eq_(self.watcher.process_events(), 0)
+
+    def test_file_descriptor(self):
+        ok_(self.watcher.fileno() is not None)
+        assert_false(self.watcher.is_degraded)
+
+    def test_background_thread(self):
+        self.watcher.start()
+        self.app.get("/foo.txt", status=200)
+        self._write_file("foo.txt", "foo bar")
+
+        for _ in range(100):
+            if not self._is_cached("/foo.txt"):
+                break
+            sleep(0.01)
+        assert_false(self._is_cached("/foo.txt"))
+
+    def test_failing_background_thread(self):
+        """The background thread survives errors."""
+        original_process_events = self.watcher.process_events
+        failures = []
+
+        def process_events():
+            if not failures:
+                failures.append(True)
+                raise ValueError()
+            return original_process_events()
+
+        self.watcher.process_events = process_events
+        self.watcher.start()
+
+        self._write_file("foo.txt", "foo bar")
+        for _ in range(100):
+            if failures:
+                break
+            sleep(0.01)
+        self.app.get("/foo.txt", status=200)
+        self._write_file("foo.txt", "foo bar baz")
+
+        for _ in range(100):
+            if not self._is_cached("/foo.txt"):
+                break
+            sleep(0.01)
+        assert_false(self._is_cached("/foo.txt"))
+
+    def test_overflow(self):
+        """The whole cache is cleared when events are lost."""
+        self.app.get("/foo.txt", status=200)
+
+        self.watcher._handle_event(-1, 0x4000, b"")
+
+        assert_false(self._is_cached("/foo.txt"))
+
+    def test_degraded(self):
+        """The entries expire early when the roots can't be watched."""
+        self.app.get("/foo.txt", status=200)
+
+        self.watcher._degrade()
+
+        ok_(self.watcher.is_degraded)
+        eq_(self.metadata_cache.timeout, 5)
+        assert_false(self._is_cached("/foo.txt"))
+
+    def test_union_application(self):
+        second_root_directory = path.join(self.temporary_directory, "second")
+        os.mkdir(second_root_directory)
+        application = UnionXSendfileApplication(
+            [self.root_directory, second_root_directory],
+            metadata_cache=self.metadata_cache,
+        )
+        watcher = FileSystemWatcher(application)
+        watcher.process_events()
+        app = _TestApp(application)
+        app.get("/second.txt", status=404)
+
+        with open(path.join(second_root_directory, "second.txt"), "w") as \
+                file_:
+            file_.write("second")
+        watcher.process_events()
+
+        app.get("/second.txt", status=200)
+
+    def test_union_application_refresh(self):
+        """Only the listings of the directories that changed are refreshed."""
+        application = UnionXSendfileApplication([self.root_directory])
+        watcher = FileSystemWatcher(application)
+        watcher.process_events()
+        sub_directory_listing = \
+            application._directory_listings[0]["sub-directory"]
+
+        self._write_file("new.txt", "new")
+        watcher.process_events()
+
+        ok_(application._directory_listings[0]["sub-directory"] is
+            sub_directory_listing)
+        eq_(application._location_index["new.txt"], 0)
+
+    def _is_cached(self, relative_file_path):
+        cache_key = self.application._get_cache_key(relative_file_path)
+        return self.metadata_cache.get(cache_key) is not None
+
+    def _write_file(self, relative_file_path, file_contents):
+        file_path = path.join(self.root_directory, relative_file_path)
+        with open(file_path, "w") as file_:
+            file_.write(file_contents)
+
+
+class TestSharedMetadataCache(object):
+    """Unit tests for the shared metadata cache."""
+
+    def setUp(self):
+        self.temporary_directory = mkdtemp()
+        self.cache_file_path = path.join(self.temporary_directory, "cache")
+        self.cache = SharedMetadataCache(self.cache_file_path, slot_count=8)
+
+    def tearDown(self):
+        rmtree(self.temporary_directory)
+
+    def test_missing_entry(self):
+        eq_(self.cache.get(u"/foo.txt"), None)
+
+    def test_existing_entry(self):
+        file_path = path.join(_PROTECTED_DIR, _NON_LATIN1_FILE_NAME)
+        file_stat = os.stat(file_path)
+        self.cache.set(_NON_LATIN1_FILE_NAME, (file_path, file_stat))
+
+        cached_file_path, cached_file_stat = \
+            self.cache.get(_NON_LATIN1_FILE_NAME)
+        eq_(cached_file_path, file_path)
+        eq_(cached_file_stat.st_mode, file_stat.st_mode)
+        eq_(cached_file_stat.st_ino, file_stat.st_ino)
+        eq_(cached_file_stat.st_size, file_stat.st_size)
+        eq_(cached_file_stat.st_mtime, file_stat.st_mtime)
+        eq_(
+            getattr(cached_file_stat, "st_mtime_ns", None),
+            getattr(file_stat, "st_mtime_ns", None),
+        )
+        # The integer modification time:
+        eq_(cached_file_stat[8], file_stat[8])
+
+    def test_negative_entry(self):
+        self.cache.set(u"/../root.txt", (None, None))
+        eq_(self.cache.get(u"/../root.txt"), (None, None))
+
+    def test_expired_entry(self):
+        cache = SharedMetadataCache(timeout=-1)
+        cache.set(u"/foo.txt", (u"/foo.txt", None))
+        eq_(cache.get(u"/foo.txt"), None)
+
+    def test_oversized_entry(self):
+        """Entries which don't fit in a slot are not cached."""
+        cache = SharedMetadataCache(slot_size=64)
+        file_path = u"/" + u"a" * 64
+        cache.set(file_path, (file_path, None))
+        eq_(cache.get(file_path), None)
+
+    def test_sharing(self):
+        """Caches backed by the same file share their entries."""
+        other_cache = SharedMetadataCache(self.cache_file_path, slot_count=8)
+        self.cache.set(u"/foo.txt", (u"/srv/foo.txt", None))
+        eq_(other_cache.get(u"/foo.txt"), (u"/srv/foo.txt", None))
+
+    def test_existing_layout(self):
+        """The layout of the file is used unless it's set."""
+        other_cache = SharedMetadataCache(self.cache_file_path)
+        self.cache.set(u"/foo.txt", (u"/srv/foo.txt", None))
+        eq_(other_cache.get(u"/foo.txt"), (u"/srv/foo.txt", None))
+
+    def test_different_layout(self):
+        """Files created with a different layout are left untouched."""
+        self.cache.set(u"/foo.txt", (u"/srv/foo.txt", None))
+        file_size = path.getsize(self.cache_file_path)
+
+        assert_raises(
+            BadCacheFileError,
+            SharedMetadataCache,
+            self.cache_file_path,
+            slot_count=16,
+        )
+        eq_(path.getsize(self.cache_file_path), file_size)
+        eq_(self.cache.get(u"/foo.txt"), (u"/srv/foo.txt", None))
+
+    def test_foreign_file(self):
+        """Files which are not a metadata cache are left untouched."""
+        foreign_file_path = path.join(self.temporary_directory, "foreign")
+        with open(foreign_file_path, "wb") as foreign_file:
+            foreign_file.write(b"foreign contents")
+
+        assert_raises(
+            BadCacheFileError,
+            SharedMetadataCache,
+            foreign_file_path,
+        )
+        with open(foreign_file_path, "rb") as foreign_file:
+            eq_(foreign_file.read(), b"foreign contents")
+
+    def test_invalidation(self):
+        self.cache.set(u"/foo.txt", (u"/srv/foo.txt", None))
+        self.cache.invalidate(u"/foo.txt")
+        eq_(self.cache.get(u"/foo.txt"), None)
+
+    def test_clearing(self):
+        self.cache.set(u"/foo.txt", (u"/srv/foo.txt", None))
+        self.cache.set(u"/bar.txt", (u"/srv/bar.txt", None))
+        self.cache.clear()
+        eq_(self.cache.get(u"/foo.txt"), None)
+        eq_(self.cache.get(u"/bar.txt"), None)
+
+
+# { Tests for the file serving applications:
+
+
+class BaseTestFileSender(object):
+    """Base **acceptance** test case for the file senders."""
+
+    sender = None
+
+    file_path_header = None
+
+    def __init__(self):
+        self.app = _TestApp(self.sender)
+
+    def get_file(self, file_name, SCRIPT_NAME="", **extra_environ):
+        """Request the ``file_name`` and return the response."""
+        absolute_path_to_file = path.join(_PROTECTED_DIR, file_name)
+        extra_environ['xsendfile.requested_file'] = absolute_path_to_file
+        extra_environ['xsendfile.root_directory'] = _PROTECTED_DIR
+
+        extra_environ['SCRIPT_NAME'] = SCRIPT_NAME
+        path_info = "/%s" % quote(file_name.encode('utf8'))
+
+        return self.app.get(path_info, status=200, extra_environ=extra_environ)
+
+    def verify_headers(self, response, file_attributes):
+        """Validate the HTTP headers received for the file."""
+        eq_(response.content_type, file_attributes['type'])
+        eq_(response.content_length, file_attributes['size'])
+        if "encoding" in file_attributes:
+            eq_(response.content_encoding, file_attributes['encoding'])
+        else:
+            ok_("Content-Encoding" not in response.headers)
+
+    def verify_file(self, response, file_name):
+        raise NotImplementedError()
+
+    def test_downloads(self):
+        """Run acceptance tests for all the known files in the fixtures."""
+        for (file_name, file_attributes) in _METADATA_BY_STUB_FILE_NAME.items():
+            # Using a Nose test generator:
+            def check():
+                response = self.get_file(file_name)
+                self.verify_headers(response, file_attributes)
+                self.verify_file(response, file_name)
+
+            check.description = "Test %r with %r" % (file_name, self.sender)
+
+            yield check
+
+
+class TestXSendfileDirectServe(BaseTestFileSender):
+    """Acceptance tests for the application that serves the files directly."""
+
+    sender = staticmethod(XSendfileApplication.serve_file)
+
+    def verify_file(self, response, file_name):
+        file_path = path.join(_PROTECTED_DIR, file_name)
+        with closing(open(file_path, 'rb')) as file_:
+            actual_file_contents = file_.read()
+
+        eq_(response.body, actual_file_contents)
+
+
+class TestDirectSendfileResponse(TestXSendfileDirectServe):
+    """
+    Acceptance tests for the application that serves the files directly
+    through cached file descriptors.
+
+    """
+
+    sender = DirectSendfile()
+
+    def test_head_through_application(self):
+        """HEAD requests reach the sender through the application."""
+        app = _TestApp(XSendfileApplication(_PROTECTED_DIR, DirectSendfile()))
+        response = app.head("/foo.txt", status=200)
+
+        eq_(response.content_length, 11)
+        eq_(response.headers['Accept-Ranges'], "bytes")
+        eq_(response.body, b"")
+
+    def test_uncached_descriptors(self):
+        """Files are served when the descriptor cache is disabled."""
+        app = _TestApp(DirectSendfile(descriptor_cache_size=0))
+        absolute_path_to_file = path.join(_PROTECTED_DIR, "foo.txt")
+        extra_environ = {'xsendfile.requested_file': absolute_path_to_file}
+        response = app.get("/foo.txt", extra_environ=extra_environ)
+        self.verify_file(response, "foo.txt")
+
+    def test_small_chunks(self):
+        """Files are served in chunks of the given size."""
+        app = _TestApp(DirectSendfile(chunk_size=100))
+        absolute_path_to_file = path.join(_PROTECTED_DIR, "binary-file.png")
+        extra_environ = {'xsendfile.requested_file': absolute_path_to_file}
+        response = app.get("/binary-file.png", extra_environ=extra_environ)
+        self.verify_file(response, "binary-file.png")
+
+
+class TestDirectSendfileRequests(object):
+    """
+    Acceptance tests for the range, conditional and ``HEAD`` requests served
+    by :class:`DirectSendfile`.
+
+    """
+
+    sender_options = {}
+
+    def setUp(self):
+        self.app = _TestApp(DirectSendfile(**self.sender_options))
+        self.file_path = path.join(_PROTECTED_DIR, "foo.txt")
+        self.last_modified = formatdate(
+            int(os.stat(self.file_path).st_mtime),
+            usegmt=True,
+        )
+
+    def test_last_modified(self):
+        response = self._get()
+        eq_(response.headers['Last-Modified'], self.last_modified)
+        eq_(response.headers['Accept-Ranges'], "bytes")
+
+    def test_head(self):
+        response = self._get(method="HEAD")
+        eq_(response.content_length, 11)
+        eq_(response.body, b"")
+
+    def test_range(self):
+        response = self._get({'Range': "bytes=2-4"}, 206)
+        eq_(response.body, b"rem")
+        eq_(response.content_length, 3)
+        eq_(response.headers['Content-Range'], "bytes 2-4/11")
+
+    def test_open_ended_range(self):
+        response = self._get({'Range': "bytes=6-"}, 206)
+        eq_(response.body, b"ipsum")
+        eq_(response.headers['Content-Range'], "bytes 6-10/11")
+
+    def test_suffix_range(self):
+        response = self._get({'Range': "bytes=-3"}, 206)
+        eq_(response.body, b"sum")
+        eq_(response.headers['Content-Range'], "bytes 8-10/11")
+
+    def test_range_beyond_end(self):
+        """Ranges that end after the file are truncated."""
+        response = self._get({'Range': "bytes=6-100"}, 206)
+        eq_(response.body, b"ipsum")
+
+    def test_unsatisfiable_range(self):
+        response = self._get({'Range': "bytes=11-"}, 416)
+        eq_(response.headers['Content-Range'], "bytes */11")
+        eq_(response.body, b"")
+
+    def test_ignored_ranges(self):
+        """Invalid or multiple ranges get the whole file."""
+        for range_header in ("bytes=1-2,4-5", "bytes=4-2", "lines=1-2", "x"):
+            response = self._get({'Range': range_header})
+            eq_(response.body, b"Lorem ipsum")
+
+    def test_if_range(self):
+        response = self._get(
+            {'Range': "bytes=0-4", 'If-Range': self.last_modified},
+            206,
+        )
+        eq_(response.body, b"Lorem")
+
+        response = self._get({
+            'Range': "bytes=0-4",
+            'If-Range': "Tue, 18 May 2010 13:44:18 GMT",
+        })
+        eq_(response.body, b"Lorem ipsum")
+
+    def test_if_modified_since(self):
+        response = self._get({'If-Modified-Since': self.last_modified}, 304)
+        eq_(response.body, b"")
+        eq_(response.headers['Last-Modified'], self.last_modified)
+
+        response = self._get(
+            {'If-Modified-Since': "Tue, 18 May 2010 13:44:18 GMT"},
+        )
+        eq_(response.body, b"Lorem ipsum")
+
+    def test_if_none_match(self):
+        content_digest = _ContentDigest("sha256", "abcd")
+        extra_environ = {'xsendfile.content_digest': content_digest}
+
+        response = self._get(
+            {'If-None-Match': '"def", W/"abcd"'},
+            304,
+            extra_environ,
+        )
+        eq_(response.headers['ETag'], '"abcd"')
+
+        response = self._get(
+            {
+                'If-None-Match': '"def"',
+                'If-Modified-Since': self.last_modified,
+            },
+            200,
+            extra_environ,
+        )
+        eq_(response.body, b"Lorem ipsum")
+
+    def test_removed_file(self):
+        """Files removed after they were looked up are not found."""
+        temporary_directory = mkdtemp()
+        try:
+            file_path = path.join(temporary_directory, "foo.txt")
+            with open(file_path, "wb") as file_:
+                file_.write(b"Lorem ipsum")
+            file_stat = os.stat(file_path)
+            os.remove(file_path)
+
+            extra_environ = {
+                'xsendfile.requested_file': file_path,
+                'xsendfile.requested_file_stat': file_stat,
+            }
+            self.app.get("/foo.txt", status=404, extra_environ=extra_environ)
+        finally:
+            rmtree(temporary_directory)
+
+    def test_short_reads(self):
+        """Files are sent in full when the reads return fewer bytes."""
+        original_pread = xsendfile._pread
+        xsendfile._pread = lambda descriptor, size, offset: \
+            original_pread(descriptor, min(size, 3), offset)
+        try:
+            response = self._get()
+        finally:
+            xsendfile._pread = original_pread
+
+        eq_(response.body, b"Lorem ipsum")
+
+    def test_truncated_file(self):
+        """Responses are aborted when the file shrinks while it's sent."""
+        temporary_directory = mkdtemp()
+        try:
+            file_path = path.join(temporary_directory, "foo.txt")
+            with open(file_path, "wb") as file_:
+                file_.write(b"Lorem ipsum")
+
+            environ = {
+                'REQUEST_METHOD': "GET",
+                'xsendfile.requested_file': file_path,
+            }
+            sender = DirectSendfile(chunk_size=4)
+            response_body = sender(environ, lambda status, headers: None)
+            chunks = iter(response_body)
+            eq_(next(chunks), b"Lore")
+
+            with open(file_path, "r+b") as file_:
+                file_.truncate(6)
+
+            eq_(next(chunks), b"m ")
+            assert_raises(IOError, next, chunks)
+            response_body.close()
+        finally:
+            rmtree(temporary_directory)
+
+    def _get(self, headers=None, status=200, extra_environ=None,
+             method="GET"):
+        extra_environ = dict(extra_environ or {})
+        extra_environ['xsendfile.requested_file'] = self.file_path
+        request_method = self.app.head if method == "HEAD" else self.app.get
+        return request_method(
+            "/foo.txt",
+            headers=headers or {},
+            status=status,
+            extra_environ=extra_environ,
+        )
+
+
+class TestCachingDirectSendfileRequests(TestDirectSendfileRequests):
+    """
+    Acceptance tests for the range, conditional and ``HEAD`` requests served
+    from memory by :class:`DirectSendfile`.
+
+    """
+
+    sender_options = {'content_cache_size': 4096}
+
+
+class TestCachingDirectSendfileResponse(TestXSendfileDirectServe):
+    """
+    Acceptance tests for the application that serves the files directly
+    from memory.
+
+    """
+
+    sender = DirectSendfile(content_cache_size=4096, max_cached_file_size=100)
+
+
+class TestReadaheadDirectSendfileResponse(TestXSendfileDirectServe):
+    """
+    Acceptance tests for the application that serves the files directly
+    with readahead hints.
+
+    """
+
+    sender = DirectSendfile(readahead_size=4096)
+
+
+class TestBandwidthShapedDirectSendfileResponse(TestXSendfileDirectServe):
+    """
+    Acceptance tests for the application that serves the files directly
+    with a bandwidth scheduler.
+
+    """
+
+    bandwidth_scheduler = BandwidthScheduler(rate=10 * 1024 * 1024)
+
+    sender = DirectSendfile(
+        chunk_size=100,
+        bandwidth_scheduler=bandwidth_scheduler,
+    )
+
+    def test_closed_streams(self):
+        """Responses no longer share the bandwidth once they're sent."""
+        self.get_file("binary-file.png")
+        eq_(self.bandwidth_scheduler._streams, set())
+
+
+class TestBandwidthScheduler(object):
+    """Unit tests for the scheduler that shapes the bandwidth."""
+
+    def test_unlimited(self):
+        scheduler = BandwidthScheduler(burst_size=10)
+        stream = scheduler.open_stream()
+        eq_(scheduler._reserve(stream, 1000, stream.refill_time), 0)
+
+    def test_burst(self):
+        """Responses can send a burst without waiting."""
+        scheduler = BandwidthScheduler(response_rate=100, burst_size=200)
+        stream = scheduler.open_stream()
+        start_time = stream.refill_time
+
+        eq_(scheduler._reserve(stream, 150, start_time), 0)
+        eq_(scheduler._reserve(stream, 100, start_time), 0.5)
+
+    def test_refill(self):
+        scheduler = BandwidthScheduler(response_rate=100, burst_size=200)
+        stream = scheduler.open_stream()
+        start_time = stream.refill_time
+        scheduler._reserve(stream, 200, start_time)
+
+        eq_(scheduler._reserve(stream, 100, start_time + 1), 0)
+        eq_(scheduler._reserve(stream, 100, start_time + 1), 1)
+
+    def test_refill_capped_to_burst(self):
+        """Idle responses can't save up more than the burst."""
+        scheduler = BandwidthScheduler(response_rate=100, burst_size=200)
+        stream = scheduler.open_stream()
+        start_time = stream.refill_time
+
+        eq_(scheduler._reserve(stream, 300, start_time + 60), 1)
+
+    def test_shared_rate(self):
+        """The total rate is shared equally by the active responses."""
+        scheduler = BandwidthScheduler(rate=100, burst_size=0)
+        first_stream = scheduler.open_stream()
+        second_stream = scheduler.open_stream()
+        start_time = first_stream.refill_time
+        second_stream.refill_time = start_time
+
+        eq_(scheduler._reserve(first_stream, 100, start_time), 2)
+        eq_(scheduler._reserve(second_stream, 100, start_time), 2)
+
+        second_stream.close()
+        eq_(scheduler._reserve(first_stream, 100, start_time + 2), 1)
+
+    def test_idle_streams(self):
+        """Responses which aren't being read don't hold a share."""
+        scheduler = BandwidthScheduler(rate=100, burst_size=0)
+        first_stream = scheduler.open_stream()
+        scheduler.open_stream()
+        start_time = first_stream.refill_time + 5
+        first_stream.refill_time = start_time
+        scheduler._refill_time = start_time
+
+        eq_(scheduler._reserve(first_stream, 100, start_time), 1)
+
+    def test_shared_burst(self):
+        """New responses take their burst from the shared budget."""
+        scheduler = BandwidthScheduler(rate=100, burst_size=200)
+        first_stream = scheduler.open_stream()
+        second_stream = scheduler.open_stream()
+        start_time = scheduler._refill_time
+        first_stream.refill_time = second_stream.refill_time = start_time
+
+        eq_(scheduler._reserve(first_stream, 200, start_time), 0)
+        eq_(scheduler._reserve(second_stream, 100, start_time), 1)
+
+    def test_response_rate_below_shared_rate(self):
+        scheduler = BandwidthScheduler(
+            rate=1000,
+            response_rate=100,
+            burst_size=0,
+        )
+        stream = scheduler.open_stream()
+        eq_(scheduler._reserve(stream, 100, stream.refill_time), 1)
+
+    def test_closing_twice(self):
+        scheduler = BandwidthScheduler()
+        stream = scheduler.open_stream()
+        stream.close()
+        stream.close()
+        eq_(scheduler._streams, set())
+
+    def test_waiting(self):
+        scheduler = BandwidthScheduler(response_rate=100, burst_size=0)
+        stream = scheduler.open_stream()
+
+        start_time = get_current_time()
+        stream.reserve(5)
+
+        ok_(0.04 <= get_current_time() - start_time)
+
+
+class TestSizeAwareSendfile(object):
+    """Unit tests for the sender that picks another sender by file size."""
+
+    def setUp(self):
+        self.inline_sender = _EnvironRecordingApp()
+        self.offloading_sender = _EnvironRecordingApp()
+        sender = SizeAwareSendfile(
+            self.offloading_sender,
+            self.inline_sender,
+            max_inline_file_size=11,
+        )
+        self.app = _TestApp(XSendfileApplication(_PROTECTED_DIR, sender))
+
+    def test_small_file(self):
+        self.app.get("/foo.txt", status=200)
+
+        eq_(self.inline_sender.environ['xsendfile.sender_decision'], "inline")
+        eq_(self.offloading_sender.environ, None)
+
+    def test_large_file(self):
+        self.app.get("/binary-file.png", status=200)
+
+        eq_(
+            self.offloading_sender.environ['xsendfile.sender_decision'],
+            "offload",
+        )
+        eq_(self.inline_sender.environ, None)
+
+    def test_default_senders(self):
+        app = _TestApp(SizeAwareSendfile(max_inline_file_size=11))
+
+        for file_name in ("foo.txt", "binary-file.png"):
+            absolute_path_to_file = path.join(_PROTECTED_DIR, file_name)
+            extra_environ = {'xsendfile.requested_file': absolute_path_to_file}
+            response = app.get("/" + file_name, extra_environ=extra_environ)
+
+            if file_name == "foo.txt":
+                eq_(response.body, b"Lorem ipsum")
+                ok_("X-Sendfile" not in response.headers)
+            else:
+                eq_(response.headers['X-Sendfile'], absolute_path_to_file)
+
+
+class TestFileContentCache(object):
+    """Unit tests for the cache of file contents used to serve files."""
+
+    def setUp(self):
+        self.cache = _FileContentCache(10, 5)
+        self.file_stat = os.stat_result((0, 1, 1, 1, 0, 0, 4, 0, 0, 0))
+
+    def test_cacheable_file(self):
+        ok_(self.cache.is_cacheable(self.file_stat))
+        large_file_stat = os.stat_result((0, 1, 1, 1, 0, 0, 6, 0, 0, 0))
+        assert_false(self.cache.is_cacheable(large_file_stat))
+
+    def test_cached_contents(self):
+        self.cache.set("/foo.txt", self.file_stat, b"abcd")
+        eq_(self.cache.get("/foo.txt", self.file_stat), b"abcd")
+
+    def test_changed_file(self):
+        """Contents are discarded when the file changes."""
+        self.cache.set("/foo.txt", self.file_stat, b"abcd")
+        new_file_stat = os.stat_result((0, 1, 1, 1, 0, 0, 4, 0, 1, 0))
+        eq_(self.cache.get("/foo.txt", new_file_stat), None)
+
+    def test_truncated_file(self):
+        """Contents which don't match the size of the file are not cached."""
+        self.cache.set("/foo.txt", self.file_stat, b"abc")
+        eq_(self.cache.get("/foo.txt", self.file_stat), None)
+
+    def test_size_budget(self):
+        """The least recently used contents are evicted to fit new ones."""
+        self.cache.set("/foo.txt", self.file_stat, b"abcd")
+        self.cache.set("/bar.txt", self.file_stat, b"efgh")
+        self.cache.get("/foo.txt", self.file_stat)
+        self.cache.set("/baz.txt", self.file_stat, b"ijkl")
+
+        eq_(self.cache.get("/foo.txt", self.file_stat), b"abcd")
+        eq_(self.cache.get("/bar.txt", self.file_stat), None)
+        eq_(self.cache.get("/baz.txt", self.file_stat), b"ijkl")
+
+    def test_invalidation(self):
+        self.cache.set("/foo.txt", self.file_stat, b"abcd")
+        self.cache.invalidate("/foo.txt")
+        eq_(self.cache.get("/foo.txt", self.file_stat), None)
+
+
+class TestFileDescriptorCache(object):
+    """Unit tests for the cache of file descriptors used to serve files."""
+
+    def setUp(self):
+        self.temporary_directory = mkdtemp()
+        self.file_path = path.join(self.temporary_directory, "foo.txt")
+        with open(self.file_path, "w") as file_:
+            file_.write("foo")
+
+        self.cache = _FileDescriptorCache(2)
+
+    def tearDown(self):
+        rmtree(self.temporary_directory)
+
+    def test_descriptor_reuse(self):
+        file_descriptor = self.cache.acquire(self.file_path)
+        self.cache.release(file_descriptor)
+
+        eq_(
+            self.cache.acquire(self.file_path, os.stat(self.file_path)),
+            file_descriptor,
+        )
+
+    def test_changed_file(self):
+        """Descriptors are replaced when the file is replaced."""
+        file_descriptor = self.cache.acquire(self.file_path)
+        self.cache.release(file_descriptor)
+
+        new_file_path = self.file_path + ".new"
+        with open(new_file_path, "w") as file_:
+            file_.write("bar")
+        os.rename(new_file_path, self.file_path)
+
+        new_file_descriptor = \
+            self.cache.acquire(self.file_path, os.stat(self.file_path))
+        ok_(new_file_descriptor is not file_descriptor)
+        eq_(os.read(new_file_descriptor.descriptor, 3), b"bar")
+
+    def test_eviction_of_descriptor_in_use(self):
+        """Descriptors are closed once they're evicted and released."""
+        file_descriptor = self.cache.acquire(self.file_path)
+
+        for file_name in ("bar.txt", "baz.txt"):
+            other_file_path = path.join(self.temporary_directory, file_name)
+            open(other_file_path, "w").close()
+            self.cache.release(self.cache.acquire(other_file_path))
+
+        ok_(file_descriptor.is_evicted)
+        eq_(os.read(file_descriptor.descriptor, 3), b"foo")
+
+        self.cache.release(file_descriptor)
+        assert_raises(OSError, os.fstat, file_descriptor.descriptor)
+
+    def test_invalidation(self):
+        file_descriptor = self.cache.acquire(self.file_path)
+        self.cache.release(file_descriptor)
+
+        self.cache.invalidate(self.file_path)
+
+        assert_raises(OSError, os.fstat, file_descriptor.descriptor)
+        ok_(self.cache.acquire(self.file_path) is not file_descriptor)
+
+
+class TestXSendfileResponse(BaseTestFileSender):
+    """
+    Acceptance tests for the application that sets the ``X-Sendfile`` header.
+    
+    """
+
+    file_path_header = "X-Sendfile"
+
+    sender = XSendfile()
+
+    def verify_file(self, response, file_name):
+        file_path_decoded = path.join(_PROTECTED_DIR, file_name)
+        file_path = file_path_decoded.encode('utf8')
+        expected_file_path = quote(file_path)
+
+        ok_(self.file_path_header in response.headers)
+        eq_(response.headers[self.file_path_header], expected_file_path)
+
+
+class TestNginxXSendfileResponse(BaseTestFileSender):
+    """
+    Acceptance tests for the application that sets the equivalent ``X-Sendfile``
+    header for Nginx.
+    
+    """
+
+    file_path_header = "X-Accel-Redirect"
+
+    sender = NginxSendfile()
+
+    def verify_file(self, response, file_name):
+        expected_file_path_decoded = "/-internal-/%s" % file_name
+        expected_file_path = quote(expected_file_path_decoded.encode('utf8'))
+
+        ok_(self.file_path_header in response.headers)
+        eq_(response.headers[self.file_path_header], expected_file_path)
+
+    def test_script_name(self):
+        """
+        The SCRIPT_NAME must be taken into account while generating the path.
+        
+        """
+        response = self.get_file("foo.txt", SCRIPT_NAME="/bar")
+        eq_(response.headers[self.file_path_header], "/bar/-internal-/foo.txt")
+
+
+class TestReadaheadXSendfileResponse(TestXSendfileResponse):
+    """
+    Acceptance tests for the application that sets the ``X-Sendfile`` header
+    once the file has been prefetched.
+
+    """
+
+    sender = XSendfile(readahead_size=4096)
+
+
+class TestPrewarming(object):
+    """Unit tests for the prewarming of the files served."""
+
+    def setUp(self):
+        self.metadata_cache = SharedMetadataCache()
+        self.sender = DirectSendfile(content_cache_size=4096)
+        self.app = XSendfileApplication(
+            _PROTECTED_DIR,
+            self.sender,
+            metadata_cache=self.metadata_cache,
+        )
+
+    def test_existing_files(self):
+        file_count = prewarm(self.app, ["foo.txt", "/" + _SUB_DIRECTORY_FILE])
+        eq_(file_count, 2)
+
+        for file_name in ("foo.txt", _SUB_DIRECTORY_FILE):
+            cache_key = _PROTECTED_DIR + "\0/" + file_name
+            absolute_file_path, file_stat = self.metadata_cache.get(cache_key)
+            eq_(absolute_file_path, path.join(_PROTECTED_DIR, file_name))
+
+        file_path = path.join(_PROTECTED_DIR, "foo.txt")
+        file_stat = os.stat(file_path)
+        eq_(
+            self.sender._content_cache.get(file_path, file_stat),
+            b"Lorem ipsum",
+        )
+
+    def test_unservable_files(self):
+        """Files that would not be served are skipped."""
+        file_count = prewarm(
+            self.app,
+            ["does-not-exist.txt", "sub-directory", "../foo.txt"],
+        )
+        eq_(file_count, 0)
+
+    def test_sender_without_caches(self):
+        app = XSendfileApplication(_PROTECTED_DIR, XSendfile())
+        eq_(prewarm(app, ["foo.txt"], readahead_size=4096), 1)
+
+    def test_command_line(self):
+        temporary_directory = mkdtemp()
+        try:
+            access_log_path = path.join(temporary_directory, "access.log")
+            with open(access_log_path, "w") as access_log:
+                access_log.write(
+                    '127.0.0.1 - - [18/May/2010:13:44:18 +0000] '
+                    '"GET /foo.txt HTTP/1.1" 200 11\n',
+                )
+            cache_file_path = path.join(temporary_directory, "cache")
+            metadata_cache = SharedMetadataCache(cache_file_path, slot_count=8)
+
+            output = _call_main([
+                "prewarm",
+                _PROTECTED_DIR,
+                "--access-log",
+                access_log_path,
+                "--metadata-cache",
+                cache_file_path,
+                "--timeout",
+                "3600",
+            ])
+            eq_(output, "Prewarmed 1 files\n")
+
+            cache_key = _PROTECTED_DIR + "\0/foo.txt"
+            absolute_file_path = metadata_cache.get(cache_key)[0]
+            eq_(absolute_file_path, path.join(_PROTECTED_DIR, "foo.txt"))
+            expiry = metadata_cache._SLOT_HEADER.unpack_from(
+                metadata_cache._mmap,
+                metadata_cache._get_slot(cache_key.encode("utf8"))[1],
+            )[2]
+            ok_(get_current_time() + 3000 < expiry)
+        finally:
+            rmtree(temporary_directory)
+
+
+class TestHotPathsFromAccessLog(object):
+    """Unit tests for the extraction of the hot paths from an access log."""
+
+    log_line_template = \
+        '127.0.0.1 - - [18/May/2010:13:44:18 +0000] "GET %s HTTP/1.1" %s 11'
+
+    def get_log_lines(self, *requests):
+        return [self.log_line_template % request for request in requests]
+
+    def test_ordering(self):
+        log_lines = self.get_log_lines(
+            ("/foo.txt", 200),
+            ("/bar.txt", 200),
+            ("/bar.txt?baz=1", 200),
+            ("/bar.txt", 304),
+        )
+        eq_(get_hot_paths_from_access_log(log_lines), ["/bar.txt", "/foo.txt"])
+
+    def test_limit(self):
+        log_lines = self.get_log_lines(("/foo.txt", 200), ("/bar.txt", 200))
+        eq_(len(get_hot_paths_from_access_log(log_lines, limit=1)), 1)
+
+    def test_unsuccessful_requests(self):
+        log_lines = self.get_log_lines(("/foo.txt", 404), ("/bar.txt", 403))
+        log_lines.append('127.0.0.1 - - [18/May/2010] "POST /foo.txt" 200 11')
+        eq_(get_hot_paths_from_access_log(log_lines), [])
+
+    def test_path_prefix(self):
+        log_lines = self.get_log_lines(
+            ("/files/foo.txt", 200),
+            ("/other/bar.txt", 200),
+        )
+        eq_(
+            get_hot_paths_from_access_log(log_lines, path_prefix="/files"),
+            ["/foo.txt"],
+        )
+
+    def test_non_ascii_paths(self):
+        log_lines = self.get_log_lines(
+            ("/" + _EXPECTED_NON_ASCII_TOKEN_FILE_NAME_ENCODED, 200),
+            ("/%FF.txt", 200),
+        )
+        eq_(
+            get_hot_paths_from_access_log(log_lines),
+            [u"/" + _NON_ASCII_FILE_NAME],
+        )
+
+    def test_tokens(self):
+        log_lines = self.get_log_lines(
+            (_EXPECTED_ASCII_TOKEN_PATH, 200),
+            ("/foo.txt", 200),
+        )
+        eq_(
+            get_hot_paths_from_access_log(log_lines, strip_tokens=True),
+            ["/foo.txt"],
+        )
+
+
+class TestTemporaryFileSenders(object):
+    """Acceptance tests for the senders of generated files."""
+
+    def setUp(self):
+        self.scratch_directory = path.realpath(mkdtemp())
+        self.file_path = path.join(self.scratch_directory, "report.csv")
+        with open(self.file_path, "w") as file_:
+            file_.write("a,b\n")
+
+    def tearDown(self):
+        rmtree(self.scratch_directory)
+
+    def test_apache(self):
+        sender = XSendfileTemporary(self.scratch_directory)
+        response = self._get(sender, self.file_path)
+
+        eq_(response.headers['X-Sendfile-Temporary'], self.file_path)
+        eq_(response.content_type, "text/csv")
+        eq_(response.content_length, 4)
+
+    def test_nginx(self):
+        sender = NginxSendfileTemporary(self.scratch_directory)
+        response = self._get(sender, self.file_path)
+
+        eq_(response.headers['X-Accel-Redirect'], "/-temporary-/report.csv")
+        eq_(response.content_length, 4)
+
+    def test_file_outside_of_scratch_directory(self):
+        sender = XSendfileTemporary(self.scratch_directory)
+        file_path = path.join(self.scratch_directory, "..", "report.csv")
+        self._get(sender, file_path, status=403)
+
+    def test_non_existing_file(self):
+        sender = XSendfileTemporary(self.scratch_directory)
+        file_path = path.join(self.scratch_directory, "does-not-exist.csv")
+        self._get(sender, file_path, status=404)
+
+    def test_bad_scratch_directory(self):
+        assert_raises(BadRootError, XSendfileTemporary, _NON_EXISTING_DIR)
+
+    def test_public_senders(self):
+        ok_('XSendfileTemporary' in xsendfile.__all__)
+        ok_('NginxSendfileTemporary' in xsendfile.__all__)
+
+    def test_nginx_clean_up(self):
+        """Only the files older than the maximum age are deleted."""
+        old_file_path = path.join(self.scratch_directory, "old-report.csv")
+        open(old_file_path, "w").close()
+        two_hours_ago = get_current_time() - 7200
+        os.utime(old_file_path, (two_hours_ago, two_hours_ago))
+
+        NginxSendfileTemporary(self.scratch_directory).clean_up()
+
+        assert_false(path.exists(old_file_path))
+        ok_(path.exists(self.file_path))
+
+    @staticmethod
+    def _get(sender, file_path, status=200):
+        extra_environ = {'xsendfile.requested_file': file_path}
+        return _TestApp(sender).get(
+            "/",
+            extra_environ=extra_environ,
+            status=status,
+        )
+
+
+class TestXSendfileMiddleware(object):
+    """Acceptance tests for the middleware that offloads files."""
+
+    def test_file_wrapper(self):
+        """Files returned through ``wsgi.file_wrapper`` are offloaded."""
+        file_path = path.join(_PROTECTED_DIR, "foo.txt")
+
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Disposition", "attachment")])
+            return environ['wsgi.file_wrapper'](open(file_path, "rb"))
+
+        response = self._get(app)
+
+        eq_(response.headers['X-Sendfile'], file_path)
+        eq_(response.headers['Content-Disposition'], "attachment")
+        eq_(response.content_type, "text/plain")
+        eq_(response.content_length, 11)
+        eq_(response.body, b"")
+
+    def test_file_object(self):
+        """File objects returned as the response body are offloaded."""
+        file_path = path.join(_PROTECTED_DIR, _NON_LATIN1_FILE_NAME)
+        response = self._get(_FileApp(file_path))
+
+        eq_(response.headers['X-Sendfile'], quote(file_path.encode("utf8")))
+
+    def test_explicit_content_type(self):
+        """The Content-Type set by the application is kept."""
+        file_path = path.join(_PROTECTED_DIR, "foo.txt")
+
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/csv")])
+            return environ['wsgi.file_wrapper'](open(file_path, "rb"))
+
+        response = self._get(app)
+
+        eq_(response.headers['X-Sendfile'], file_path)
+        eq_(response.headers.getall('Content-Type'), ["text/csv"])
+
+    def test_partially_read_file(self):
+        """Files which have been read from are passed through."""
+        file_path = path.join(_PROTECTED_DIR, "foo.txt")
+
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            file_ = open(file_path, "rb")
+            file_.seek(6)
+            return environ['wsgi.file_wrapper'](file_)
+
+        response = self._get(app)
+
+        ok_("X-Sendfile" not in response.headers)
+        eq_(response.body, b"ipsum")
+
+    def test_nginx_sender(self):
+        file_path = path.join(_PROTECTED_SUB_DIR, "baz.txt")
+        response = self._get(_FileApp(file_path), "nginx")
+
+        eq_(
+            response.headers['X-Accel-Redirect'],
+            "/-internal-/sub-directory/baz.txt",
+        )
+
+    def test_nginx_sender_with_non_ascii_file(self):
+        file_path = path.join(_PROTECTED_DIR, _NON_LATIN1_FILE_NAME)
+        response = self._get(_FileApp(file_path), "nginx")
+
+        expected_file_path = u"/-internal-/" + _NON_LATIN1_FILE_NAME
+        eq_(
+            response.headers['X-Accel-Redirect'],
+            quote(expected_file_path.encode("utf8")),
+        )
+
+    def test_file_outside_of_root(self):
+        """Files outside of the root directory are passed through."""
+        file_path = path.join(_FIXTURES_DIR, "root.txt")
+        response = self._get(_FileApp(file_path))
+
+        ok_("X-Sendfile" not in response.headers)
+        with open(file_path, "rb") as file_:
+            eq_(response.body, file_.read())
+
+    def test_unsuccessful_response(self):
+        """Files in unsuccessful responses are passed through."""
+        file_path = path.join(_PROTECTED_DIR, "foo.txt")
+        response = self._get(_FileApp(file_path, "404 Not Found"), status=404)
+
+        ok_("X-Sendfile" not in response.headers)
+        eq_(response.body, b"Lorem ipsum")
+
+    def test_other_response(self):
+        """Responses whose body is not a file are passed through."""
+
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [b"Hello"]
+
+        response = self._get(app)
+
+        ok_("X-Sendfile" not in response.headers)
+        eq_(response.body, b"Hello")
+
+    def test_write(self):
+        """Responses written imperatively are passed through."""
+
+        def app(environ, start_response):
+            write = start_response("200 OK", [("Content-Type", "text/plain")])
+            write(b"Hello")
+            return []
+
+        response = self._get(app)
+
+        eq_(response.body, b"Hello")
+
+    @staticmethod
+    def _get(app, file_sender=None, status=200):
+        middleware = XSendfileMiddleware(app, _PROTECTED_DIR, file_sender)
+        return _TestApp(middleware).get("/", status=status)
+
+
+class TestHotFileTracker(object):
+    """Unit tests for the tracker of the files requested most often."""
+
+    def setUp(self):
+        self.tracker = HotFileTracker(capacity=2)
+
+    def test_no_requests(self):
+        eq_(self.tracker.get_hot_files(), [])
+
+    def test_counts(self):
+        self.tracker.record("/foo.txt", 10)
+        self.tracker.record("/bar.txt", 5)
+        self.tracker.record("/bar.txt", 5)
+
+        eq_(
+            self.tracker.get_hot_files(),
+            [("/bar.txt", 2, 10), ("/foo.txt", 1, 10)],
+        )
+
+    def test_limit(self):
+        self.tracker.record("/foo.txt", 10)
+        self.tracker.record("/bar.txt", 5)
+
+        eq_(len(self.tracker.get_hot_files(limit=1)), 1)
+
+    def test_capacity(self):
+        """The coldest hot file is replaced by a hotter file."""
+        self.tracker.record("/foo.txt", 1)
+        self.tracker.record("/foo.txt", 1)
+        self.tracker.record("/bar.txt", 1)
+        self.tracker.record("/baz.txt", 1)
+        eq_(
+            [hot_file[0] for hot_file in self.tracker.get_hot_files()],
+            ["/foo.txt", "/bar.txt"],
+        )
+
+        self.tracker.record("/baz.txt", 1)
+        eq_(
+            [hot_file[0] for hot_file in self.tracker.get_hot_files()],
+            ["/baz.txt", "/foo.txt"],
+        )
+
+    def test_many_files(self):
+        """The hottest files are found among many cold files."""
+        tracker = HotFileTracker(capacity=10, sketch_width=512)
+        for file_index in range(2000):
+            tracker.record("/cold-%s.txt" % file_index, 1)
+        for _ in range(50):
+            tracker.record("/hot.txt", 100)
+
+        hot_file = tracker.get_hot_files(limit=1)[0]
+        eq_(hot_file[0], "/hot.txt")
+        ok_(50 <= hot_file[1] < 60)
+        ok_(5000 <= hot_file[2])
 
+    def test_decay(self):
+        self.tracker.record("/foo.txt", 10)
+        self.tracker.record("/foo.txt", 10)
+        self.tracker.record("/bar.txt", 10)
 
-class BaseTestFileSender(object):
-    """Base **acceptance** test case for the file senders."""
+        self.tracker._last_decay_time -= 3600
+        self.tracker.record("/foo.txt", 10)
 
-    sender = None
+        eq_(self.tracker.get_hot_files(), [("/foo.txt", 2, 20)])
 
-    file_path_header = None
+    def test_no_decay(self):
+        tracker = HotFileTracker(decay_interval=None)
+        tracker.record("/foo.txt", 10)
+        tracker._last_decay_time -= 3600
+        tracker.record("/foo.txt", 10)
 
-    def __init__(self):
-        self.app = _TestApp(self.sender)
+        eq_(tracker.get_hot_files(), [("/foo.txt", 2, 20)])
 
-    def get_file(self, file_name, SCRIPT_NAME="", **extra_environ):
-        """Request the ``file_name`` and return the response."""
-        absolute_path_to_file = path.join(_PROTECTED_DIR, file_name)
-        extra_environ['xsendfile.requested_file'] = absolute_path_to_file
-        extra_environ['xsendfile.root_directory'] = _PROTECTED_DIR
+    def test_report(self):
+        self.tracker.record("/foo.txt", 10)
+        self.tracker.record("/bar.txt", 5)
+        self.tracker.record("/bar.txt", 5)
 
-        extra_environ['SCRIPT_NAME'] = SCRIPT_NAME
-        path_info = "/%s" % quote(file_name.encode('utf8'))
+        response = _TestApp(self.tracker).get("/", {'limit': "1"}, status=200)
 
-        return self.app.get(path_info, status=200, extra_environ=extra_environ)
+        eq_(response.content_type, "application/json")
+        eq_(
+            json.loads(response.body.decode("utf8")),
+            [{'path': "/bar.txt", 'requests': 2, 'bytes': 10}],
+        )
 
-    def verify_headers(self, response, file_attributes):
-        """Validate the HTTP headers received for the file."""
-        eq_(response.content_type, file_attributes['type'])
-        eq_(response.content_length, file_attributes['size'])
-        if "encoding" in file_attributes:
-            eq_(response.content_encoding, file_attributes['encoding'])
-        else:
-            ok_("Content-Encoding" not in response.headers)
+    def test_report_with_invalid_limit(self):
+        self.tracker.record("/foo.txt", 10)
+
+        response = _TestApp(self.tracker).get("/", {'limit': "a"})
+
+        eq_(len(json.loads(response.body.decode("utf8"))), 1)
+
+    def test_application(self):
+        """Only the files served are tracked."""
+        app = _TestApp(XSendfileApplication(
+            _PROTECTED_DIR,
+            hot_file_tracker=self.tracker,
+        ))
+        app.get("/foo.txt", status=200)
+        app.get("/does-not-exist.txt", status=404)
+
+        eq_(self.tracker.get_hot_files(), [("/foo.txt", 1, 11)])
+
+    def test_auth_token_application(self):
+        """Files are tracked by their path, without the token."""
+        token_config = TokenConfig(_SECRET, timeout=120)
+        app = _TestApp(AuthTokenApplication(
+            _PROTECTED_DIR,
+            token_config,
+            hot_file_tracker=self.tracker,
+        ))
+        url_path = token_config._generate_url_path(
+            _EXPECTED_ASCII_TOKEN_FILE_NAME,
+            datetime.now(),
+        )
+        app.get(url_path, status=200)
 
-    def verify_file(self, response, file_name):
-        raise NotImplementedError()
+        eq_(self.tracker.get_hot_files(), [("/foo.txt", 1, 11)])
 
-    def test_downloads(self):
-        """Run acceptance tests for all the known files in the fixtures."""
-        for (file_name, file_attributes) in _METADATA_BY_STUB_FILE_NAME.items():
-            # Using a Nose test generator:
-            def check():
-                response = self.get_file(file_name)
-                self.verify_headers(response, file_attributes)
-                self.verify_file(response, file_name)
 
-            check.description = "Test %r with %r" % (file_name, self.sender)
+class TestProfilingMiddleware(object):
+    """Unit tests for the middleware that profiles a sample of the requests."""
 
-            yield check
+    def setUp(self):
+        self.output_directory = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.output_directory)
+
+    def test_sampled_requests(self):
+        app = self._get_app(sample_rate=2)
+        for _ in range(4):
+            app.get("/foo.txt", status=200)
+
+        stats = self._get_stats(app.app.dump())
+        eq_(self._get_call_count(stats, "_lookup_file"), 2)
+
+    def test_periodic_dump(self):
+        """The statistics are dumped by a background thread."""
+        app = self._get_app(sample_rate=1, dump_interval=0.01)
+        app.get("/foo.txt", status=200)
+
+        for _ in range(500):
+            if os.listdir(self.output_directory):
+                break
+            sleep(0.01)
+        eq_(len(os.listdir(self.output_directory)), 1)
+        eq_(app.app.dump(), None)
+
+    def test_response_body(self):
+        """The iteration over the response body is profiled."""
+        app = _TestApp(ProfilingMiddleware(
+            XSendfileApplication(_PROTECTED_DIR, DirectSendfile()),
+            self.output_directory,
+            sample_rate=1,
+            dump_interval=3600,
+        ))
+        app.get("/foo.txt", status=200)
+
+        stats = self._get_stats(app.app.dump())
+        ok_(self._get_call_count(stats, "_read_chunks"))
+        eq_(self._get_call_count(stats, "release"), 1)
+
+    def test_unclosed_response(self):
+        """Requests are only added to the statistics once they're closed."""
+        app = ProfilingMiddleware(
+            XSendfileApplication(_PROTECTED_DIR),
+            self.output_directory,
+            sample_rate=1,
+            dump_interval=3600,
+        )
+        environ = {'REQUEST_METHOD': "GET", 'PATH_INFO': "/foo.txt"}
+        app_iter = app(environ, lambda status, headers, exc_info=None: None)
+        list(app_iter)
+        eq_(app.dump(), None)
+
+        app_iter.close()
+        ok_(app.dump())
+
+    def test_slow_request_threshold(self):
+        """Requests faster than the threshold are discarded."""
+        app = self._get_app(sample_rate=1, slow_request_threshold=60)
+        app.get("/foo.txt", status=200)
+
+        eq_(app.app.dump(), None)
+
+    def _get_app(self, **kwargs):
+        kwargs.setdefault('dump_interval', 3600)
+        app = ProfilingMiddleware(
+            XSendfileApplication(_PROTECTED_DIR),
+            self.output_directory,
+            **kwargs
+        )
+        return _TestApp(app)
 
+    @staticmethod
+    def _get_stats(stats_file_path):
+        from pstats import Stats
+        ok_(stats_file_path.endswith(".pstats"))
+        return Stats(stats_file_path)
 
-class TestXSendfileDirectServe(BaseTestFileSender):
-    """Acceptance tests for the application that serves the files directly."""
+    @staticmethod
+    def _get_call_count(stats, function_name):
+        call_count = 0
+        for function_key, function_stats in stats.stats.items():
+            if function_key[2] == function_name:
+                call_count += function_stats[1]
+        return call_count
 
-    sender = staticmethod(XSendfileApplication.serve_file)
 
-    def verify_file(self, response, file_name):
-        file_path = path.join(_PROTECTED_DIR, file_name)
-        with closing(open(file_path, 'rb')) as file_:
-            actual_file_contents = file_.read()
+class TestAccessLogMiddleware(object):
+    """Unit tests for the middleware that logs the requests."""
 
-        eq_(response.body, actual_file_contents)
+    def setUp(self):
+        self.temporary_directory = mkdtemp()
+        self.log_file_path = path.join(self.temporary_directory, "access.log")
+        self.config = TokenConfig(_SECRET, timeout=120)
 
+    def tearDown(self):
+        rmtree(self.temporary_directory)
 
-class TestXSendfileResponse(BaseTestFileSender):
-    """
-    Acceptance tests for the application that sets the ``X-Sendfile`` header.
-    
-    """
+    def test_served_file(self):
+        app = self._get_app()
+        token_time = datetime.now() - timedelta(seconds=30)
+        url_path = self.config._generate_url_path(
+            _EXPECTED_ASCII_TOKEN_FILE_NAME,
+            token_time,
+        )
+        app.get(url_path, status=200)
+        app.app.flush()
+
+        records = self._get_records()
+        eq_(len(records), 1)
+        record = records[0]
+        eq_(record['method'], "GET")
+        eq_(record['path'], url_path)
+        eq_(record['file'], path.join(_PROTECTED_DIR, "foo.txt"))
+        eq_(record['digest'], url_path[1:].split("-")[0])
+        ok_(29 <= record['token_age'] <= 32)
+        eq_(record['status'], 200)
+        eq_(record['bytes'], 11)
+        ok_(0 <= record['latency'] < 5)
+
+    def test_rejected_request(self):
+        app = self._get_app()
+        app.get("/foo.txt", status=404)
+        app.app.flush()
+
+        record = self._get_records()[0]
+        eq_(record['status'], 404)
+        eq_(record['file'], None)
+        eq_(record['digest'], None)
+        eq_(record['token_age'], None)
+
+    def test_full_buffer(self):
+        """Records are dropped and counted when the buffer is full."""
+        app = self._get_app(buffer_size=1)
+        app.get("/foo.txt", status=404)
+        app.get("/bar.txt", status=404)
+        eq_(app.app.dropped_record_count, 1)
+
+        app.app.flush()
+
+        records = self._get_records()
+        eq_(len(records), 2)
+        eq_(records[0]['path'], "/foo.txt")
+        eq_(records[1]['dropped_records'], 1)
+
+    def test_empty_buffer(self):
+        self._get_app().app.flush()
+        ok_(not path.exists(self.log_file_path))
+
+    def test_failed_write(self):
+        """Records which couldn't be written are dropped and counted."""
+        app = self._get_app()
+        app.get("/foo.txt", status=404)
+        os.mkdir(self.log_file_path)
+
+        assert_raises(EnvironmentError, app.app.flush)
+        eq_(app.app.dropped_record_count, 1)
+
+        os.rmdir(self.log_file_path)
+        app.app.flush()
+
+        records = self._get_records()
+        eq_(len(records), 1)
+        eq_(records[0]['dropped_records'], 1)
+
+    def test_invalid_content_length(self):
+        app = AccessLogMiddleware(
+            _HeadersApp([("Content-Length", "eleven")]),
+            self.log_file_path,
+            flush_interval=3600,
+        )
+        environ = {'REQUEST_METHOD': "GET", 'PATH_INFO': "/foo.txt"}
+        app(environ, lambda status, headers, exc_info=None: None)
+        app.flush()
+
+        record = self._get_records()[0]
+        eq_(record['status'], 200)
+        eq_(record['bytes'], None)
+
+    def test_failed_application(self):
+        """Requests are logged even if the application raises an error."""
+        app = AccessLogMiddleware(
+            _FailingApp(),
+            self.log_file_path,
+            flush_interval=3600,
+        )
+        environ = {'REQUEST_METHOD': "GET", 'PATH_INFO': "/foo.txt"}
+        assert_raises(ValueError, app, environ, None)
+        app.flush()
+
+        record = self._get_records()[0]
+        eq_(record['path'], "/foo.txt")
+        eq_(record['status'], None)
+
+    def _get_app(self, **kwargs):
+        app = AccessLogMiddleware(
+            AuthTokenApplication(_PROTECTED_DIR, self.config),
+            self.log_file_path,
+            flush_interval=3600,
+            **kwargs
+        )
+        return _TestApp(app)
 
-    file_path_header = "X-Sendfile"
+    def _get_records(self):
+        with open(self.log_file_path) as log_file:
+            return [json.loads(line) for line in log_file]
 
-    sender = XSendfile()
 
-    def verify_file(self, response, file_name):
-        file_path_decoded = path.join(_PROTECTED_DIR, file_name)
-        file_path = file_path_decoded.encode('utf8')
-        expected_file_path = quote(file_path)
+class _HeadersApp(object):
 
-        ok_(self.file_path_header in response.headers)
-        eq_(response.headers[self.file_path_header], expected_file_path)
+    def __init__(self, headers):
+        self._headers = headers
 
+    def __call__(self, environ, start_response):
+        start_response("200 OK", self._headers)
+        return []
 
-class TestNginxXSendfileResponse(BaseTestFileSender):
-    """
-    Acceptance tests for the application that sets the equivalent ``X-Sendfile``
-    header for Nginx.
-    
-    """
 
-    file_path_header = "X-Accel-Redirect"
+class _FailingApp(object):
 
-    sender = NginxSendfile()
+    def __call__(self, environ, start_response):
+        raise ValueError("The application failed")
 
-    def verify_file(self, response, file_name):
-        expected_file_path_decoded = "/-internal-/%s" % file_name
-        expected_file_path = quote(expected_file_path_decoded.encode('utf8'))
 
-        ok_(self.file_path_header in response.headers)
-        eq_(response.headers[self.file_path_header], expected_file_path)
+class _FileApp(object):
 
-    def test_script_name(self):
-        """
-        The SCRIPT_NAME must be taken into account while generating the path.
-        
-        """
-        response = self.get_file("foo.txt", SCRIPT_NAME="/bar")
-        eq_(response.headers[self.file_path_header], "/bar/-internal-/foo.txt")
+    def __init__(self, file_path, status="200 OK"):
+        self._file_path = file_path
+        self._status = status
+
+    def __call__(self, environ, start_response):
+        start_response(self._status, [("Content-Type", "text/plain")])
+        return open(self._file_path, "rb")
 
 
 # { Tests for the auth token
@@ -414,6 +3079,13 @@ class TestTokenConfig(object):
         five_hours_later = _EPOCH + timedelta(hours=5)
         ok_(self.config.is_current(five_hours_later))
 
+    def test_deadline(self):
+        """Tokens expire once the timeout has elapsed."""
+        eq_(
+            self.config.get_deadline(_FIXED_TIME),
+            _FIXED_TIME + timedelta(seconds=120),
+        )
+
     # { Tests for the token digest validation
 
     def test_validating_invalid_digest(self):
@@ -583,9 +3255,547 @@ class TestAuthTokenApp(object):
         )
 
 
+class TestAuthTokenAppWithUsageStore(object):
+    """Acceptance tests for the auth token application with usage limits."""
+
+    def setUp(self):
+        self.temporary_directory = mkdtemp()
+        database_path = path.join(self.temporary_directory, "tokens.sqlite")
+        self.config = TokenConfig(_SECRET, timeout=120)
+        usage_store = SQLiteTokenUsageStore(database_path, max_uses=2)
+        app = AuthTokenApplication(
+            _PROTECTED_DIR,
+            self.config,
+            token_usage_store=usage_store,
+        )
+        self.app = _TestApp(app)
+
+    def tearDown(self):
+        rmtree(self.temporary_directory)
+
+    def test_token_used_up(self):
+        """Tokens used as many times as allowed get a 410 response."""
+        url_path = self.config.get_url_path(_EXPECTED_ASCII_TOKEN_FILE_NAME)
+
+        self.app.get(url_path, status=200)
+        self.app.get(url_path, status=200)
+        self.app.get(url_path, status=410)
+
+    def test_invalid_digest(self):
+        """Tokens with invalid digests are not consumed."""
+        good_url_path = self.config.get_url_path(
+            _EXPECTED_ASCII_TOKEN_FILE_NAME,
+        )
+        bad_url_path = good_url_path[:3] + "xyz" + good_url_path[6:]
+
+        self.app.get(bad_url_path, status=404)
+        self.app.get(good_url_path, status=200)
+        self.app.get(good_url_path, status=200)
+
+    def test_rejected_requests(self):
+        """Tokens are not consumed by requests whose file isn't served."""
+        url_path = self.config.get_url_path(_EXPECTED_ASCII_TOKEN_FILE_NAME)
+        missing_file_url_path = self.config.get_url_path("non-existing.txt")
+
+        self.app.post(url_path, status=405)
+        self.app.head(url_path, status=200)
+        self.app.head(url_path, status=200)
+        self.app.get(missing_file_url_path, status=404)
+        self.app.get(missing_file_url_path, status=404)
+        self.app.get(missing_file_url_path, status=404)
+        self.app.get(url_path, status=200)
+        self.app.get(url_path, status=200)
+        self.app.get(url_path, status=410)
+
+    def test_unavailable_store(self):
+        """A 503 response is given if the store can't be updated."""
+        database_path = path.join(self.temporary_directory, "tokens.sqlite")
+        usage_store = SQLiteTokenUsageStore(database_path)
+        app = _TestApp(AuthTokenApplication(
+            _PROTECTED_DIR,
+            self.config,
+            token_usage_store=usage_store,
+        ))
+        url_path = self.config.get_url_path(_EXPECTED_ASCII_TOKEN_FILE_NAME)
+
+        usage_store._get_connection().execute("DROP TABLE token_uses")
+
+        response = app.get(url_path, status=503)
+        eq_(response.headers['Retry-After'], "1")
+
+
+class TestAuthTokenAppWithRevocationList(object):
+    """Acceptance tests for the auth token application with revoked tokens."""
+
+    def setUp(self):
+        self.temporary_directory = mkdtemp()
+        revocation_list_path = path.join(self.temporary_directory, "revoked")
+        self.config = TokenConfig(_SECRET, timeout=120)
+        self.revocation_list = \
+            TokenRevocationList(revocation_list_path, reload_interval=0)
+        app = AuthTokenApplication(
+            _PROTECTED_DIR,
+            self.config,
+            token_revocation_list=self.revocation_list,
+        )
+        self.app = _TestApp(app)
+
+    def tearDown(self):
+        rmtree(self.temporary_directory)
+
+    def test_revoked_token(self):
+        """Revoked tokens get a 410 response."""
+        now = datetime.now()
+        url_path = self.config._generate_url_path(
+            _EXPECTED_ASCII_TOKEN_FILE_NAME,
+            now,
+        )
+        self.app.get(url_path, status=200)
+
+        digest = url_path[1:].split("-")[0]
+        self.revocation_list.revoke(digest, now)
+
+        self.app.get(url_path, status=410)
+
+
+class TestAuthTokenAppWithCachePolicy(object):
+    """Acceptance tests for the caching headers of token-protected files."""
+
+    def setUp(self):
+        self.config = TokenConfig(_SECRET, timeout=120)
+        cache_policy = CachePolicy()
+        cache_policy.add_rule(3600)
+        app = AuthTokenApplication(
+            _PROTECTED_DIR,
+            self.config,
+            cache_policy=cache_policy,
+        )
+        self.app = _TestApp(app)
+
+    def test_remaining_lifetime(self):
+        """The max-age is capped to the remaining lifetime of the token."""
+        url_path = self.config._generate_url_path(
+            _EXPECTED_ASCII_TOKEN_FILE_NAME,
+            datetime.now() - timedelta(seconds=60),
+        )
+        response = self.app.get(url_path, status=200)
+
+        max_age = int(response.headers['Cache-Control'].split("=")[1])
+        ok_(50 <= max_age <= 61)
+
+    def test_usage_store(self):
+        """Tokens with limited uses prevent the files from being cached."""
+        temporary_directory = mkdtemp()
+        try:
+            usage_store = SQLiteTokenUsageStore(
+                path.join(temporary_directory, "tokens.sqlite"),
+            )
+            response = self._get_file(token_usage_store=usage_store)
+        finally:
+            rmtree(temporary_directory)
+
+        eq_(response.headers['Cache-Control'], "private, no-store")
+        assert_false('Expires' in response.headers)
+
+    def test_revocation_list(self):
+        """Revocable tokens prevent the files from being cached."""
+        temporary_directory = mkdtemp()
+        try:
+            revocation_list = TokenRevocationList(
+                path.join(temporary_directory, "revoked"),
+            )
+            response = self._get_file(token_revocation_list=revocation_list)
+        finally:
+            rmtree(temporary_directory)
+
+        eq_(response.headers['Cache-Control'], "private, no-store")
+        assert_false('Expires' in response.headers)
+
+    def test_usage_store_without_cache_policy(self):
+        """Files are not cached even if there's no cache policy."""
+        temporary_directory = mkdtemp()
+        try:
+            usage_store = SQLiteTokenUsageStore(
+                path.join(temporary_directory, "tokens.sqlite"),
+            )
+            app = _TestApp(AuthTokenApplication(
+                _PROTECTED_DIR,
+                self.config,
+                token_usage_store=usage_store,
+            ))
+            url_path = \
+                self.config.get_url_path(_EXPECTED_ASCII_TOKEN_FILE_NAME)
+            response = app.get(url_path, status=200)
+        finally:
+            rmtree(temporary_directory)
+
+        eq_(response.headers['Cache-Control'], "private, no-store")
+
+    def _get_file(self, **app_options):
+        cache_policy = CachePolicy()
+        cache_policy.add_rule(3600)
+        app = _TestApp(AuthTokenApplication(
+            _PROTECTED_DIR,
+            self.config,
+            cache_policy=cache_policy,
+            **app_options
+        ))
+        url_path = self.config.get_url_path(_EXPECTED_ASCII_TOKEN_FILE_NAME)
+        return app.get(url_path, status=200)
+
+
+class TestTokenRevocationList(object):
+    """Unit tests for the token revocation list."""
+
+    def setUp(self):
+        self.temporary_directory = mkdtemp()
+        self.file_path = path.join(self.temporary_directory, "revoked")
+        self.revocation_list = \
+            TokenRevocationList(self.file_path, reload_interval=0)
+
+    def tearDown(self):
+        rmtree(self.temporary_directory)
+
+    def test_missing_file(self):
+        assert_false(self.revocation_list.is_revoked("abc"))
+
+    def test_revoked_token(self):
+        self.revocation_list.revoke("abc", datetime.now())
+        ok_(self.revocation_list.is_revoked("abc"))
+        assert_false(self.revocation_list.is_revoked("def"))
+
+    def test_revocation_by_other_process(self):
+        """Tokens revoked through other instances are picked up."""
+        self.revocation_list.is_revoked("abc")
+
+        other_revocation_list = TokenRevocationList(self.file_path)
+        other_revocation_list.revoke("abc", datetime.now())
+
+        ok_(self.revocation_list.is_revoked("abc"))
+
+    def test_reload_interval(self):
+        """Changes are not picked up until the reload interval elapses."""
+        revocation_list = TokenRevocationList(self.file_path, 3600)
+        revocation_list.is_revoked("abc")
+
+        self.revocation_list.revoke("abc", datetime.now())
+
+        assert_false(revocation_list.is_revoked("abc"))
+
+    def test_compaction(self):
+        """Only the tokens which haven't expired are kept."""
+        self.revocation_list.revoke("abc", _EPOCH - timedelta(minutes=5))
+        self.revocation_list.revoke("def", datetime.now())
+
+        self.revocation_list.compact(TokenConfig(_SECRET, timeout=120))
+
+        assert_false(self.revocation_list.is_revoked("abc"))
+        ok_(self.revocation_list.is_revoked("def"))
+
+    def test_revocation_during_compaction(self):
+        """Tokens revoked while the list is being compacted are kept."""
+        self.revocation_list.revoke("abc", datetime.now())
+        token_config = TokenConfig(_SECRET, timeout=120)
+        revocation_thread = threading.Thread(
+            target=self.revocation_list.revoke,
+            args=("def", datetime.now()),
+        )
+
+        def get_deadline(generation_time):
+            if not revocation_thread.is_alive():
+                revocation_thread.start()
+                sleep(0.1)
+            return TokenConfig.get_deadline(token_config, generation_time)
+
+        token_config.get_deadline = get_deadline
+        self.revocation_list.compact(token_config)
+        revocation_thread.join()
+
+        ok_(self.revocation_list.is_revoked("abc"))
+        ok_(self.revocation_list.is_revoked("def"))
+
+
+class TestSQLiteTokenUsageStore(object):
+    """Unit tests for the SQLite token usage store."""
+
+    def setUp(self):
+        self.temporary_directory = mkdtemp()
+        self.database_path = path.join(self.temporary_directory, "tokens")
+        self.store = SQLiteTokenUsageStore(self.database_path)
+        self.deadline = get_current_time() + 120
+
+    def tearDown(self):
+        rmtree(self.temporary_directory)
+
+    def test_single_use(self):
+        ok_(self.store.consume("abc", self.deadline))
+        assert_false(self.store.consume("abc", self.deadline))
+
+    def test_multiple_uses(self):
+        store = SQLiteTokenUsageStore(self.database_path, max_uses=3)
+        for _ in range(3):
+            ok_(store.consume("abc", self.deadline))
+        assert_false(store.consume("abc", self.deadline))
+
+    def test_different_tokens(self):
+        ok_(self.store.consume("abc", self.deadline))
+        ok_(self.store.consume("def", self.deadline))
+
+    def test_sharing(self):
+        """Stores backed by the same database share the uses of tokens."""
+        other_store = SQLiteTokenUsageStore(self.database_path)
+        ok_(self.store.consume("abc", self.deadline))
+        assert_false(other_store.consume("abc", self.deadline))
+
+    def test_unavailable_database(self):
+        self.store._get_connection().execute("DROP TABLE token_uses")
+
+        assert_raises(
+            TokenUsageStoreUnavailableError,
+            self.store.consume,
+            "abc",
+            self.deadline,
+        )
+
+    def test_compaction(self):
+        """Only expired tokens are removed."""
+        self.store.consume("abc", get_current_time() - 1)
+        self.store.consume("def", self.deadline)
+
+        self.store.compact()
+
+        ok_(self.store.consume("abc", self.deadline))
+        assert_false(self.store.consume("def", self.deadline))
+
+
+class TestZipArchiveApplication(object):
+    """Acceptance tests for the application that streams ZIP archives."""
+
+    def setUp(self):
+        self.app = _TestApp(ZipArchiveApplication(_PROTECTED_DIR))
+
+    def test_stored_archive(self):
+        """Files are stored in the archive, whose size is known in advance."""
+        response = self.app.get(
+            "/documents.zip",
+            {'file': ["foo.txt", "binary-file.png"]},
+            status=200,
+        )
+
+        eq_(response.content_type, "application/zip")
+        eq_(response.content_length, len(response.body))
+        eq_(
+            response.headers['Content-Disposition'],
+            "attachment; filename*=UTF-8''documents.zip",
+        )
+        self._verify_archive(response, ["foo.txt", "binary-file.png"])
+
+    def test_compressed_archive(self):
+        """Files can be deflated."""
+        app = _TestApp(ZipArchiveApplication(_PROTECTED_DIR, compress=True))
+        response = app.get("/documents.zip", {'file': "foo.txt"}, status=200)
+
+        self._verify_archive(response, ["foo.txt"])
+
+    def test_non_ascii_file_names(self):
+        file_names = [_NON_ASCII_FILE_NAME, _NON_LATIN1_FILE_NAME]
+        response = self.app.get(
+            "/documents.zip",
+            {'file': [f.encode("utf8") for f in file_names]},
+            status=200,
+        )
+
+        self._verify_archive(response, file_names)
+
+    def test_directory(self):
+        """The files in the directories requested are archived."""
+        response = self.app.get(
+            "/documents.zip",
+            {'file': "sub-directory"},
+            status=200,
+        )
+
+        self._verify_archive(response, [_SUB_DIRECTORY_FILE])
+
+    def test_normalized_file_names(self):
+        """Names with dot segments or repeated slashes are normalized."""
+        response = self.app.get(
+            "/documents.zip",
+            {'file': ["sub-directory/../foo.txt", "sub-directory//./baz.txt"]},
+            status=200,
+        )
+
+        self._verify_archive(response, ["foo.txt", _SUB_DIRECTORY_FILE])
+
+    def test_duplicated_files(self):
+        """Files requested several times are only archived once."""
+        response = self.app.get(
+            "/documents.zip",
+            {'file': [
+                "foo.txt",
+                "./foo.txt",
+                _SUB_DIRECTORY_FILE,
+                "sub-directory",
+            ]},
+            status=200,
+        )
+
+        self._verify_archive(response, ["foo.txt", _SUB_DIRECTORY_FILE])
+
+    def test_no_files(self):
+        self.app.get("/documents.zip", status=404)
+
+    def test_non_existing_file(self):
+        self.app.get(
+            "/documents.zip",
+            {'file': ["foo.txt", "does-not-exist.txt"]},
+            status=404,
+        )
+
+    def test_file_outside_of_root(self):
+        self.app.get(
+            "/documents.zip",
+            {'file': ["foo.txt", "../root.txt"]},
+            status=403,
+        )
+
+    def test_method_other_than_get(self):
+        response = self.app.post("/documents.zip?file=foo.txt", status=405)
+        eq_(response.headers['Allow'], "GET")
+
+    def test_good_token(self):
+        config = TokenConfig(_SECRET, timeout=120)
+        app = _TestApp(ZipArchiveApplication(_PROTECTED_DIR, config))
+
+        file_names = ["foo.txt", _NON_LATIN1_FILE_NAME]
+        url_path = config.get_archive_url_path(u"documents.zip", file_names)
+        response = app.get(url_path, status=200)
+
+        self._verify_archive(response, file_names)
+
+    def test_invalid_token(self):
+        """The token must be valid for the whole list of files."""
+        config = TokenConfig(_SECRET, timeout=120)
+        app = _TestApp(ZipArchiveApplication(_PROTECTED_DIR, config))
+
+        url_path = config.get_archive_url_path(u"documents.zip", ["foo.txt"])
+        app.get(url_path + "&file=no-extension", status=404)
+
+    def test_expired_token(self):
+        config = TokenConfig(_SECRET, timeout=120)
+        app = _TestApp(ZipArchiveApplication(_PROTECTED_DIR, config))
+
+        url_path = config._generate_archive_url_path(
+            u"documents.zip",
+            ["foo.txt"],
+            _EPOCH - timedelta(minutes=5),
+        )
+        app.get(url_path, status=410)
+
+    @staticmethod
+    def _verify_archive(response, file_names):
+        with closing(ZipFile(BytesIO(response.body))) as archive:
+            eq_(archive.testzip(), None)
+            eq_(archive.namelist(), file_names)
+
+            for file_name in file_names:
+                file_path = path.join(_PROTECTED_DIR, file_name)
+                with open(file_path, "rb") as file_:
+                    eq_(archive.read(file_name), file_.read())
+
+
 # }
 
 
+class TestLoadTestComparison(object):
+    """Smoke tests for the comparison of the results of two load tests."""
+
+    def setUp(self):
+        self.temporary_directory = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.temporary_directory)
+
+    def test_comparison(self):
+        baseline_results_path = self._write_results("baseline.json", {
+            'valid': self._make_summary(100, 2),
+            'expired': self._make_summary(10, 1),
+        })
+        new_results_path = self._write_results("new.json", {
+            'valid': self._make_summary(150, 1),
+            'missing': self._make_summary(5, 1),
+        })
+
+        output = self._call_main(
+            ["compare", baseline_results_path, new_results_path],
+        )
+
+        output_lines = output.splitlines()
+        eq_(
+            output_lines[0].split(),
+            ["outcome", "metric", "baseline", "new", "change"],
+        )
+        eq_(
+            output_lines[1].split(),
+            ["valid", "throughput", "100.00", "150.00", "+50.0%"],
+        )
+        eq_(
+            output_lines[2].split(),
+            ["valid", "p50", "2.00", "1.00", "-50.0%"],
+        )
+        # Only the outcomes in both runs are compared:
+        eq_(len(output_lines), 5)
+
+    def test_zero_baseline(self):
+        baseline_results_path = self._write_results("baseline.json", {
+            'valid': self._make_summary(0, 0),
+        })
+        new_results_path = self._write_results("new.json", {
+            'valid': self._make_summary(10, 1),
+        })
+
+        output = self._call_main(
+            ["compare", baseline_results_path, new_results_path],
+        )
+
+        eq_(output.splitlines()[1].split()[-1], "n/a")
+
+    def test_percentiles(self):
+        latencies = [float(latency) for latency in range(1, 1001)]
+        eq_(loadtest._get_percentile(latencies, 0.5), 500)
+        eq_(loadtest._get_percentile(latencies, 0.99), 990)
+        eq_(loadtest._get_percentile(latencies, 0.999), 999)
+        eq_(loadtest._get_percentile([7.0], 0.999), 7)
+        eq_(loadtest._get_percentile([1.0, 2.0], 0.5), 1)
+
+    def _write_results(self, file_name, summaries_by_outcome):
+        results_path = path.join(self.temporary_directory, file_name)
+        with open(results_path, "w") as results_file:
+            json.dump({'outcomes': summaries_by_outcome}, results_file)
+        return results_path
+
+    @staticmethod
+    def _make_summary(throughput, latency):
+        return {
+            'requests': 1,
+            'errors': 0,
+            'throughput': throughput,
+            'p50': latency,
+            'p99': latency,
+            'p999': latency,
+        }
+
+    @staticmethod
+    def _call_main(arguments):
+        original_stdout = sys.stdout
+        sys.stdout = output = StringIO()
+        try:
+            loadtest.main(arguments)
+        finally:
+            sys.stdout = original_stdout
+        return output.getvalue()
+
+
 class _TestResponse(TestResponse):
     @staticmethod
     def decode_content():
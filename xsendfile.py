@@ -13,32 +13,183 @@
 # INFRINGEMENT, AND FITNESS FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+import base64
+import binascii
+import errno
 import hashlib
+import heapq
+import itertools
+import logging
+import mimetypes
+import mmap
 import os
+import posixpath
 import re
+import select
+import stat
+import struct
+import sys
+import threading
+import zlib
+from collections import Counter
+from collections import OrderedDict
+from collections import deque
 from datetime import datetime
 from datetime import timedelta
-from mimetypes import guess_type
+from email.utils import formatdate
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
 from os import path
+from time import localtime
 from time import mktime
+from time import sleep
+from time import time as get_current_time
 
-from paste.fileapp import FileApp
-from paste.httpexceptions import HTTPForbidden
-from paste.httpexceptions import HTTPGone
-from paste.httpexceptions import HTTPMethodNotAllowed
-from paste.httpexceptions import HTTPNotFound
+import six
+from six.moves.queue import Full as QueueFull
+from six.moves.queue import Queue
+from six.moves.urllib.parse import parse_qs
 from six.moves.urllib.parse import quote
 from six.moves.urllib.parse import unquote
+from six.moves.urllib.parse import unquote_to_bytes
+from six.moves.urllib.parse import urlencode
 
+try:
+    import fcntl
+except ImportError:  # pragma:no cover
+    # Not on a POSIX system, so cross-process locking is not available:
+    fcntl = None
 
-__all__ = ["AuthTokenApplication", "BadRootError", "BadSenderError",
-    "NginxSendfile", "TokenConfig", "XSendfile", "XSendfileApplication"]
+try:
+    import ctypes
+except ImportError:  # pragma:no cover
+    ctypes = None
 
+try:
+    import resource
+except ImportError:  # pragma:no cover
+    resource = None
 
-_FORBIDDEN_RESPONSE = HTTPForbidden()
-_GONE_RESPONSE = HTTPGone()
-_INVALID_METHOD_RESPONSE = HTTPMethodNotAllowed(headers=[("allow", "GET")])
-_NOT_FOUND_RESPONSE = HTTPNotFound()
+try:
+    from time import monotonic as get_monotonic_time
+except ImportError:  # pragma:no cover
+    # Python 2, where the wall clock has to do:
+    from time import time as get_monotonic_time
+
+
+__all__ = ["AccessLogMiddleware", "AuthTokenApplication", "BadCacheFileError",
+    "BadRootError", "BadSenderError", "BandwidthScheduler", "CachePolicy",
+    "ContentDigestStore", "ContentTypeResolver", "DirectSendfile",
+    "FileSystemGuard", "FileSystemUnavailableError", "FileSystemWatcher",
+    "HotFileTracker", "NginxSendfile", "NginxSendfileTemporary",
+    "ProfilingMiddleware", "SQLiteTokenUsageStore", "SharedMetadataCache",
+    "SizeAwareSendfile", "TokenConfig", "TokenRevocationList",
+    "TokenUsageStoreUnavailableError", "UnionXSendfileApplication",
+    "XSendfile", "XSendfileApplication", "XSendfileMiddleware",
+    "XSendfileTemporary", "ZipArchiveApplication",
+    "get_hot_paths_from_access_log", "prewarm"]
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class _ErrorResponse(object):
+    """
+    WSGI application which returns an HTTP error response.
+
+    The headers and the body are rendered in advance in HTML and plain text, and
+    the variant for each ``Accept`` header is memoized.
+
+    """
+
+    _MAX_MEMOIZED_ACCEPT_HEADERS = 256
+
+    def __init__(self, status, explanation, headers=()):
+        self._status = status
+
+        plain_text_body = "%s\n\n%s\n" % (status, explanation)
+        html_body = (
+            "<html><head><title>%s</title></head>"
+            "<body><h1>%s</h1><p>%s</p></body></html>\n"
+        ) % (status, status, explanation)
+
+        self._plain_text_response = self._render(
+            "text/plain; charset=UTF-8",
+            plain_text_body,
+            headers,
+        )
+        self._html_response = self._render(
+            "text/html; charset=UTF-8",
+            html_body,
+            headers,
+        )
+
+        self._responses_by_accept_header = {
+            "": self._plain_text_response,
+            "*/*": self._plain_text_response,
+        }
+
+    def __call__(self, environ, start_response):
+        accept_header = environ.get('HTTP_ACCEPT', "")
+        response = self._responses_by_accept_header.get(accept_header)
+        if response is None:
+            response = self._negotiate(accept_header)
+
+        headers, body = response
+        start_response(self._status, list(headers))
+        return [body]
+
+    def _negotiate(self, accept_header):
+        if "html" in accept_header:
+            response = self._html_response
+        else:
+            response = self._plain_text_response
+
+        responses_by_accept_header = self._responses_by_accept_header
+        if len(responses_by_accept_header) < \
+                self._MAX_MEMOIZED_ACCEPT_HEADERS:
+            responses_by_accept_header[accept_header] = response
+
+        return response
+
+    @staticmethod
+    def _render(content_type, body, extra_headers):
+        body = body.encode("ascii")
+        headers = [
+            ("Content-Type", content_type),
+            ("Content-Length", str(len(body))),
+        ]
+        headers.extend(extra_headers)
+        return tuple(headers), body
+
+
+_FORBIDDEN_RESPONSE = _ErrorResponse(
+    "403 Forbidden",
+    "Access was denied to this resource.",
+)
+_GONE_RESPONSE = _ErrorResponse(
+    "410 Gone",
+    "This resource is no longer available.",
+)
+_INVALID_ARCHIVE_METHOD_RESPONSE = _ErrorResponse(
+    "405 Method Not Allowed",
+    "The method specified is not allowed for this resource.",
+    [("Allow", "GET")],
+)
+_INVALID_METHOD_RESPONSE = _ErrorResponse(
+    "405 Method Not Allowed",
+    "The method specified is not allowed for this resource.",
+    [("Allow", "GET, HEAD")],
+)
+_NOT_FOUND_RESPONSE = _ErrorResponse(
+    "404 Not Found",
+    "The resource could not be found.",
+)
+_SERVICE_UNAVAILABLE_RESPONSE = _ErrorResponse(
+    "503 Service Unavailable",
+    "The resource is temporarily unavailable.",
+    [("Retry-After", "1")],
+)
 
 
 class XSendfileApplication(object):
@@ -48,7 +199,10 @@ class XSendfileApplication(object):
 
     """
 
-    def __init__(self, root_directory, file_sender=None):
+    def __init__(self, root_directory, file_sender=None, metadata_cache=None,
+                 cache_policy=None, file_system_guard=None,
+                 content_digest_store=None, hot_file_tracker=None,
+                 content_type_resolver=None):
         """
 
         :param root_directory: The absolute path to the root directory.
@@ -57,29 +211,35 @@ class XSendfileApplication(object):
             defaults to the standard X-Sendfile.
         :type file_sender: a string of ``standard``, ``nginx`` or ``serve``,
             or a WSGI application.
+        :param metadata_cache: The cache for the resolved paths and the status
+            of the requested files, if any.
+        :type metadata_cache: :class:`SharedMetadataCache`
+        :param cache_policy: The rules for the ``Cache-Control`` header of the
+            files served, if any.
+        :type cache_policy: :class:`CachePolicy`
+        :param file_system_guard: The guard that bounds the time taken to
+            look up the requested files, if any.
+        :type file_system_guard: :class:`FileSystemGuard`
+        :param content_digest_store: The store of the digests of the files,
+            if the responses should have a strong ``ETag`` and a ``Digest``
+            header.
+        :type content_digest_store: :class:`ContentDigestStore`
+        :param hot_file_tracker: The tracker of the files requested most often,
+            if any.
+        :type hot_file_tracker: :class:`HotFileTracker`
+        :param content_type_resolver: The resolver of the MIME types of the
+            files served; defaults to one with the types built into Python.
+        :type content_type_resolver: :class:`ContentTypeResolver`
         :raises BadRootError: If the root directory is not an existing directory
             or is contained in a symbolic link
         :raises BadSenderError: If the ``file_sender`` is not valid.
 
         """
-        # Let's remove any trailing slash before any validation:
-        root_directory = root_directory.rstrip(os.sep)
-
-        # Validating the root directory:
-        if not path.isabs(root_directory):
-            raise BadRootError("Path to root directory %s is not absolute" %
-                               root_directory)
-
-        if not path.isdir(root_directory):
-            raise BadRootError("Path to root directory %s does not exist or "
-                               "is not a directory" % root_directory)
-
-        real_path = path.realpath(root_directory)
-        if root_directory != real_path:
-            raise BadRootError("Directory %s or one of its parents is a "
-                               "symbolic link" % root_directory)
+        root_directory = _validate_root_directory(root_directory)
 
         self._root_directory = root_directory
+        self._root_directory_descriptor = \
+            _open_resolution_root(root_directory)
 
         # Validating the file sender:
         if not file_sender or file_sender == "standard":
@@ -89,6 +249,8 @@ class XSendfileApplication(object):
             sender = NginxSendfile()
 
         elif file_sender == "serve":
+            # Load Paste now rather than when the first file is served:
+            _get_file_app_class()
             sender = self.serve_file
 
         elif callable(file_sender):
@@ -100,37 +262,225 @@ class XSendfileApplication(object):
 
         self._sender = sender
 
+        self._metadata_cache = metadata_cache
+
+        self._cache_policy = cache_policy
+
+        self._file_system_guard = file_system_guard
+
+        self._content_digest_store = content_digest_store
+
+        self._hot_file_tracker = hot_file_tracker
+
+        self._content_type_resolver = content_type_resolver
+
     def __call__(self, environ, start_response):
         """
-        Serve the file if and only if the request method is GET and the file
-        exists within the root directory.
+        Serve the file if and only if the request method is GET or HEAD and
+        the file exists within the root directory.
 
         Otherwise, return an error response.
 
         """
-        path_info_decoded = _decode_path(environ['PATH_INFO'])
-        absolute_file_path = self._get_absolute_file_path(path_info_decoded)
-
-        if environ['REQUEST_METHOD'].upper() != "GET":
-            # The request was made using a method other than GET, which is
-            # not supported:
+        if environ['REQUEST_METHOD'].upper() not in ("GET", "HEAD"):
+            # The request was made using a method other than GET or HEAD,
+            # which is not supported:
             response = _INVALID_METHOD_RESPONSE
 
-        elif (not absolute_file_path.startswith(self._root_directory) or
-                absolute_file_path == self._root_directory):
-            # The file requested is outside of the root or it's the root itself:
-            response = _FORBIDDEN_RESPONSE
-
-        elif not path.isfile(absolute_file_path):
-            # The requested file is within the root directory but doesn't exist:
-            response = _NOT_FOUND_RESPONSE
         else:
-            # The requested file can be served:
-            environ['xsendfile.requested_file'] = absolute_file_path
-            response = self._sender
+            path_info_decoded = _get_decoded_path_info(environ)
+            try:
+                absolute_file_path, file_stat = \
+                    self._resolve_file(path_info_decoded)
+            except FileSystemUnavailableError:
+                return self._file_system_guard._unavailable_response(
+                    environ,
+                    start_response,
+                )
+
+            if absolute_file_path is None:
+                # The file requested is outside of the root or it's the root
+                # itself:
+                response = _FORBIDDEN_RESPONSE
+
+            elif file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+                # The requested file is within the root directory but doesn't
+                # exist:
+                response = _NOT_FOUND_RESPONSE
+
+            else:
+                # The requested file can be served, unless access is denied:
+                denial_response = self._get_denial_response(environ)
+                if denial_response is not None:
+                    return denial_response(environ, start_response)
+
+                environ['xsendfile.requested_file'] = absolute_file_path
+                environ['xsendfile.requested_file_stat'] = file_stat
+                environ['xsendfile.file_sender'] = self._sender
+                response = self._sender
+
+                if self._content_type_resolver is not None:
+                    environ['xsendfile.content_type'] = \
+                        self._content_type_resolver.resolve(
+                            absolute_file_path,
+                            file_stat,
+                        )
+
+                content_digest_store = self._content_digest_store
+                if content_digest_store is not None:
+                    environ['xsendfile.content_digest'] = \
+                        content_digest_store.get_content_digest(
+                            absolute_file_path,
+                            file_stat,
+                        )
+
+                if self._cache_policy is not None:
+                    start_response = self._cache_policy.wrap_start_response(
+                        start_response,
+                        environ,
+                        path_info_decoded,
+                    )
+
+                if self._hot_file_tracker is not None:
+                    self._hot_file_tracker.record(
+                        path_info_decoded,
+                        file_stat.st_size,
+                    )
 
         return response(environ, start_response)
 
+    def _get_denial_response(self, environ):
+        """
+        Return the error response for a request whose file exists and can be
+        served, or :data:`None` if access is granted.
+
+        This is the last check made before the file is sent, so subclasses can
+        use it to keep track of the requests actually served.
+
+        """
+        return None
+
+    def _resolve_file(self, relative_file_path):
+        """
+        Return the absolute path to ``relative_file_path`` and its status.
+
+        The path is :data:`None` if the file is outside of the root directory,
+        and the status is :data:`None` if the file does not exist.
+
+        ``.`` and ``..`` segments are resolved before symbolic links, so that
+        each file has a single path (e.g., in the metadata cache).
+
+        """
+        relative_file_path = posixpath.normpath(relative_file_path.lstrip("/"))
+        if relative_file_path == ".." or relative_file_path.startswith("../"):
+            # The file is outside of the root:
+            return None, None
+        if relative_file_path == ".":
+            relative_file_path = ""
+        relative_file_path = "/" + relative_file_path
+
+        metadata_cache = self._metadata_cache
+        if metadata_cache is None:
+            return self._lookup_file(relative_file_path)
+
+        cache_key = self._get_cache_key(relative_file_path)
+        file_metadata = metadata_cache.get(cache_key)
+        if file_metadata is None:
+            file_metadata = self._lookup_file(relative_file_path)
+            # Files reached through symbolic links to directories are not
+            # cached, since their entries couldn't be invalidated when the
+            # files change:
+            if self._is_canonical_file_path(
+                    relative_file_path,
+                    file_metadata[0]):
+                metadata_cache.set(cache_key, file_metadata)
+
+        return file_metadata
+
+    def _lookup_file(self, relative_file_path):
+        """Resolve ``relative_file_path`` against the file system."""
+        file_system_guard = self._file_system_guard
+        if file_system_guard is not None:
+            return file_system_guard.call(
+                self._lookup_file_unguarded,
+                relative_file_path,
+            )
+
+        return self._lookup_file_unguarded(relative_file_path)
+
+    def _lookup_file_unguarded(self, relative_file_path):
+        if self._root_directory_descriptor is not None:
+            return self._lookup_file_beneath_root(relative_file_path)
+
+        absolute_file_path = self._get_absolute_file_path(relative_file_path)
+
+        if not absolute_file_path.startswith(self._root_directory + os.sep):
+            # The file is outside of the root or it's the root itself:
+            return None, None
+
+        try:
+            file_stat = os.stat(absolute_file_path)
+        except OSError:
+            file_stat = None
+
+        return absolute_file_path, file_stat
+
+    def _lookup_file_beneath_root(self, relative_file_path):
+        """
+        Resolve ``relative_file_path`` with a single ``openat2()`` call
+        relative to the root directory.
+
+        Unlike :meth:`_get_absolute_file_path`, symbolic links to absolute
+        paths are not followed even if they point inside the root directory.
+
+        """
+        relative_file_path = relative_file_path.lstrip("/")
+        relative_file_path_bytes = _encode_file_system_path(relative_file_path)
+        if not relative_file_path_bytes or b"\0" in relative_file_path_bytes:
+            return None, None
+
+        try:
+            file_descriptor = _openat2(
+                self._root_directory_descriptor,
+                relative_file_path_bytes,
+            )
+        except OSError as exc:
+            if exc.errno == errno.EXDEV:
+                # The file is outside of the root:
+                return None, None
+
+            absolute_file_path = path.normpath(
+                path.join(self._root_directory, relative_file_path),
+            )
+            return absolute_file_path, None
+
+        try:
+            file_stat = os.fstat(file_descriptor)
+            absolute_file_path = \
+                os.readlink("/proc/self/fd/%s" % file_descriptor)
+        finally:
+            os.close(file_descriptor)
+
+        if absolute_file_path == self._root_directory:
+            return None, None
+
+        return absolute_file_path, file_stat
+
+    def _get_cache_key(self, relative_file_path):
+        # Entries are scoped by root directory because several applications
+        # may share the same cache:
+        return self._root_directory + "\0" + \
+            _normalize_path(relative_file_path)
+
+    def _is_canonical_file_path(self, relative_file_path, absolute_file_path):
+        """
+        Report whether ``absolute_file_path`` is the file in
+        ``relative_file_path`` without following symbolic links.
+
+        """
+        return absolute_file_path == \
+            self._root_directory + _normalize_path(relative_file_path)
+
     def _get_absolute_file_path(self, relative_file_path):
         absolute_file_path = path.join(
             self._root_directory,
@@ -142,20 +492,273 @@ class XSendfileApplication(object):
     @staticmethod
     def serve_file(environ, start_response):
         """Serve the file in ``environ`` directly."""
-        file_app = FileApp(environ['xsendfile.requested_file'])
+        file_app_class = _get_file_app_class()
+        file_app = file_app_class(environ['xsendfile.requested_file'])
         return file_app(environ, start_response)
 
 
+def _validate_root_directory(root_directory):
+    """
+    Return ``root_directory`` without any trailing slash if it's a valid root
+    directory.
+
+    :raises BadRootError: If the root directory is not an existing directory
+        or is contained in a symbolic link
+
+    """
+    # Let's remove any trailing slash before any validation:
+    root_directory = root_directory.rstrip(os.sep)
+
+    # Validating the root directory:
+    if not path.isabs(root_directory):
+        raise BadRootError("Path to root directory %s is not absolute" %
+                           root_directory)
+
+    if not path.isdir(root_directory):
+        raise BadRootError("Path to root directory %s does not exist or "
+                           "is not a directory" % root_directory)
+
+    real_path = path.realpath(root_directory)
+    if root_directory != real_path:
+        raise BadRootError("Directory %s or one of its parents is a "
+                           "symbolic link" % root_directory)
+
+    return root_directory
+
+
+def _get_file_app_class():
+    """
+    Return :class:`paste.fileapp.FileApp`, which is only imported when needed
+    because it pulls in much of Paste.
+
+    """
+    from paste.fileapp import FileApp
+    return FileApp
+
+
+class XSendfileMiddleware(object):
+    """
+    WSGI middleware which offloads the files returned by the wrapped
+    application to the Web server.
+
+    Files are offloaded when they are returned through ``wsgi.file_wrapper``
+    or as file objects in successful responses, they are within the root
+    directory and they haven't been read from. Any other response is passed
+    through unchanged.
+
+    The ``Content-Type`` set by the wrapped application, if any, is kept.
+
+    """
+
+    _REPLACED_HEADER_NAMES = frozenset(["content-length", "content-encoding"])
+
+    def __init__(self, app, root_directory, file_sender=None,
+                 file_system_guard=None):
+        """
+
+        :param app: The WSGI application whose files should be offloaded.
+        :param root_directory: The absolute path to the directory whose files
+            can be offloaded.
+        :type root_directory: :class:`basestring`
+        :param file_sender: The application to use to send the files;
+            defaults to the standard X-Sendfile.
+        :type file_sender: a string of ``standard`` or ``nginx``, or a WSGI
+            application.
+        :param file_system_guard: The guard that bounds the time taken to
+            look up the files, if any. Files whose lookup fails are sent by
+            ``app`` itself.
+        :type file_system_guard: :class:`FileSystemGuard`
+        :raises BadRootError: If the root directory is not an existing directory
+            or is contained in a symbolic link
+        :raises BadSenderError: If the ``file_sender`` is not valid.
+
+        """
+        self._app = app
+        self._file_application = XSendfileApplication(
+            root_directory,
+            file_sender,
+            file_system_guard=file_system_guard,
+        )
+
+    def __call__(self, environ, start_response):
+        original_file_wrapper = environ.get('wsgi.file_wrapper')
+        environ['wsgi.file_wrapper'] = _TrackingFileWrapper
+
+        captured_responses = []
+        is_passthrough = []
+
+        def start_captured_response(status, headers, exc_info=None):
+            if is_passthrough:
+                return start_response(status, headers, exc_info)
+
+            captured_responses.append((status, headers, exc_info))
+            server_writes = []
+
+            def write(data):
+                # The body is being written imperatively, so the response
+                # cannot be offloaded:
+                if not server_writes:
+                    is_passthrough.append(True)
+                    server_write = start_response(status, headers, exc_info)
+                    server_writes.append(server_write)
+                server_writes[0](data)
+
+            return write
+
+        app_iter = self._app(environ, start_captured_response)
+
+        if not is_passthrough and captured_responses:
+            status, headers = captured_responses[-1][:2]
+            file_metadata = self._get_offloadable_file(app_iter, status)
+            if file_metadata is not None:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+                return self._offload_file(
+                    environ,
+                    start_response,
+                    file_metadata,
+                    headers,
+                )
+
+            start_response(*captured_responses[-1])
+
+        is_passthrough.append(True)
+
+        if isinstance(app_iter, _TrackingFileWrapper) and \
+                original_file_wrapper is not None:
+            app_iter = original_file_wrapper(
+                app_iter.filelike,
+                app_iter.block_size,
+            )
+        return app_iter
+
+    def _get_offloadable_file(self, app_iter, status):
+        if not status.startswith("200 "):
+            return None
+
+        if isinstance(app_iter, _TrackingFileWrapper):
+            filelike = app_iter.filelike
+        elif hasattr(app_iter, "read"):
+            filelike = app_iter
+        else:
+            return None
+
+        # Only whole files can be offloaded:
+        try:
+            if filelike.tell() != 0:
+                return None
+        except (AttributeError, EnvironmentError, ValueError):
+            return None
+
+        file_path = getattr(filelike, "name", None)
+        if not isinstance(file_path, six.string_types) or \
+                not path.isabs(file_path):
+            return None
+
+        if isinstance(file_path, bytes):
+            # Python 2:
+            file_path = file_path.decode(sys.getfilesystemencoding() or "utf8")
+
+        root_directory = self._file_application._root_directory
+        file_path = path.normpath(file_path)
+        if not file_path.startswith(root_directory + os.sep):
+            return None
+
+        relative_file_path = file_path[len(root_directory):]
+        try:
+            absolute_file_path, file_stat = \
+                self._file_application._resolve_file(relative_file_path)
+        except FileSystemUnavailableError:
+            # The response of the application is sent as is instead:
+            return None
+        if absolute_file_path is None or file_stat is None or \
+                not stat.S_ISREG(file_stat.st_mode):
+            return None
+
+        return relative_file_path, absolute_file_path, file_stat
+
+    def _offload_file(self, environ, start_response, file_metadata, headers):
+        relative_file_path, absolute_file_path, file_stat = file_metadata
+
+        sender_environ = dict(environ)
+        sender_environ['SCRIPT_NAME'] = ""
+        path_info = _encode_path(relative_file_path)
+        sender_environ['PATH_INFO'] = path_info
+        sender_environ['xsendfile.decoded_path_info'] = \
+            (path_info, relative_file_path)
+        sender_environ['xsendfile.requested_file'] = absolute_file_path
+        sender_environ['xsendfile.requested_file_stat'] = file_stat
+
+        extra_headers = [
+            (name, value) for (name, value) in headers
+            if name.lower() not in self._REPLACED_HEADER_NAMES
+        ]
+        has_content_type = any(
+            name.lower() == "content-type" for (name, _) in extra_headers
+        )
+
+        def start_sender_response(status, sender_headers, exc_info=None):
+            if has_content_type:
+                sender_headers = [
+                    (name, value) for (name, value) in sender_headers
+                    if name.lower() != "content-type"
+                ]
+            return start_response(
+                status,
+                sender_headers + extra_headers,
+                exc_info,
+            )
+
+        sender = self._file_application._sender
+        return sender(sender_environ, start_sender_response)
+
+
+class _TrackingFileWrapper(object):
+    """
+    ``wsgi.file_wrapper`` which keeps track of the file it wraps.
+
+    """
+
+    def __init__(self, filelike, block_size=8192):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        read = self.filelike.read
+        block = read(self.block_size)
+        while block:
+            yield block
+            block = read(self.block_size)
+
+    def close(self):
+        if hasattr(self.filelike, "close"):
+            self.filelike.close()
+
+
 class _Sendfile(object):
     """Auxiliar WSGI applications that sends the file present in the environ."""
 
+    _readahead_size = 0
+
     def __call__(self, environ, start_response):
         """Send the file in ``environ`` with the X-Sendfile header."""
+        if self._readahead_size:
+            _prefetch_file(
+                environ['xsendfile.requested_file'],
+                self._readahead_size,
+            )
+
         file_path = self.get_file_path(environ)
         file_path_encoded = _encode_path(file_path)
 
         headers = [(self.file_path_header, file_path_encoded)]
-        _complete_headers(environ['xsendfile.requested_file'], headers)
+        _complete_headers(
+            environ['xsendfile.requested_file'],
+            headers,
+            environ.get('xsendfile.requested_file_stat'),
+            environ.get('xsendfile.content_digest'),
+            environ.get('xsendfile.content_type'),
+        )
 
         start_response("200 OK", headers)
         return [b""]
@@ -170,6 +773,17 @@ class XSendfile(_Sendfile):
 
     file_path_header = "X-Sendfile"
 
+    def __init__(self, readahead_size=0):
+        """
+
+        :param readahead_size: The number of bytes at the start of the file
+            that the kernel should start reading into the page cache before
+            the headers are sent; ``0`` disables the hint.
+        :type readahead_size: :class:`int`
+
+        """
+        self._readahead_size = readahead_size
+
     def get_file_path(self, environ):
         """Return the requested file in the ``environ`` as is."""
         return environ['xsendfile.requested_file']
@@ -180,247 +794,5107 @@ class NginxSendfile(_Sendfile):
 
     file_path_header = "X-Accel-Redirect"
 
-    def __init__(self, redirect_location="/-internal-"):
+    def __init__(self, redirect_location="/-internal-", readahead_size=0):
         """
 
         :param redirect_location: The prefix of the path to the internal
             location of the file, with ``SCRIPT_NAME`` preppended (if present).
+        :param readahead_size: The number of bytes at the start of the file
+            that the kernel should start reading into the page cache before
+            the headers are sent; ``0`` disables the hint.
+        :type readahead_size: :class:`int`
 
         """
         self._redirect_location = redirect_location
+        self._readahead_size = readahead_size
 
     def get_file_path(self, environ):
         """
         Return the path to the requested file under {SCRIPT_NAME}/-internal-/.
 
         """
-        script_name = unquote(environ['SCRIPT_NAME'])
-        path_info = _decode_path(environ['PATH_INFO'])
+        script_name = _unquote_script_name(environ['SCRIPT_NAME'])
+        path_info = _get_decoded_path_info(environ)
         file_path = ''.join((script_name, self._redirect_location, path_info))
         return file_path
 
 
-def _complete_headers(file_path, headers):
+class _TemporarySendfile(_Sendfile):
     """
-    Add the MIME type, length and encoding HTTP headers associated to the file
-    in ``file_path``.
+    Auxiliar WSGI application that sends a generated file in a scratch
+    directory, which must be deleted once it's been sent.
 
     """
-    mime_type, encoding = guess_type(file_path)
 
-    if not mime_type:
-        mime_type = "application/octet-stream"
+    def __init__(self, scratch_directory):
+        """
 
-    headers.append(("Content-Type", mime_type))
-    headers.append(("Content-Length", str(path.getsize(file_path))))
+        :param scratch_directory: The absolute path to the directory where the
+            files are generated.
+        :type scratch_directory: :class:`basestring`
+        :raises BadRootError: If the scratch directory is not an existing
+            directory or is contained in a symbolic link
 
-    if encoding:
-        headers.append(("Content-Encoding", encoding))
+        """
+        self._scratch_directory = _validate_root_directory(scratch_directory)
 
+    def __call__(self, environ, start_response):
+        """
+        Send the file in ``environ`` if and only if it's in the scratch
+        directory.
 
-# { Auth token application
+        """
+        # Symbolic links are resolved so that the Web server can never be told
+        # to delete a file outside of the scratch directory:
+        file_path = path.realpath(environ['xsendfile.requested_file'])
+        if not file_path.startswith(self._scratch_directory + os.sep):
+            response = _FORBIDDEN_RESPONSE
+        elif not path.isfile(file_path):
+            response = _NOT_FOUND_RESPONSE
+        else:
+            environ['xsendfile.requested_file'] = file_path
+            response = super(_TemporarySendfile, self).__call__
+        return response(environ, start_response)
 
 
-class TokenConfig(object):
+class XSendfileTemporary(_TemporarySendfile):
     """
-    Configuration object for a protected directory.
+    File sender for generated files with the ``X-Sendfile-Temporary`` header in
+    Apache's mod_xsendfile, which deletes the file once it's been sent.
 
     """
 
-    def __init__(self, secret, hash_algo="md5", timeout=120):
-        """
+    file_path_header = "X-Sendfile-Temporary"
 
-        :param secret: The secret string shared by the application that
-            generates the links and the WSGI application that serves the files.
-        :type secret: :class:`basestring`
-        :param hash_algo: The name of the built-in hashing algorithm to use or
-            a callable that returns the required (hexadecimal) digest.
-        :type hash_algo: :class:`basestring` or callable
-        :param timeout: The time during which a token is valid (in seconds)
-        :type timeout: :class:`int`
+    def get_file_path(self, environ):
+        """Return the requested file in the ``environ`` as is."""
+        return environ['xsendfile.requested_file']
 
-        .. versionchanged:: 1.0rc1
 
-            Removed ability to use a custom character encoding.
+class NginxSendfileTemporary(_TemporarySendfile):
+    """
+    File sender for generated files with the Nginx' X-Sendfile equivalent.
 
-        """
-        self._secret = secret
-        self._timeout = timedelta(seconds=timeout)
+    Nginx cannot delete the files once they've been sent, so the files in the
+    scratch directory which are older than ``max_age`` are deleted
+    periodically in a background thread.
 
-        if callable(hash_algo):
-            self._hash_algo = hash_algo
-        else:
-            # It must be an string representing a built-in hashing algorithm,
-            # otherwise an exception would be raised:
-            hashlib.new(hash_algo)
-            self._hash_algo = _BuiltinHashWrapper(hash_algo)
+    """
 
-    def is_valid_digest(self, digest, file_name, time):
+    file_path_header = "X-Accel-Redirect"
+
+    def __init__(self, scratch_directory, redirect_location="/-temporary-",
+                 max_age=3600, cleanup_interval=60):
         """
-        Report whether ``digest`` is the valid digest for ``file_name`` and
-        ``time``.
 
-        :param digest: The (hexadecimal) digest string.
-        :type digest: :class:`basestring`
-        :param file_name: The path to the file, which could not exist.
-        :type file_name: :class:`basestring`
-        :param time: The time supposedly associated to the ``digest``.
-        :type time: :class:`datetime.datetime`
-        :rtype: :class:`bool`
+        :param scratch_directory: The absolute path to the directory where the
+            files are generated.
+        :type scratch_directory: :class:`basestring`
+        :param redirect_location: The path to the internal location of the
+            scratch directory.
+        :param max_age: The time after which a generated file is deleted (in
+            seconds), which must be longer than the slowest download.
+        :type max_age: :class:`int`
+        :param cleanup_interval: The minimum time between clean-ups (in
+            seconds).
+        :type cleanup_interval: :class:`int`
+        :raises BadRootError: If the scratch directory is not an existing
+            directory or is contained in a symbolic link
 
         """
-        hex_timestamp = self._to_hex_timestamp(time)
-        expected_digest = self._get_digest(file_name, hex_timestamp)
+        super(NginxSendfileTemporary, self).__init__(scratch_directory)
+        self._redirect_location = redirect_location
+        self._max_age = max_age
+        self._cleanup_interval = cleanup_interval
 
-        return expected_digest == digest
+        self._lock = threading.Lock()
+        self._next_cleanup_time = 0
 
-    def is_current(self, generation_time):
+    def __call__(self, environ, start_response):
         """
-        Report whether a token ``generation_time`` is considered as expired.
-
-        :param generation_time: The time when a URL was generated.
-        :type generation_time: :class:`datetime.datetime`
-        :rtype: :class:`bool`
+        Send the file in ``environ`` and start a clean-up of the scratch
+        directory if it's due.
 
         """
-        deadline = generation_time + self._timeout
-        now = datetime.now()
+        self._schedule_cleanup()
+        return super(NginxSendfileTemporary, self).__call__(
+            environ,
+            start_response,
+        )
 
-        return now <= deadline
+    def get_file_path(self, environ):
+        """
+        Return the path to the requested file under the internal location.
 
-    def get_url_path(self, file_name):  # pragma:no cover
         """
-        Get the protected URL path for ``file_name``.
+        relative_file_path = \
+            environ['xsendfile.requested_file'][len(self._scratch_directory):]
+        return self._redirect_location + relative_file_path
 
-        :param file_name: The file to be served.
-        :type file_name: :class:`basestring`
-        :rtype: :class:`basestring`
+    def clean_up(self):
+        """Delete the generated files older than ``max_age``."""
+        oldest_time = get_current_time() - self._max_age
+        for directory_path, _, file_names in os.walk(self._scratch_directory):
+            for file_name in file_names:
+                file_path = path.join(directory_path, file_name)
+                try:
+                    if path.getmtime(file_path) < oldest_time:
+                        os.remove(file_path)
+                except OSError:
+                    # The file was deleted meanwhile:
+                    pass
 
-        """
-        # This method cannot be unit tested because its output depends on the
-        # time when it's called.
-        now = datetime.now()
-        return self._generate_url_path(file_name, now)
+    def _schedule_cleanup(self):
+        now = get_current_time()
+        if now < self._next_cleanup_time:
+            return
 
-    # { Internal utilities
+        with self._lock:
+            if now < self._next_cleanup_time:
+                return
+            self._next_cleanup_time = now + self._cleanup_interval
 
-    def _generate_url_path(self, file_name, time):
-        """Generate protected URL path for ``file_name``."""
-        hex_timestamp = self._to_hex_timestamp(time)
-        digest = self._get_digest(file_name, hex_timestamp)
+        cleanup_thread = threading.Thread(target=self.clean_up)
+        cleanup_thread.daemon = True
+        cleanup_thread.start()
 
-        urlencoded_file_name = _encode_path(file_name)
 
-        url_path = "/%s-%s/%s" % (digest, hex_timestamp, urlencoded_file_name)
+class DirectSendfile(object):
+    """
+    File sender which serves the file in the environ by itself.
+
+    The descriptors of the most recently served files are kept open and shared
+    by concurrent responses, which read from them at explicit offsets.
+
+    ``HEAD`` requests, conditional requests (``If-None-Match``, against the
+    ``ETag`` set when the content digest is known, and ``If-Modified-Since``)
+    and requests for a single byte range (``Range`` and ``If-Range``) are
+    supported. Requests for several ranges get the whole file.
+
+    """
+
+    def __init__(self, descriptor_cache_size=256, chunk_size=64 * 1024,
+                 content_cache_size=0, max_cached_file_size=64 * 1024,
+                 readahead_size=0, bandwidth_scheduler=None):
+        """
+
+        :param descriptor_cache_size: The maximum number of file descriptors to
+            keep open, which is further limited to a quarter of the soft
+            ``RLIMIT_NOFILE``; ``0`` disables the cache.
+        :type descriptor_cache_size: :class:`int`
+        :param chunk_size: The size of each chunk in the response body.
+        :type chunk_size: :class:`int`
+        :param content_cache_size: The maximum number of bytes to keep in
+            memory from the most recently served small files; ``0`` disables
+            the cache.
+        :type content_cache_size: :class:`int`
+        :param max_cached_file_size: The size of the largest file whose
+            contents can be kept in memory.
+        :type max_cached_file_size: :class:`int`
+        :param readahead_size: The number of bytes at the start of the file
+            that the kernel should start reading into the page cache before
+            the headers are sent, in addition to a hint that the file will be
+            read sequentially; ``0`` disables the hints.
+        :type readahead_size: :class:`int`
+        :param bandwidth_scheduler: The scheduler that shapes the bandwidth
+            used by the responses, if any. Files served from memory are not
+            shaped.
+        :type bandwidth_scheduler: :class:`BandwidthScheduler`
+
+        """
+        if _pread is None:  # pragma:no cover
+            # Descriptors cannot be shared without reading at explicit offsets:
+            descriptor_cache_size = 0
+
+        max_open_files = _get_max_open_files()
+        if max_open_files is not None:
+            descriptor_cache_size = \
+                min(descriptor_cache_size, max_open_files // 4)
+
+        self._descriptor_cache = _FileDescriptorCache(descriptor_cache_size)
+        self._chunk_size = chunk_size
+        self._readahead_size = readahead_size
+        self._bandwidth_scheduler = bandwidth_scheduler
+
+        if content_cache_size:
+            self._content_cache = _FileContentCache(
+                content_cache_size,
+                max_cached_file_size,
+            )
+        else:
+            self._content_cache = None
+
+    def __call__(self, environ, start_response):
+        """Send the contents of the file in ``environ``."""
+        file_path = environ['xsendfile.requested_file']
+        file_stat = environ.get('xsendfile.requested_file_stat')
+
+        try:
+            content_cache = self._content_cache
+            if content_cache is not None:
+                if file_stat is None:
+                    file_stat = os.stat(file_path)
+
+                if content_cache.is_cacheable(file_stat):
+                    return self._send_cached_contents(
+                        environ,
+                        file_path,
+                        file_stat,
+                        start_response,
+                    )
+
+            file_descriptor = \
+                self._descriptor_cache.acquire(file_path, file_stat)
+        except OSError as exc:
+            if exc.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            # The file was removed after it was looked up:
+            return _NOT_FOUND_RESPONSE(environ, start_response)
+
+        is_body_pending = False
+        try:
+            status, headers, byte_range = _get_partial_response(
+                environ,
+                file_path,
+                file_descriptor.file_stat,
+            )
+            if byte_range is not None and self._readahead_size:
+                _advise_readahead(
+                    file_descriptor.descriptor,
+                    self._readahead_size,
+                    is_sequential=True,
+                )
+
+            start_response(status, headers)
+            is_body_pending = byte_range is not None
+        finally:
+            # The body iterator releases the descriptor otherwise:
+            if not is_body_pending:
+                self._descriptor_cache.release(file_descriptor)
+
+        if byte_range is None:
+            # There's no body to send:
+            return []
+
+        offset, length = byte_range
+        return _FileDescriptorIterator(
+            self._descriptor_cache,
+            file_descriptor,
+            self._chunk_size,
+            self._bandwidth_scheduler,
+            offset,
+            length,
+        )
+
+    def prewarm(self, file_path, file_stat):
+        """
+        Load the file in ``file_path`` into the caches, as if it had been
+        requested.
+
+        """
+        content_cache = self._content_cache
+        if content_cache is not None and content_cache.is_cacheable(file_stat):
+            self._get_cached_contents(file_path, file_stat)
+        else:
+            file_descriptor = \
+                self._descriptor_cache.acquire(file_path, file_stat)
+            self._descriptor_cache.release(file_descriptor)
+
+    def _send_cached_contents(self, environ, file_path, file_stat,
+                              start_response):
+        file_stat, file_contents = \
+            self._get_cached_contents(file_path, file_stat)
+
+        status, headers, byte_range = \
+            _get_partial_response(environ, file_path, file_stat)
+        start_response(status, headers)
+
+        if byte_range is None:
+            return []
+        offset, length = byte_range
+        return [file_contents[offset:offset + length]]
+
+    def _get_cached_contents(self, file_path, file_stat):
+        """
+        Return the status and the contents of the file in ``file_path``,
+        after caching them if necessary.
+
+        """
+        file_contents = self._content_cache.get(file_path, file_stat)
+        if file_contents is None:
+            file_descriptor = \
+                self._descriptor_cache.acquire(file_path, file_stat)
+            try:
+                file_stat = file_descriptor.file_stat
+                file_contents = _read_exactly(
+                    file_descriptor.descriptor,
+                    file_stat.st_size,
+                    0,
+                )
+            finally:
+                self._descriptor_cache.release(file_descriptor)
+
+            self._content_cache.set(file_path, file_stat, file_contents)
+
+        return file_stat, file_contents
+
+
+def _get_partial_response(environ, file_path, file_stat):
+    """
+    Return the status and the headers of the response for the file in
+    ``file_path``, and the offset and the length of the bytes to send in the
+    body (or :data:`None` if there's no body), depending on the method and the
+    conditional and range headers of the request.
+
+    """
+    content_digest = environ.get('xsendfile.content_digest')
+    headers = []
+    _complete_headers(
+        file_path,
+        headers,
+        file_stat,
+        content_digest,
+        environ.get('xsendfile.content_type'),
+    )
+
+    last_modified = formatdate(int(file_stat.st_mtime), usegmt=True)
+    headers.append(("Last-Modified", last_modified))
+    headers.append(("Accept-Ranges", "bytes"))
+
+    entity_tag = None
+    if content_digest is not None:
+        entity_tag = '"%s"' % content_digest.digest
+
+    if not _is_modified(environ, entity_tag, file_stat):
+        not_modified_headers = [
+            (name, value) for (name, value) in headers
+            if name in ("ETag", "Last-Modified")
+        ]
+        return "304 Not Modified", not_modified_headers, None
+
+    file_size = file_stat.st_size
+    byte_range = (0, file_size)
+    status = "200 OK"
+
+    range_header = environ.get('HTTP_RANGE')
+    if_range_header = environ.get('HTTP_IF_RANGE')
+    if range_header and \
+            if_range_header in (None, entity_tag, last_modified):
+        requested_byte_range = _parse_byte_range(range_header, file_size)
+        if requested_byte_range is _UNSATISFIABLE_BYTE_RANGE:
+            headers = [
+                ("Content-Range", "bytes */%s" % file_size),
+                ("Content-Length", "0"),
+            ]
+            return "416 Range Not Satisfiable", headers, None
+
+        if requested_byte_range is not None:
+            byte_range = requested_byte_range
+            offset, length = byte_range
+            headers = [
+                (name, value) for (name, value) in headers
+                # The digest of the whole file doesn't match the body:
+                if name not in ("Content-Length", "Content-Digest")
+            ]
+            headers.append(("Content-Length", str(length)))
+            headers.append((
+                "Content-Range",
+                "bytes %s-%s/%s" % (offset, offset + length - 1, file_size),
+            ))
+            status = "206 Partial Content"
+
+    if environ.get('REQUEST_METHOD', "GET").upper() == "HEAD":
+        byte_range = None
+
+    return status, headers, byte_range
+
+
+def _is_modified(environ, entity_tag, file_stat):
+    """
+    Report whether the file has changed since the version cached by the
+    client, if any.
+
+    """
+    if_none_match_header = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match_header is not None:
+        if if_none_match_header.strip() == "*":
+            return False
+
+        if entity_tag is None:
+            return True
+
+        for requested_entity_tag in if_none_match_header.split(","):
+            requested_entity_tag = requested_entity_tag.strip()
+            if requested_entity_tag.startswith("W/"):
+                requested_entity_tag = requested_entity_tag[2:]
+            if requested_entity_tag == entity_tag:
+                return False
+        return True
+
+    if_modified_since_header = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since_header is not None:
+        if_modified_since = parsedate_tz(if_modified_since_header)
+        if if_modified_since is not None and \
+                int(file_stat.st_mtime) <= mktime_tz(if_modified_since):
+            return False
+
+    return True
+
+
+def _parse_byte_range(range_header, file_size):
+    """
+    Return the offset and the length of the single byte range in
+    ``range_header``, :data:`_UNSATISFIABLE_BYTE_RANGE` if it's outside of
+    the file, or :data:`None` if the header should be ignored (i.e., it's
+    invalid or it has several ranges).
+
+    """
+    unit, _, byte_ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in byte_ranges:
+        return None
+
+    first_byte, separator, last_byte = byte_ranges.strip().partition("-")
+    if not separator or not (first_byte or last_byte) or \
+            not (first_byte or "0").isdigit() or \
+            not (last_byte or "0").isdigit():
+        return None
+
+    if not first_byte:
+        # The last bytes of the file:
+        suffix_length = int(last_byte)
+        if not suffix_length or not file_size:
+            return _UNSATISFIABLE_BYTE_RANGE
+        offset = max(file_size - suffix_length, 0)
+        return offset, file_size - offset
+
+    offset = int(first_byte)
+    if last_byte:
+        last_byte = int(last_byte)
+        if last_byte < offset:
+            return None
+    else:
+        last_byte = file_size - 1
+
+    if file_size <= offset:
+        return _UNSATISFIABLE_BYTE_RANGE
+
+    return offset, min(last_byte, file_size - 1) - offset + 1
+
+
+_UNSATISFIABLE_BYTE_RANGE = object()
+
+
+class SizeAwareSendfile(object):
+    """
+    File sender which serves small files by itself and offloads the others to
+    the Web server.
+
+    The decision for each request is set in the environ, under
+    ``xsendfile.sender_decision``, as ``inline`` or ``offload``, and the
+    sender picked under ``xsendfile.file_sender``.
+
+    """
+
+    def __init__(self, offloading_sender=None, inline_sender=None,
+                 max_inline_file_size=64 * 1024):
+        """
+
+        :param offloading_sender: The sender for the files larger than
+            ``max_inline_file_size``; defaults to the standard X-Sendfile.
+        :type offloading_sender: :class:`XSendfile`,
+            :class:`NginxSendfile` or a WSGI application
+        :param inline_sender: The sender for the other files; defaults to
+            :class:`DirectSendfile` with their contents cached in memory.
+        :type inline_sender: :class:`DirectSendfile` or a WSGI application
+        :param max_inline_file_size: The size of the largest file to be served
+            by ``inline_sender``.
+        :type max_inline_file_size: :class:`int`
+
+        """
+        if offloading_sender is None:
+            offloading_sender = XSendfile()
+
+        if inline_sender is None:
+            inline_sender = DirectSendfile(
+                content_cache_size=256 * max_inline_file_size,
+                max_cached_file_size=max_inline_file_size,
+            )
+
+        self._offloading_sender = offloading_sender
+        self._inline_sender = inline_sender
+        self._max_inline_file_size = max_inline_file_size
+
+    def __call__(self, environ, start_response):
+        """Send the file in ``environ`` with the sender for its size."""
+        file_stat = environ.get('xsendfile.requested_file_stat')
+        if file_stat is None:
+            file_stat = os.stat(environ['xsendfile.requested_file'])
+            environ['xsendfile.requested_file_stat'] = file_stat
+
+        if file_stat.st_size <= self._max_inline_file_size:
+            environ['xsendfile.sender_decision'] = "inline"
+            sender = self._inline_sender
+        else:
+            environ['xsendfile.sender_decision'] = "offload"
+            sender = self._offloading_sender
+
+        environ['xsendfile.file_sender'] = sender
+        return sender(environ, start_response)
+
+
+class _FileDescriptorCache(object):
+    """
+    LRU cache of read-only file descriptors, which are reference-counted so
+    that they remain open while any response is using them.
+
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._file_descriptors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, file_path, file_stat=None):
+        """
+        Return an open descriptor for ``file_path``, reopening the file if it
+        changed since it was cached.
+
+        """
+        with self._lock:
+            file_descriptor = self._file_descriptors.get(file_path)
+            if file_descriptor is not None:
+                if file_stat is not None and \
+                        file_descriptor.is_stale(file_stat):
+                    self._discard(file_path)
+                else:
+                    self._file_descriptors[file_path] = \
+                        self._file_descriptors.pop(file_path)
+                    file_descriptor.reference_count += 1
+                    return file_descriptor
+
+        file_descriptor = _CachedFileDescriptor(file_path)
+        file_descriptor.reference_count += 1
+
+        if self._max_size:
+            with self._lock:
+                if file_path in self._file_descriptors:
+                    self._discard(file_path)
+                self._file_descriptors[file_path] = file_descriptor
+                while self._max_size < len(self._file_descriptors):
+                    self._discard(next(iter(self._file_descriptors)))
+        else:
+            file_descriptor.is_evicted = True
+
+        return file_descriptor
+
+    def release(self, file_descriptor):
+        """Signal that a response no longer uses ``file_descriptor``."""
+        with self._lock:
+            file_descriptor.reference_count -= 1
+            if file_descriptor.is_evicted and \
+                    not file_descriptor.reference_count:
+                file_descriptor.close()
+
+    def invalidate(self, file_path):
+        """Discard the descriptor for ``file_path``, if any."""
+        with self._lock:
+            if file_path in self._file_descriptors:
+                self._discard(file_path)
+
+    def clear(self):
+        """Discard all the descriptors."""
+        with self._lock:
+            for file_path in list(self._file_descriptors):
+                self._discard(file_path)
+
+    def _discard(self, file_path):
+        file_descriptor = self._file_descriptors.pop(file_path)
+        file_descriptor.is_evicted = True
+        if not file_descriptor.reference_count:
+            file_descriptor.close()
+
+
+class _FileContentCache(object):
+    """
+    LRU cache of the contents of small files, bounded by the total number of
+    bytes kept in memory.
+
+    """
+
+    def __init__(self, max_size, max_file_size):
+        self._max_size = max_size
+        self._max_file_size = min(max_file_size, max_size)
+        self._size = 0
+        self._file_contents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_cacheable(self, file_stat):
+        """Report whether the file with ``file_stat`` fits in the cache."""
+        return file_stat.st_size <= self._max_file_size
+
+    def get(self, file_path, file_stat):
+        """
+        Return the contents of ``file_path``, or :data:`None` if they're not
+        cached or the file changed since they were cached.
+
+        """
+        with self._lock:
+            cache_entry = self._file_contents.pop(file_path, None)
+            if cache_entry is None:
+                return None
+
+            file_signature, file_contents = cache_entry
+            if file_signature != _get_file_signature(file_stat):
+                self._size -= len(file_contents)
+                return None
+
+            self._file_contents[file_path] = cache_entry
+
+        return file_contents
+
+    def set(self, file_path, file_stat, file_contents):
+        """Cache ``file_contents`` if the file hasn't changed meanwhile."""
+        if len(file_contents) != file_stat.st_size or \
+                self._max_file_size < len(file_contents):
+            return
+
+        cache_entry = (_get_file_signature(file_stat), file_contents)
+        with self._lock:
+            self._discard(file_path)
+            self._file_contents[file_path] = cache_entry
+            self._size += len(file_contents)
+            while self._max_size < self._size:
+                self._discard(next(iter(self._file_contents)))
+
+    def invalidate(self, file_path):
+        """Discard the contents of ``file_path``, if cached."""
+        with self._lock:
+            self._discard(file_path)
+
+    def clear(self):
+        """Discard the contents of all the files."""
+        with self._lock:
+            self._file_contents.clear()
+            self._size = 0
+
+    def _discard(self, file_path):
+        cache_entry = self._file_contents.pop(file_path, None)
+        if cache_entry is not None:
+            self._size -= len(cache_entry[1])
+
+
+def _get_file_signature(file_stat):
+    return (
+        file_stat.st_ino,
+        file_stat.st_dev,
+        file_stat.st_size,
+        file_stat.st_mtime,
+    )
+
+
+class _CachedFileDescriptor(object):
+
+    def __init__(self, file_path):
+        self.descriptor = os.open(
+            file_path,
+            os.O_RDONLY | getattr(os, "O_CLOEXEC", 0),
+        )
+        self.file_stat = os.fstat(self.descriptor)
+        self.reference_count = 0
+        self.is_evicted = False
+
+    def is_stale(self, file_stat):
+        return _get_file_signature(file_stat) != \
+            _get_file_signature(self.file_stat)
+
+    def close(self):
+        os.close(self.descriptor)
+
+
+class _FileDescriptorIterator(object):
+    """
+    WSGI response body which reads the file in ``file_descriptor`` at explicit
+    offsets, so the descriptor can be shared by concurrent responses.
+
+    """
+
+    def __init__(self, descriptor_cache, file_descriptor, chunk_size,
+                 bandwidth_scheduler=None, offset=0, length=None):
+        self._descriptor_cache = descriptor_cache
+        self._file_descriptor = file_descriptor
+        self._chunk_size = chunk_size
+        self._bandwidth_scheduler = bandwidth_scheduler
+        self._offset = offset
+        if length is None:
+            length = file_descriptor.file_stat.st_size - offset
+        self._length = length
+        self._bandwidth_stream = None
+        self._is_closed = False
+
+    def __iter__(self):
+        # The response only takes a share of the bandwidth once it's being
+        # sent:
+        if self._bandwidth_scheduler is not None:
+            self._bandwidth_stream = self._bandwidth_scheduler.open_stream()
+
+        try:
+            for chunk in self._read_chunks():
+                yield chunk
+        finally:
+            self._close_bandwidth_stream()
+
+    def _read_chunks(self):
+        descriptor = self._file_descriptor.descriptor
+        remaining_size = self._length
+        offset = self._offset
+        while 0 < remaining_size:
+            chunk_size = min(self._chunk_size, remaining_size)
+            if self._bandwidth_stream is not None:
+                self._bandwidth_stream.reserve(chunk_size)
+
+            chunk = _read_at(descriptor, chunk_size, offset)
+            if not chunk:
+                # The response can't match its Content-Length any longer, so
+                # the server must abort it:
+                raise IOError("The file shrank while it was being sent")
+            offset += len(chunk)
+            remaining_size -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self._close_bandwidth_stream()
+        if not self._is_closed:
+            self._is_closed = True
+            self._descriptor_cache.release(self._file_descriptor)
+
+    def _close_bandwidth_stream(self):
+        if self._bandwidth_stream is not None:
+            self._bandwidth_stream.close()
+
+
+class BandwidthScheduler(object):
+    """
+    Scheduler which shapes the bandwidth used by the responses of
+    :class:`DirectSendfile`, so that a few large downloads can't starve the
+    others.
+
+    The total rate is enforced by a token bucket shared by all the responses,
+    so the bursts of new responses are taken from the same budget. Each
+    response also has its own token bucket, which is refilled at its share of
+    the total rate: The total rate is shared equally by the responses which
+    sent a chunk recently, so that the responses whose clients stopped reading
+    don't hold a share. The budget for each chunk is taken from the buckets
+    before the chunk is read, and the response waits for the buckets to refill
+    when they're exhausted.
+
+    """
+
+    # The time after its last chunk during which a response holds a share of
+    # the total rate (in seconds):
+    _ACTIVITY_PERIOD = 1
+
+    def __init__(self, rate=None, response_rate=None, burst_size=256 * 1024):
+        """
+
+        :param rate: The maximum number of bytes per second sent by all the
+            responses together, if any.
+        :type rate: :class:`int`
+        :param response_rate: The maximum number of bytes per second sent by
+            each response, if any.
+        :type response_rate: :class:`int`
+        :param burst_size: The number of bytes that can be sent without
+            waiting, by all the responses together and by each of them, which
+            is also the number of bytes that can be saved up while the
+            responses are not being read.
+        :type burst_size: :class:`int`
+
+        """
+        self._rate = rate
+        self._response_rate = response_rate
+        self._burst_size = burst_size
+
+        self._lock = threading.Lock()
+        self._streams = set()
+        self._tokens = burst_size
+        self._refill_time = get_monotonic_time()
+
+    def open_stream(self):
+        """
+        Return the token bucket of a new response, which shares the total rate
+        until it's closed.
+
+        """
+        current_time = get_monotonic_time()
+        stream = _BandwidthStream(self, self._burst_size, current_time)
+        stream.active_until = current_time + self._ACTIVITY_PERIOD
+        with self._lock:
+            self._streams.add(stream)
+        return stream
+
+    def _close_stream(self, stream):
+        with self._lock:
+            self._streams.discard(stream)
+
+    def _reserve(self, stream, byte_count, current_time):
+        """
+        Take ``byte_count`` bytes from the shared bucket and the bucket of
+        ``stream``, and return the time to wait (in seconds) before sending
+        them.
+
+        The buckets can go into debt, so that a chunk larger than the burst
+        size is sent after a proportional wait, and the chunks of concurrent
+        responses are spread over time.
+
+        """
+        with self._lock:
+            stream_rate = self._get_stream_rate(stream, current_time)
+            if stream_rate is None:
+                return 0
+
+            delay = 0
+            if self._rate is not None:
+                self._tokens = min(
+                    self._burst_size,
+                    self._tokens +
+                    (current_time - self._refill_time) * self._rate,
+                )
+                self._refill_time = current_time
+                self._tokens -= byte_count
+                if self._tokens < 0:
+                    delay = -self._tokens / float(self._rate)
+
+            stream.tokens = min(
+                self._burst_size,
+                stream.tokens +
+                (current_time - stream.refill_time) * stream_rate,
+            )
+            stream.refill_time = current_time
+            stream.tokens -= byte_count
+            if stream.tokens < 0:
+                delay = max(delay, -stream.tokens / float(stream_rate))
+
+            stream.active_until = \
+                current_time + delay + self._ACTIVITY_PERIOD
+
+        return delay
+
+    def _get_stream_rate(self, stream, current_time):
+        stream_rates = []
+        if self._rate is not None:
+            active_stream_count = 1
+            for other_stream in self._streams:
+                if other_stream is not stream and \
+                        current_time <= other_stream.active_until:
+                    active_stream_count += 1
+            stream_rates.append(self._rate / float(active_stream_count))
+        if self._response_rate is not None:
+            stream_rates.append(self._response_rate)
+
+        return min(stream_rates) if stream_rates else None
+
+
+class _BandwidthStream(object):
+    """The token bucket of a response in :class:`BandwidthScheduler`."""
+
+    def __init__(self, scheduler, tokens, refill_time):
+        self._scheduler = scheduler
+        self.tokens = tokens
+        self.refill_time = refill_time
+        self.active_until = refill_time
+        self._is_closed = False
+
+    def reserve(self, byte_count):
+        """Wait until ``byte_count`` bytes can be sent."""
+        delay = self._scheduler._reserve(
+            self,
+            byte_count,
+            get_monotonic_time(),
+        )
+        if delay:
+            sleep(delay)
+
+    def close(self):
+        if not self._is_closed:
+            self._is_closed = True
+            self._scheduler._close_stream(self)
+
+
+_pread = getattr(os, "pread", None)
+
+
+def _read_at(descriptor, size, offset):
+    if _pread is not None:
+        return _pread(descriptor, size, offset)
+
+    # The descriptor is never shared in this case:
+    os.lseek(descriptor, offset, os.SEEK_SET)  # pragma:no cover
+    return os.read(descriptor, size)  # pragma:no cover
+
+
+def _read_exactly(descriptor, size, offset):
+    """
+    Read ``size`` bytes at ``offset``, even if they're returned in several
+    reads.
+
+    :raises IOError: If the file ends before.
+
+    """
+    chunks = []
+    while 0 < size:
+        chunk = _read_at(descriptor, size, offset)
+        if not chunk:
+            raise IOError("The file shrank while it was being read")
+        chunks.append(chunk)
+        offset += len(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+_posix_fadvise = getattr(os, "posix_fadvise", None)
+
+
+def _advise_readahead(descriptor, readahead_size, is_sequential=False):
+    """
+    Hint the kernel to start reading the first ``readahead_size`` bytes of the
+    file in ``descriptor`` into the page cache.
+
+    """
+    if _posix_fadvise is None:  # pragma:no cover
+        return
+
+    try:
+        if is_sequential:
+            _posix_fadvise(descriptor, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        _posix_fadvise(descriptor, 0, readahead_size, os.POSIX_FADV_WILLNEED)
+    except OSError:  # pragma:no cover
+        # The file system doesn't support the hints:
+        pass
+
+
+def _prefetch_file(file_path, readahead_size):
+    if _posix_fadvise is None:  # pragma:no cover
+        return
+
+    try:
+        descriptor = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        _advise_readahead(descriptor, readahead_size)
+    finally:
+        os.close(descriptor)
+
+
+def _get_max_open_files():
+    if resource is None:  # pragma:no cover
+        return None
+
+    soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft_limit == resource.RLIM_INFINITY:
+        return None
+    return soft_limit
+
+
+def _complete_headers(file_path, headers, file_stat=None,
+                      content_digest=None, content_type=None):
+    """
+    Add the MIME type, length and encoding HTTP headers associated to the file
+    in ``file_path``.
+
+    The size of the file is taken from ``file_stat`` when available, the MIME
+    type and the encoding from ``content_type`` when already resolved, and the
+    strong ``ETag`` and the ``Digest`` headers are added when the
+    ``content_digest`` is known.
+
+    """
+    if content_type is None:
+        content_type = _DEFAULT_CONTENT_TYPE_RESOLVER.resolve(file_path)
+    mime_type, encoding = content_type
+
+    if not mime_type:
+        mime_type = "application/octet-stream"
+
+    if file_stat is None:
+        file_size = path.getsize(file_path)
+    else:
+        file_size = file_stat.st_size
+
+    headers.append(("Content-Type", mime_type))
+    headers.append(("Content-Length", str(file_size)))
+
+    if encoding:
+        headers.append(("Content-Encoding", encoding))
+
+    if content_digest is not None:
+        headers.extend(content_digest.headers)
+
+
+# { Content types
+
+
+class ContentTypeResolver(object):
+    """
+    Resolver of the MIME type and encoding of the files served, from their
+    extensions.
+
+    The table of extensions is built once, when the resolver is created, from
+    the types built into Python, so the types are the same on every host
+    unless ``use_system_types`` is set.
+
+    """
+
+    def __init__(self, mime_types=None, use_system_types=False,
+                 sniff_unknown_types=False):
+        """
+
+        :param mime_types: The MIME type for each extension (e.g.,
+            ``{".log": "text/plain"}``), which take precedence over the
+            built-in types.
+        :type mime_types: :class:`dict`
+        :param use_system_types: Whether to include the types in the system
+            files listed in :data:`mimetypes.knownfiles` (e.g.,
+            ``/etc/mime.types``).
+        :type use_system_types: :class:`bool`
+        :param sniff_unknown_types: Whether to look for the MIME type in the
+            first bytes of the files whose extension is unknown. The result is
+            cached until the file changes.
+        :type sniff_unknown_types: :class:`bool`
+
+        """
+        if use_system_types:
+            file_names = [
+                file_name
+                for file_name in mimetypes.knownfiles
+                if path.isfile(file_name)
+            ]
+            mime_types_database = mimetypes.MimeTypes(file_names)
+            types_map = mime_types_database.types_map[True]
+            encodings_map = mime_types_database.encodings_map
+            suffix_map = mime_types_database.suffix_map
+        else:
+            types_map, encodings_map, suffix_map = _get_built_in_mime_types()
+
+        types_by_extension = dict(types_map)
+        for extension, mime_type in (mime_types or {}).items():
+            types_by_extension[extension.lower()] = mime_type
+
+        self._types_by_extension = types_by_extension
+        self._encodings_by_extension = dict(encodings_map)
+        self._suffixes_by_extension = dict(suffix_map)
+
+        # The result for the encodings and the aliases of compound extensions
+        # (e.g., ".tgz") also depends on the previous extension, if any:
+        self._compound_extensions = frozenset(
+            list(self._encodings_by_extension) +
+            list(self._suffixes_by_extension),
+        )
+        self._content_types_by_extension = dict(
+            (extension, self._resolve_suffix(extension))
+            for extension in types_by_extension
+            if extension not in self._compound_extensions
+        )
+        self._memoized_content_types = {}
+
+        self._sniff_unknown_types = sniff_unknown_types
+        self._sniffed_content_types = {}
+
+    def resolve(self, file_path, file_stat=None):
+        """
+        Return the MIME type and encoding of the file in ``file_path``.
+
+        The status of the file, if available, saves a call to ``stat()`` when
+        the type has to be sniffed.
+
+        :return: The MIME type and the encoding, each of which is :data:`None`
+            if unknown.
+        :rtype: :class:`tuple`
+
+        """
+        file_root, suffix = path.splitext(file_path)
+        suffix = suffix.lower()
+        if suffix in self._compound_extensions:
+            suffix = path.splitext(file_root)[1].lower() + suffix
+            content_type = None
+        else:
+            content_type = self._content_types_by_extension.get(suffix)
+
+        if content_type is None:
+            memoized_content_types = self._memoized_content_types
+            content_type = memoized_content_types.get(suffix)
+            if content_type is None:
+                content_type = self._resolve_suffix(suffix)
+                if len(memoized_content_types) >= _MAX_MEMOIZED_PATHS:
+                    memoized_content_types.clear()
+                memoized_content_types[suffix] = content_type
+
+        if content_type == (None, None) and self._sniff_unknown_types:
+            content_type = self._sniff_content_type(file_path, file_stat)
+
+        return content_type
+
+    def _resolve_suffix(self, suffix):
+        """
+        Return the MIME type and encoding for the extensions in ``suffix``, in
+        the same way as :func:`mimetypes.guess_type`.
+
+        """
+        file_root, extension = path.splitext("_" + suffix)
+        while extension in self._suffixes_by_extension:
+            file_root, extension = path.splitext(
+                file_root + self._suffixes_by_extension[extension],
+            )
+
+        encoding = self._encodings_by_extension.get(extension)
+        if encoding is not None:
+            file_root, extension = path.splitext(file_root)
+
+        mime_type = self._types_by_extension.get(extension) or \
+            self._types_by_extension.get(extension.lower())
+        return mime_type, encoding
+
+    def _sniff_content_type(self, file_path, file_stat):
+        if file_stat is None:
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                return None, None
+
+        cache_key = (file_path, _get_file_signature(file_stat))
+        sniffed_content_types = self._sniffed_content_types
+        mime_type = sniffed_content_types.get(cache_key)
+        if mime_type is None:
+            try:
+                with open(file_path, "rb") as file_:
+                    file_prefix = file_.read(_MAX_FILE_SIGNATURE_SIZE)
+            except (IOError, OSError):
+                return None, None
+
+            mime_type = ""
+            for file_signature_re, signature_mime_type in _FILE_SIGNATURES:
+                if file_signature_re.match(file_prefix):
+                    mime_type = signature_mime_type
+                    break
+
+            if len(sniffed_content_types) >= _MAX_MEMOIZED_PATHS:
+                sniffed_content_types.clear()
+            sniffed_content_types[cache_key] = mime_type
+
+        return mime_type or None, None
+
+
+_FILE_SIGNATURES = (
+    (re.compile(br"\x89PNG\r\n\x1a\n"), "image/png"),
+    (re.compile(br"\xff\xd8\xff"), "image/jpeg"),
+    (re.compile(br"GIF8[79]a"), "image/gif"),
+    (re.compile(br"RIFF.{4}WEBP", re.DOTALL), "image/webp"),
+    (re.compile(br"%PDF-"), "application/pdf"),
+    (re.compile(br"PK\x03\x04"), "application/zip"),
+    (re.compile(br"\x1f\x8b"), "application/gzip"),
+    (re.compile(br".{4}ftyp", re.DOTALL), "video/mp4"),
+    (re.compile(br"OggS"), "application/ogg"),
+    (re.compile(br"ID3"), "audio/mpeg"),
+)
+
+_MAX_FILE_SIGNATURE_SIZE = 16
+
+
+def _get_built_in_mime_types():
+    """
+    Return the types, encodings and suffixes built into :mod:`mimetypes`,
+    without calling :func:`mimetypes.init` (which reads the files of the
+    host).
+
+    """
+    types_map = getattr(mimetypes, "_types_map_default", None)
+    if types_map is None:  # pragma:no cover
+        # Python 2, where the module-level tables only have the built-in
+        # types until mimetypes.init() is called:
+        return (
+            mimetypes.types_map,
+            mimetypes.encodings_map,
+            mimetypes.suffix_map,
+        )
+
+    return (
+        types_map,
+        mimetypes._encodings_map_default,
+        mimetypes._suffix_map_default,
+    )
+
+
+_DEFAULT_CONTENT_TYPE_RESOLVER = ContentTypeResolver()
+
+
+# }
+
+
+# { Metadata caches
+
+
+class SharedMetadataCache(object):
+    """
+    Cache for the resolved paths and the status of the requested files, shared
+    by all the processes that map the same backing file.
+
+    The cache is a memory-mapped hash table with a fixed number of fixed-size
+    slots, so its total size is bounded. Each slot is protected by a sequence
+    lock: Readers never block and retry if the slot was updated while they
+    were reading it, whilst writers skip the update if another writer holds
+    the slot.
+
+    Workers pre-forked from the process that created the cache share it
+    without further configuration; unrelated processes can share it by
+    passing the same ``file_path``. The number and the size of the slots are
+    stored in the file, so the processes that don't set them use those of
+    the existing file.
+
+    """
+
+    _HEADER = struct.Struct("=4sII")
+
+    _HEADER_MAGIC = b"XSFC"
+
+    # Sequence number, key hash, expiry time, key length and value length:
+    _SLOT_HEADER = struct.Struct("=QQdHH")
+
+    _SEQUENCE = struct.Struct("=Q")
+
+    _VALUE_FLAGS = struct.Struct("=B")
+
+    # Mode, inode, device, links, UID, GID, size, atime, mtime and ctime, and
+    # the same times in nanoseconds:
+    _FILE_STAT = struct.Struct("=IQQQIIQdddqqq")
+
+    _DEFAULT_SLOT_COUNT = 4096
+
+    _DEFAULT_SLOT_SIZE = 512
+
+    _HAS_PATH_FLAG = 1
+
+    _HAS_STAT_FLAG = 2
+
+    def __init__(self, file_path=None, slot_count=None, slot_size=None,
+                 timeout=5):
+        """
+
+        :param file_path: The path to the file backing the cache; an anonymous
+            temporary file is used by default.
+        :type file_path: :class:`basestring`
+        :param slot_count: The number of entries in the cache; defaults to
+            that of the existing file, if any, or 4096.
+        :type slot_count: :class:`int`
+        :param slot_size: The maximum size of each entry (in bytes); defaults
+            to that of the existing file, if any, or 512.
+        :type slot_size: :class:`int`
+        :param timeout: The time during which an entry is valid (in seconds).
+        :type timeout: :class:`int`
+        :raises BadCacheFileError: If the file is not a metadata cache, or it
+            has a different number or size of slots than those set.
+
+        """
+        self._timeout = timeout
+        self._lock = threading.Lock()
+
+        if file_path is None:
+            from tempfile import TemporaryFile
+            self._file = TemporaryFile()
+        else:
+            file_descriptor = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._file = os.fdopen(file_descriptor, "r+b")
+
+        self._file_descriptor = self._file.fileno()
+        try:
+            self._mmap = self._map_file(slot_count, slot_size)
+        except BadCacheFileError:
+            self._file.close()
+            raise
+
+    @property
+    def timeout(self):
+        """
+        The time during which new entries are valid (in seconds); existing
+        entries keep their expiry time.
+
+        """
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._timeout = timeout
+
+    def get(self, key):
+        """
+        Return the absolute path and status for ``key``, or :data:`None` if
+        the entry is not cached.
+
+        """
+        key_bytes = key.encode("utf8")
+        key_hash, slot_offset = self._get_slot(key_bytes)
+
+        for _ in range(3):
+            slot = self._mmap[slot_offset:slot_offset + self._slot_size]
+            sequence, slot_key_hash, expiry, key_length, value_length = \
+                self._SLOT_HEADER.unpack_from(slot)
+
+            current_sequence = \
+                self._SEQUENCE.unpack_from(self._mmap, slot_offset)[0]
+            if sequence & 1 or sequence != current_sequence:
+                # The slot is being (or was just) written:
+                continue
+
+            if slot_key_hash != key_hash or expiry < get_current_time():
+                return None
+
+            key_offset = self._SLOT_HEADER.size
+            value_offset = key_offset + key_length
+            if slot[key_offset:value_offset] != key_bytes:
+                return None
+
+            value_bytes = slot[value_offset:value_offset + value_length]
+            return self._decode_value(value_bytes)
+
+        return None
+
+    def set(self, key, value):
+        """
+        Cache the absolute path and status in ``value`` for ``key``.
+
+        Entries that do not fit in a slot are not cached.
+
+        """
+        key_bytes = key.encode("utf8")
+        try:
+            value_bytes = self._encode_value(value)
+        except UnicodeError:
+            return
+
+        slot_header_size = self._SLOT_HEADER.size
+        payload = key_bytes + value_bytes
+        if self._slot_size < (slot_header_size + len(payload)):
+            return
+
+        key_hash, slot_offset = self._get_slot(key_bytes)
+        expiry = get_current_time() + self._timeout
+
+        def write_slot(sequence):
+            self._SLOT_HEADER.pack_into(
+                self._mmap,
+                slot_offset,
+                sequence,
+                key_hash,
+                expiry,
+                len(key_bytes),
+                len(value_bytes),
+            )
+            payload_offset = slot_offset + slot_header_size
+            self._mmap[payload_offset:payload_offset + len(payload)] = payload
+
+        self._write_slot(slot_offset, write_slot)
+
+    def invalidate(self, key):
+        """Remove the entry for ``key``, if any."""
+        key_bytes = key.encode("utf8")
+        slot_offset = self._get_slot(key_bytes)[1]
+
+        def clear_slot(sequence):
+            self._SLOT_HEADER.pack_into(
+                self._mmap, slot_offset, sequence, 0, 0, 0, 0)
+
+        self._write_slot(slot_offset, clear_slot)
+
+    def clear(self):
+        """Remove all the entries."""
+        for slot_index in range(self._slot_count):
+            slot_offset = self._HEADER.size + slot_index * self._slot_size
+
+            def clear_slot(sequence):
+                self._SLOT_HEADER.pack_into(
+                    self._mmap, slot_offset, sequence, 0, 0, 0, 0)
+
+            self._write_slot(slot_offset, clear_slot)
+
+    # { Internal utilities
+
+    def _map_file(self, slot_count, slot_size):
+        """
+        Map the file, after initializing it if it's new.
+
+        Files already initialized are never truncated, since other processes
+        may have mapped them and would crash when accessing the missing pages.
+
+        """
+        header_size = self._HEADER.size
+
+        self._lock_range(0, header_size, blocking=True)
+        try:
+            existing_header = os.read(self._file_descriptor, header_size)
+            if existing_header.strip(b"\0"):
+                if len(existing_header) != header_size:
+                    raise BadCacheFileError("The file is not a metadata cache")
+                magic, existing_slot_count, existing_slot_size = \
+                    self._HEADER.unpack(existing_header)
+                if magic != self._HEADER_MAGIC:
+                    raise BadCacheFileError("The file is not a metadata cache")
+                if slot_count not in (None, existing_slot_count) or \
+                        slot_size not in (None, existing_slot_size):
+                    raise BadCacheFileError(
+                        "The cache has %s slots of %s bytes" % (
+                            existing_slot_count,
+                            existing_slot_size,
+                        ),
+                    )
+                self._slot_count = existing_slot_count
+                self._slot_size = existing_slot_size
+                file_size = self._get_file_size()
+
+                if os.fstat(self._file_descriptor).st_size < file_size:
+                    # The file was extended by a process which died half-way
+                    # through:
+                    os.ftruncate(self._file_descriptor, file_size)
+            else:
+                # The file is new, or it was being initialized by a process
+                # which died before writing the header (so no other process
+                # could have mapped it):
+                self._slot_count = slot_count or self._DEFAULT_SLOT_COUNT
+                self._slot_size = slot_size or self._DEFAULT_SLOT_SIZE
+                file_size = self._get_file_size()
+
+                os.ftruncate(self._file_descriptor, 0)
+                os.ftruncate(self._file_descriptor, file_size)
+                os.lseek(self._file_descriptor, 0, os.SEEK_SET)
+                os.write(
+                    self._file_descriptor,
+                    self._HEADER.pack(
+                        self._HEADER_MAGIC,
+                        self._slot_count,
+                        self._slot_size,
+                    ),
+                )
+        finally:
+            self._unlock_range(0, header_size)
+
+        return mmap.mmap(self._file_descriptor, file_size)
+
+    def _get_file_size(self):
+        return self._HEADER.size + self._slot_count * self._slot_size
+
+    def _get_slot(self, key_bytes):
+        key_digest = hashlib.md5(key_bytes).digest()
+        key_hash = struct.unpack("=Q", key_digest[:8])[0]
+        slot_index = key_hash % self._slot_count
+        slot_offset = self._HEADER.size + slot_index * self._slot_size
+        return key_hash, slot_offset
+
+    def _write_slot(self, slot_offset, write):
+        with self._lock:
+            if not self._lock_range(slot_offset, self._slot_size):
+                # Another process is writing to the slot:
+                return
+
+            try:
+                sequence = \
+                    self._SEQUENCE.unpack_from(self._mmap, slot_offset)[0]
+                # Recover from any writer which died half-way through:
+                sequence += sequence & 1
+
+                self._SEQUENCE.pack_into(self._mmap, slot_offset, sequence + 1)
+                write(sequence + 1)
+                self._SEQUENCE.pack_into(self._mmap, slot_offset, sequence + 2)
+            finally:
+                self._unlock_range(slot_offset, self._slot_size)
+
+    def _lock_range(self, offset, length, blocking=False):
+        if fcntl is None:  # pragma:no cover
+            return True
+
+        lock_type = fcntl.LOCK_EX
+        if not blocking:
+            lock_type |= fcntl.LOCK_NB
+
+        try:
+            fcntl.lockf(self._file_descriptor, lock_type, length, offset)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def _unlock_range(self, offset, length):
+        if fcntl is not None:
+            fcntl.lockf(self._file_descriptor, fcntl.LOCK_UN, length, offset)
+
+    def _encode_value(self, value):
+        absolute_file_path, file_stat = value
+
+        flags = 0
+        encoded_value = b""
+        if file_stat is not None:
+            flags |= self._HAS_STAT_FLAG
+            encoded_value += self._FILE_STAT.pack(
+                file_stat.st_mode,
+                file_stat.st_ino,
+                file_stat.st_dev,
+                file_stat.st_nlink,
+                file_stat.st_uid,
+                file_stat.st_gid,
+                file_stat.st_size,
+                file_stat.st_atime,
+                file_stat.st_mtime,
+                file_stat.st_ctime,
+                _get_stat_time_ns(file_stat, "atime"),
+                _get_stat_time_ns(file_stat, "mtime"),
+                _get_stat_time_ns(file_stat, "ctime"),
+            )
+        if absolute_file_path is not None:
+            flags |= self._HAS_PATH_FLAG
+            encoded_value += absolute_file_path.encode("utf8")
+
+        return self._VALUE_FLAGS.pack(flags) + encoded_value
+
+    def _decode_value(self, value_bytes):
+        flags = self._VALUE_FLAGS.unpack_from(value_bytes)[0]
+        offset = self._VALUE_FLAGS.size
+
+        file_stat = None
+        if flags & self._HAS_STAT_FLAG:
+            file_stat = _make_stat_result(
+                self._FILE_STAT.unpack_from(value_bytes, offset),
+            )
+            offset += self._FILE_STAT.size
+
+        absolute_file_path = None
+        if flags & self._HAS_PATH_FLAG:
+            absolute_file_path = value_bytes[offset:].decode("utf8")
+
+        return absolute_file_path, file_stat
+
+    # }
+
+
+def _get_stat_time_ns(file_stat, time_name):
+    time_ns = getattr(file_stat, "st_%s_ns" % time_name, None)
+    if time_ns is None:
+        # Python 2 only has the times in seconds:
+        time_ns = int(getattr(file_stat, "st_" + time_name) * 1000000000)
+    return time_ns
+
+
+def _make_stat_result(stat_fields):
+    """
+    Return the :class:`os.stat_result` for the fields encoded in
+    :class:`SharedMetadataCache`.
+
+    Like the result of :func:`os.stat`, the times are integers when accessed
+    by index, and floats (or nanoseconds) when accessed by name.
+
+    """
+    mode, inode, device, link_count, uid, gid, size, atime, mtime, ctime, \
+        atime_ns, mtime_ns, ctime_ns = stat_fields
+    return os.stat_result(
+        (
+            mode,
+            inode,
+            device,
+            link_count,
+            uid,
+            gid,
+            size,
+            atime_ns // 1000000000,
+            mtime_ns // 1000000000,
+            ctime_ns // 1000000000,
+        ),
+        {
+            'st_atime': atime,
+            'st_mtime': mtime,
+            'st_ctime': ctime,
+            'st_atime_ns': atime_ns,
+            'st_mtime_ns': mtime_ns,
+            'st_ctime_ns': ctime_ns,
+        },
+    )
+
+
+# { File system watcher
+
+
+class FileSystemWatcher(object):
+    """
+    Watcher of the root directories of an application, which invalidates the
+    entries in its metadata cache as soon as the files change, so that the
+    entries can be kept for longer.
+
+    The directories are watched with ``inotify`` on Linux. The entries for
+    the files created, modified, moved or deleted are invalidated, including
+    the entries for the files that didn't exist. When a directory is created,
+    moved or deleted, the whole cache is cleared since the entries beneath it
+    are not known, and files may have been created in a new directory before
+    it was watched.
+
+    If the limit of watches is reached, or ``inotify`` is not available, the
+    entries fall back to expiring after ``fallback_timeout``.
+
+    Each process that calls :meth:`start`, :meth:`fileno` or
+    :meth:`process_events` gets its own set of watches.
+
+    """
+
+    _EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, application, fallback_timeout=5):
+        """
+
+        :param application: The application whose root directories are
+            watched.
+        :type application: :class:`XSendfileApplication`
+        :param fallback_timeout: The time during which the entries in the
+            metadata cache are valid if the root directories can't be watched
+            entirely (in seconds).
+        :type fallback_timeout: :class:`int`
+
+        """
+        self._application = application
+        self._metadata_cache = application._metadata_cache
+        self._root_directories = [
+            volume_application._root_directory
+            for volume_application in
+            getattr(application, "_volume_applications", [application])
+        ]
+        self._fallback_timeout = fallback_timeout
+
+        self._lock = threading.RLock()
+        self._process_id = None
+        self._thread_process_id = None
+        self._inotify_descriptor = None
+        self._watched_directories = {}
+        self._is_degraded = False
+
+    @property
+    def is_degraded(self):
+        """
+        Whether the entries fall back to expiring after the
+        ``fallback_timeout`` because the root directories can't be watched
+        entirely.
+
+        """
+        return self._is_degraded
+
+    def fileno(self):
+        """
+        Return the file descriptor to poll for events, which are then handled
+        with :meth:`process_events`, or :data:`None` if the root directories
+        can't be watched.
+
+        """
+        self._open()
+        return self._inotify_descriptor
+
+    def start(self):
+        """Handle the events in a background thread in this process."""
+        process_id = os.getpid()
+        if self._thread_process_id == process_id:
+            return
+
+        with self._lock:
+            if self._thread_process_id != process_id:
+                self._open()
+                if self._inotify_descriptor is not None:
+                    watcher_thread = threading.Thread(target=self._run)
+                    watcher_thread.daemon = True
+                    watcher_thread.start()
+                self._thread_process_id = process_id
+
+    def process_events(self):
+        """
+        Handle the pending events without waiting for new ones.
+
+        :return: The number of events handled.
+        :rtype: :class:`int`
+
+        """
+        self._open()
+
+        event_count = 0
+        with self._lock:
+            if self._inotify_descriptor is None:
+                return event_count
+
+            changed_directories = set()
+            while True:
+                try:
+                    events_bytes = os.read(self._inotify_descriptor, 65536)
+                except OSError as exc:
+                    if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+
+                for watch_descriptor, mask, entry_name in \
+                        self._parse_events(events_bytes):
+                    event_count += 1
+                    changed_directory = self._handle_event(
+                        watch_descriptor,
+                        mask,
+                        entry_name,
+                    )
+                    if changed_directory is not None:
+                        changed_directories.add(changed_directory)
+
+        if hasattr(self._application, "refresh_index"):
+            self._refresh_union_index(changed_directories)
+
+        return event_count
+
+    def _refresh_union_index(self, changed_directories):
+        if _ALL_DIRECTORIES in changed_directories:
+            self._application.refresh_index()
+            return
+
+        for root_directory, relative_directory_path in changed_directories:
+            self._application._refresh_directory(
+                root_directory,
+                relative_directory_path,
+            )
+
+    def _run(self):
+        inotify_descriptor = self._inotify_descriptor
+        while True:
+            select.select([inotify_descriptor], [], [])
+            try:
+                self.process_events()
+            except Exception:
+                # The thread must survive or the entries would no longer be
+                # invalidated:
+                _LOGGER.exception("Could not handle the file system events")
+
+    def _open(self):
+        process_id = os.getpid()
+        if self._process_id == process_id:
+            return
+
+        with self._lock:
+            if self._process_id == process_id:
+                return
+
+            # The descriptor inherited from the parent process (if any) is
+            # left to the parent, since the events are read only once:
+            self._inotify_descriptor = None
+            self._watched_directories = {}
+
+            if _LIBC is None or not hasattr(_LIBC, "inotify_init1"):
+                self._degrade()
+            else:
+                inotify_descriptor = _LIBC.inotify_init1(
+                    _IN_NONBLOCK | _IN_CLOEXEC,
+                )
+                if inotify_descriptor < 0:
+                    self._degrade()
+                else:
+                    self._inotify_descriptor = inotify_descriptor
+                    for root_directory in self._root_directories:
+                        self._watch_tree(root_directory, "")
+
+            self._process_id = process_id
+
+    def _watch_tree(self, root_directory, relative_directory_path):
+        absolute_directory_path = \
+            path.join(root_directory, relative_directory_path)
+        for directory_path, _, _ in os.walk(absolute_directory_path):
+            if not self._add_watch(
+                    root_directory,
+                    path.relpath(directory_path, root_directory),
+            ):
+                break
+
+    def _add_watch(self, root_directory, relative_directory_path):
+        if relative_directory_path == ".":
+            relative_directory_path = ""
+        absolute_directory_path = \
+            path.join(root_directory, relative_directory_path)
+
+        watch_descriptor = _LIBC.inotify_add_watch(
+            ctypes.c_int(self._inotify_descriptor),
+            ctypes.c_char_p(_encode_file_system_path(absolute_directory_path)),
+            ctypes.c_uint32(_WATCHED_EVENTS_MASK),
+        )
+        if watch_descriptor < 0:
+            if ctypes.get_errno() == errno.ENOSPC:
+                # The limit of watches was reached:
+                self._degrade()
+                return False
+            # The directory was removed in the meantime:
+            return True
+
+        self._watched_directories[watch_descriptor] = \
+            (root_directory, relative_directory_path)
+        return True
+
+    def _remove_watches(self, root_directory, relative_directory_path):
+        directory_path_prefix = relative_directory_path + os.sep
+        for watch_descriptor, watched_directory in \
+                list(self._watched_directories.items()):
+            watched_root_directory, watched_directory_path = watched_directory
+            if watched_root_directory == root_directory and (
+                    watched_directory_path == relative_directory_path or
+                    watched_directory_path.startswith(directory_path_prefix)):
+                del self._watched_directories[watch_descriptor]
+                _LIBC.inotify_rm_watch(
+                    ctypes.c_int(self._inotify_descriptor),
+                    ctypes.c_int(watch_descriptor),
+                )
+
+    def _parse_events(self, events_bytes):
+        event_header_size = self._EVENT_HEADER.size
+        offset = 0
+        while offset < len(events_bytes):
+            watch_descriptor, mask, _, name_length = \
+                self._EVENT_HEADER.unpack_from(events_bytes, offset)
+            offset += event_header_size
+            entry_name = \
+                events_bytes[offset:offset + name_length].rstrip(b"\0")
+            offset += name_length
+            yield watch_descriptor, mask, entry_name
+
+    def _handle_event(self, watch_descriptor, mask, entry_name):
+        """
+        Invalidate the entries affected by the event.
+
+        :return: The root directory and the relative path to the directory
+            whose entries changed, if any.
+
+        """
+        if mask & _IN_Q_OVERFLOW:
+            # Events were lost:
+            self._clear_metadata_cache()
+            return _ALL_DIRECTORIES
+
+        if mask & _IN_IGNORED:
+            self._watched_directories.pop(watch_descriptor, None)
+            return None
+
+        watched_directory = self._watched_directories.get(watch_descriptor)
+        if watched_directory is None:
+            return None
+        root_directory, relative_directory_path = watched_directory
+
+        if mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+            if not relative_directory_path:
+                # The root directory itself was moved or deleted:
+                self._clear_metadata_cache()
+                return _ALL_DIRECTORIES
+            # Otherwise, the event for its entry in its parent is enough.
+            return None
+
+        relative_path = path.join(
+            relative_directory_path,
+            _decode_file_system_path(entry_name),
+        )
+
+        if mask & _IN_ISDIR:
+            if mask & (_IN_MOVED_FROM | _IN_DELETE):
+                self._remove_watches(root_directory, relative_path)
+            if mask & (_IN_MOVED_TO | _IN_CREATE):
+                self._watch_tree(root_directory, relative_path)
+            if mask & (_IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE |
+                       _IN_DELETE):
+                self._clear_metadata_cache()
+                return watched_directory
+
+        if self._metadata_cache is not None:
+            cache_key = self._application._get_cache_key("/" + relative_path)
+            try:
+                self._metadata_cache.invalidate(cache_key)
+            except UnicodeError:
+                # The file can't be requested with a UTF-8 URL, so it can't be
+                # in the cache either.
+                pass
+
+        return watched_directory
+
+    def _clear_metadata_cache(self):
+        if self._metadata_cache is not None:
+            self._metadata_cache.clear()
+
+    def _degrade(self):
+        self._is_degraded = True
+
+        metadata_cache = self._metadata_cache
+        if metadata_cache is not None and \
+                self._fallback_timeout < metadata_cache.timeout:
+            metadata_cache.timeout = self._fallback_timeout
+            metadata_cache.clear()
+
+
+# The changed directory when all of them may have changed:
+_ALL_DIRECTORIES = (None, None)
+
+_IN_MODIFY = 0x00000002
+
+_IN_ATTRIB = 0x00000004
+
+_IN_CLOSE_WRITE = 0x00000008
+
+_IN_MOVED_FROM = 0x00000040
+
+_IN_MOVED_TO = 0x00000080
+
+_IN_CREATE = 0x00000100
+
+_IN_DELETE = 0x00000200
+
+_IN_DELETE_SELF = 0x00000400
+
+_IN_MOVE_SELF = 0x00000800
+
+_IN_Q_OVERFLOW = 0x00004000
+
+_IN_IGNORED = 0x00008000
+
+_IN_ONLYDIR = 0x01000000
+
+_IN_DONT_FOLLOW = 0x02000000
+
+_IN_ISDIR = 0x40000000
+
+_IN_NONBLOCK = 0o4000
+
+_IN_CLOEXEC = 0o2000000
+
+_WATCHED_EVENTS_MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | \
+    _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | \
+    _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR | _IN_DONT_FOLLOW
+
+
+# }
+
+
+# { Content digests
+
+
+class ContentDigestStore(object):
+    """
+    Store of the digests of the contents of the files served, which are
+    computed once and persisted alongside the files.
+
+    The digests are kept in the ``user.xsendfile.<algorithm>`` extended
+    attribute of each file, or in a sidecar directory if extended attributes
+    are not supported, tagged with the size and the modification time of the
+    file so that stale digests are ignored.
+
+    The digests can be computed in bulk with ``python -m xsendfile digest``.
+
+    The most recent digests are also kept in memory, so that files whose
+    digest can't be persisted are not hashed again on every request.
+
+    """
+
+    _CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, algorithm="sha256", sidecar_directory=None,
+                 compute_missing=True, max_inline_file_size=16 * 1024 * 1024):
+        """
+
+        :param algorithm: The name of the built-in hashing algorithm to use.
+        :type algorithm: :class:`basestring`
+        :param sidecar_directory: The directory where the digests are kept
+            when they can't be stored in extended attributes, if any.
+        :type sidecar_directory: :class:`basestring`
+        :param compute_missing: Whether the digest of a file should be
+            computed when it's requested and its digest is missing or stale.
+        :type compute_missing: :class:`bool`
+        :param max_inline_file_size: The size of the largest file whose
+            missing digest is computed while the request waits. The digests of
+            larger files are computed by a background thread, one file at a
+            time, and the responses sent in the meantime have no digest.
+        :type max_inline_file_size: :class:`int`
+
+        """
+        # Fail early if the algorithm is not available:
+        hashlib.new(algorithm)
+        self._algorithm = algorithm
+        self._attribute_name = "user.xsendfile." + algorithm
+        self._sidecar_directory = sidecar_directory
+        self._compute_missing = compute_missing
+        self._max_inline_file_size = max_inline_file_size
+
+        self._digests_by_file_signature = {}
+        self._has_reported_persistence_failure = False
+
+        self._lock = threading.Lock()
+        self._pending_file_paths = set()
+        self._queue = None
+        self._process_id = None
+
+    def get_digest(self, file_path, file_stat):
+        """
+        Return the hexadecimal digest of the file in ``file_path``.
+
+        :param file_path: The absolute path to the file.
+        :type file_path: :class:`basestring`
+        :param file_stat: The status of the file.
+        :return: The digest, or :data:`None` if it's missing or stale and
+            ``compute_missing`` is disabled or the file is being hashed in the
+            background.
+        :rtype: :class:`basestring`
+
+        """
+        cache_key = (file_path, _get_file_signature(file_stat))
+        digest = self._digests_by_file_signature.get(cache_key)
+        if digest is not None:
+            return digest
+
+        record = self._read_record(file_path)
+        if record is not None:
+            record_tag, _, digest = record.rpartition(" ")
+            if record_tag == self._get_tag(file_stat):
+                self._remember_digest(cache_key, digest)
+                return digest
+
+        if not self._compute_missing:
+            return None
+
+        if self._max_inline_file_size < file_stat.st_size:
+            self._schedule_update(file_path)
+            return None
+
+        return self.update(file_path)
+
+    def get_content_digest(self, file_path, file_stat):
+        """
+        Return the digest of the file in ``file_path`` along with its HTTP
+        headers, or :data:`None` if the digest is not available.
+
+        """
+        digest = self.get_digest(file_path, file_stat)
+        if digest is None:
+            return None
+        return _ContentDigest(self._algorithm, digest)
+
+    def update(self, file_path):
+        """
+        Compute and store the digest of the file in ``file_path``.
+
+        :return: The hexadecimal digest.
+        :rtype: :class:`basestring`
+
+        """
+        with open(file_path, "rb") as file_:
+            file_stat = os.fstat(file_.fileno())
+            hash_ = hashlib.new(self._algorithm)
+            for chunk in iter(lambda: file_.read(self._CHUNK_SIZE), b""):
+                hash_.update(chunk)
+        digest = hash_.hexdigest()
+
+        self._remember_digest(
+            (file_path, _get_file_signature(file_stat)),
+            digest,
+        )
+
+        record = "%s %s" % (self._get_tag(file_stat), digest)
+        if not self._write_record(file_path, record) and \
+                not self._has_reported_persistence_failure:
+            self._has_reported_persistence_failure = True
+            _LOGGER.error(
+                "Could not persist the digest of %s; digests will only be "
+                "kept in memory. Set a sidecar directory if the file system "
+                "doesn't support user extended attributes.",
+                file_path,
+            )
+
+        return digest
+
+    # { Internal utilities
+
+    def _remember_digest(self, cache_key, digest):
+        digests_by_file_signature = self._digests_by_file_signature
+        if len(digests_by_file_signature) >= _MAX_MEMOIZED_PATHS:
+            digests_by_file_signature.clear()
+        digests_by_file_signature[cache_key] = digest
+
+    def _schedule_update(self, file_path):
+        self._start_worker()
+
+        with self._lock:
+            if file_path in self._pending_file_paths:
+                # Another request is already waiting for the same digest:
+                return
+            self._pending_file_paths.add(file_path)
+
+        try:
+            self._queue.put_nowait(file_path)
+        except QueueFull:
+            with self._lock:
+                self._pending_file_paths.discard(file_path)
+
+    def _start_worker(self):
+        process_id = os.getpid()
+        if self._process_id == process_id:
+            return
+
+        # Threads don't survive a fork, so each process needs its own:
+        with self._lock:
+            if self._process_id != process_id:
+                self._queue = Queue(maxsize=1024)
+                self._pending_file_paths = set()
+                worker_thread = threading.Thread(target=self._run_updates)
+                worker_thread.daemon = True
+                worker_thread.start()
+                self._process_id = process_id
+
+    def _run_updates(self):
+        queue = self._queue
+        while True:
+            file_path = queue.get()
+            try:
+                self.update(file_path)
+            except (IOError, OSError):
+                # The file was removed or can't be read, so the next request
+                # will try again:
+                pass
+            finally:
+                with self._lock:
+                    self._pending_file_paths.discard(file_path)
+
+    @staticmethod
+    def _get_tag(file_stat):
+        return "%d:%.6f" % (file_stat.st_size, file_stat.st_mtime)
+
+    def _read_record(self, file_path):
+        getxattr = getattr(os, "getxattr", None)
+        if getxattr is not None:
+            try:
+                record = getxattr(file_path, self._attribute_name)
+                return record.decode("ascii")
+            except OSError:
+                # The attribute is missing or not supported:
+                pass
+
+        sidecar_file_path = self._get_sidecar_file_path(file_path)
+        if sidecar_file_path is None:
+            return None
+
+        try:
+            with open(sidecar_file_path) as sidecar_file:
+                return sidecar_file.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def _write_record(self, file_path, record):
+        setxattr = getattr(os, "setxattr", None)
+        if setxattr is not None:
+            try:
+                setxattr(
+                    file_path,
+                    self._attribute_name,
+                    record.encode("ascii"),
+                )
+                return True
+            except OSError:
+                # The file is read-only or the attribute is not supported:
+                pass
+
+        sidecar_file_path = self._get_sidecar_file_path(file_path)
+        if sidecar_file_path is None:
+            return False
+
+        # Write the record atomically so readers never see partial records:
+        temporary_file_path = "%s.%s.tmp" % (sidecar_file_path, os.getpid())
+        with open(temporary_file_path, "w") as temporary_file:
+            temporary_file.write(record)
+        os.rename(temporary_file_path, sidecar_file_path)
+        return True
+
+    def _get_sidecar_file_path(self, file_path):
+        if self._sidecar_directory is None:
+            return None
+
+        file_path_hash = hashlib.md5(_encode_file_system_path(file_path))
+        sidecar_file_name = "%s.%s" % (
+            file_path_hash.hexdigest(),
+            self._algorithm,
+        )
+        return path.join(self._sidecar_directory, sidecar_file_name)
+
+    # }
+
+
+class _ContentDigest(object):
+    """The digest of a file, with the HTTP headers that convey it."""
+
+    # The names of the algorithms in the HTTP Digest Algorithm Values registry:
+    _HTTP_ALGORITHM_NAMES = {
+        'md5': "md5",
+        'sha256': "sha-256",
+        'sha512': "sha-512",
+    }
+
+    def __init__(self, algorithm, digest):
+        self.algorithm = algorithm
+        self.digest = digest
+
+        headers = [("ETag", '"%s"' % digest)]
+        http_algorithm_name = self._HTTP_ALGORITHM_NAMES.get(algorithm)
+        if http_algorithm_name is not None:
+            digest_base64 = base64.b64encode(binascii.unhexlify(digest))
+            digest_base64 = digest_base64.decode("ascii")
+            headers.append(
+                ("Digest", "%s=%s" % (http_algorithm_name, digest_base64)),
+            )
+            headers.append((
+                "Content-Digest",
+                "%s=:%s:" % (http_algorithm_name, digest_base64),
+            ))
+        self.headers = tuple(headers)
+
+
+# }
+
+
+# { File system guard
+
+
+class FileSystemGuard(object):
+    """
+    Guard that runs the lookups of the requested files in a bounded pool of
+    threads, so that a stalled file system (e.g., an NFS server) doesn't tie
+    up the threads serving the requests.
+
+    Lookups that don't complete within the timeout, or that can't even be
+    queued because all the threads are stuck, get a ``503 Service
+    Unavailable`` response with a ``Retry-After`` header.
+
+    After ``failure_threshold`` consecutive failures, the guard stops sending
+    lookups to the file system for ``retry_after`` seconds. The first lookup
+    after that is sent to probe the file system: If it succeeds, lookups are
+    resumed; otherwise, the guard waits for another ``retry_after`` seconds.
+
+    A guard can be shared by several applications serving files from the same
+    file system.
+
+    """
+
+    def __init__(self, timeout=1, worker_count=8, queue_size=64,
+                 failure_threshold=5, retry_after=10):
+        """
+
+        :param timeout: The maximum time to wait for each lookup (in seconds).
+        :type timeout: :class:`float`
+        :param worker_count: The number of threads doing lookups in each
+            process.
+        :type worker_count: :class:`int`
+        :param queue_size: The maximum number of lookups waiting for a thread.
+        :type queue_size: :class:`int`
+        :param failure_threshold: The number of consecutive failures that
+            stop the lookups.
+        :type failure_threshold: :class:`int`
+        :param retry_after: The time during which lookups are stopped (in
+            seconds), which is also sent in the ``Retry-After`` header.
+        :type retry_after: :class:`int`
+
+        """
+        self._timeout = timeout
+        self._worker_count = worker_count
+        self._queue_size = queue_size
+        self._failure_threshold = failure_threshold
+        self._retry_after = retry_after
+
+        self._calls = None
+
+        self._lock = threading.Lock()
+        self._process_id = None
+        self._failure_count = 0
+        self._opening_time = None
+        self._is_probing = False
+
+        self._unavailable_response = _ErrorResponse(
+            "503 Service Unavailable",
+            "The resource is temporarily unavailable.",
+            [("Retry-After", str(retry_after))],
+        )
+
+    @property
+    def is_open(self):
+        """Whether the lookups are stopped after repeated failures."""
+        return self._opening_time is not None
+
+    def call(self, function, *args):
+        """
+        Return the result of calling ``function`` with ``args`` in a thread of
+        the pool.
+
+        :raises FileSystemUnavailableError: If the call didn't complete in
+            time, or the lookups are stopped.
+
+        Any exception raised by ``function`` is raised again in the calling
+        thread, and doesn't count as a successful lookup.
+
+        """
+        self._start_call()
+
+        self._start_workers()
+
+        guarded_call = _GuardedCall(function, args)
+        try:
+            self._calls.put_nowait(guarded_call)
+        except QueueFull:
+            self._record_failure()
+            raise FileSystemUnavailableError("All the threads are busy")
+
+        if not guarded_call.completion_event.wait(self._timeout):
+            self._record_failure()
+            raise FileSystemUnavailableError(
+                "The call took longer than %s seconds" % self._timeout,
+            )
+
+        if not guarded_call.is_successful:
+            # The error doesn't tell whether the file system is healthy:
+            self._cancel_probe()
+            six.reraise(*guarded_call.exc_info)
+
+        self._record_success()
+        return guarded_call.result
+
+    # { Internal utilities
+
+    def _start_call(self):
+        if self._opening_time is None:
+            return
+
+        with self._lock:
+            opening_time = self._opening_time
+            if opening_time is None:
+                return
+
+            is_retry_due = \
+                opening_time + self._retry_after <= get_current_time()
+            if not is_retry_due or self._is_probing:
+                raise FileSystemUnavailableError(
+                    "Lookups are stopped after repeated failures",
+                )
+
+            self._is_probing = True
+
+    def _record_failure(self):
+        with self._lock:
+            self._failure_count += 1
+            if self._is_probing or \
+                    self._failure_threshold <= self._failure_count:
+                self._opening_time = get_current_time()
+                self._is_probing = False
+
+    def _cancel_probe(self):
+        if self._is_probing:
+            with self._lock:
+                self._is_probing = False
+
+    def _record_success(self):
+        if self._failure_count or self._opening_time is not None:
+            with self._lock:
+                self._failure_count = 0
+                self._opening_time = None
+                self._is_probing = False
+
+    def _start_workers(self):
+        process_id = os.getpid()
+        if self._process_id == process_id:
+            return
+
+        # The threads in the parent process (if any) are gone after a fork,
+        # and so is the state of the locks in its queue:
+        with self._lock:
+            if self._process_id != process_id:
+                calls = Queue(self._queue_size)
+                for _ in range(self._worker_count):
+                    self._start_worker(calls)
+                self._calls = calls
+                self._process_id = process_id
+
+    def _start_worker(self, calls):
+        worker_thread = threading.Thread(
+            target=self._run_calls,
+            args=(calls, ),
+        )
+        worker_thread.daemon = True
+        worker_thread.start()
+
+    def _run_calls(self, calls):
+        try:
+            while True:
+                guarded_call = calls.get()
+                guarded_call.run()
+        finally:
+            # The thread is only ended by an exception which isn't an error
+            # (e.g., SystemExit), so another thread takes its place:
+            self._start_worker(calls)
+
+    # }
+
+
+class _GuardedCall(object):
+
+    def __init__(self, function, args):
+        self._function = function
+        self._args = args
+
+        self.completion_event = threading.Event()
+        self.result = None
+        self.is_successful = False
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.result = self._function(*self._args)
+            self.is_successful = True
+        except Exception:
+            # The error is raised in the calling thread instead:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.completion_event.set()
+
+# }
+
+
+# { Caching policies
+
+
+class CachePolicy(object):
+    """
+    Rules that set the ``Cache-Control`` and ``Expires`` HTTP headers of the
+    files served, so that browsers and CDNs can serve repeat requests.
+
+    The first rule that matches a file is used, in the order they were added.
+    Files that don't match any rule are served without those headers.
+
+    For files served by :class:`AuthTokenApplication`, the ``max-age`` is
+    capped to the remaining lifetime of the token, and the files are never
+    cached if the uses of the tokens are limited or the tokens can be revoked.
+
+    """
+
+    def __init__(self):
+        self._rules = []
+
+    def add_rule(self, max_age, path_prefix="/", mime_type=None,
+                 file_sender=None, is_private=False, is_immutable=False):
+        """
+        Add a rule for the files that match all the given conditions.
+
+        :param max_age: The time during which the file can be cached (in
+            seconds); ``0`` requires caches to revalidate it on each request.
+        :type max_age: :class:`int`
+        :param path_prefix: The path to the directory of the files relative
+            to the root directory (e.g., ``/images/``), which is matched
+            against whole segments of the normalized paths to the files.
+        :type path_prefix: :class:`basestring`
+        :param mime_type: The MIME type of the files, or its major type
+            followed by ``/*`` (e.g., ``image/*``).
+        :type mime_type: :class:`basestring`
+        :param file_sender: The file sender that serves the files, which is
+            useful with :class:`SizeAwareSendfile`.
+        :type file_sender: a WSGI application
+        :param is_private: Whether shared caches (like CDNs) must not store the
+            files.
+        :type is_private: :class:`bool`
+        :param is_immutable: Whether the files never change while they're
+            fresh.
+        :type is_immutable: :class:`bool`
+
+        """
+        if mime_type and mime_type.endswith("/*"):
+            # Only the major type and the slash have to match:
+            mime_type = mime_type[:-1]
+
+        # With a trailing slash, so that "/images" doesn't match
+        # "/images-old/":
+        path_prefix = _normalize_path(path_prefix).rstrip("/") + "/"
+
+        if is_private:
+            directives = ["private", "max-age=%s"]
+        else:
+            directives = ["public", "max-age=%s"]
+        if max_age == 0:
+            directives.append("no-cache")
+        if is_immutable:
+            directives.append("immutable")
+        cache_control_template = ", ".join(directives)
+
+        rule = (
+            path_prefix,
+            mime_type,
+            file_sender,
+            max_age,
+            cache_control_template,
+        )
+        self._rules.append(rule)
+
+    def get_headers(self, relative_file_path, mime_type, file_sender=None,
+                    deadline=None):
+        """
+        Return the caching HTTP headers for the file in ``relative_file_path``.
+
+        :param relative_file_path: The path to the file relative to the root
+            directory, which is normalized before it's matched.
+        :type relative_file_path: :class:`basestring`
+        :param mime_type: The MIME type of the file.
+        :type mime_type: :class:`basestring`
+        :param file_sender: The file sender that serves the file.
+        :type file_sender: a WSGI application
+        :param deadline: The time when the URL to the file expires, if any.
+        :type deadline: :class:`datetime.datetime`
+        :return: The ``Cache-Control`` and ``Expires`` headers, or none if no
+            rule matches the file.
+        :rtype: :class:`list` of (name, value) tuples
+
+        """
+        # Aliases like "/public/../private/" must get the rules of the file
+        # they resolve to:
+        relative_directory_path = \
+            _normalize_path(relative_file_path).rstrip("/") + "/"
+        for rule in self._rules:
+            path_prefix, rule_mime_type, rule_file_sender = rule[:3]
+            if not relative_directory_path.startswith(path_prefix):
+                continue
+            if rule_mime_type and not (
+                    mime_type == rule_mime_type or
+                    (rule_mime_type.endswith("/") and
+                     mime_type.startswith(rule_mime_type))):
+                continue
+            if rule_file_sender is not None and \
+                    rule_file_sender is not file_sender:
+                continue
+            break
+        else:
+            return []
+
+        max_age, cache_control_template = rule[3:]
+        now = get_current_time()
+        if deadline is not None:
+            remaining_lifetime = int(mktime(deadline.timetuple()) - now)
+            max_age = max(min(max_age, remaining_lifetime), 0)
+
+        headers = [
+            ("Cache-Control", cache_control_template % max_age),
+            ("Expires", formatdate(now + max_age, usegmt=True)),
+        ]
+        return headers
+
+    def wrap_start_response(self, start_response, environ,
+                            relative_file_path):
+        """
+        Return a ``start_response`` callable that adds the caching headers to
+        successful responses that don't set ``Cache-Control`` already.
+
+        """
+        def start_response_with_cache_headers(status, headers, *args):
+            if status[:3] in ("200", "206"):
+                mime_type = ""
+                for header_name, header_value in headers:
+                    header_name = header_name.lower()
+                    if header_name == "cache-control":
+                        # The file sender knows better:
+                        break
+                    if header_name == "content-type":
+                        mime_type = header_value.split(";")[0].strip()
+                else:
+                    headers = headers + self.get_headers(
+                        relative_file_path,
+                        mime_type,
+                        environ.get('xsendfile.file_sender'),
+                        environ.get('xsendfile.token_deadline'),
+                    )
+
+            return start_response(status, headers, *args)
+
+        return start_response_with_cache_headers
+
+
+def _wrap_start_response_without_caching(start_response):
+    """
+    Return a ``start_response`` callable that forbids any cache to store the
+    successful responses, replacing their caching headers if any.
+
+    """
+    def start_response_without_caching(status, headers, *args):
+        if status[:3] in ("200", "206"):
+            headers = [
+                (header_name, header_value)
+                for (header_name, header_value) in headers
+                if header_name.lower() not in ("cache-control", "expires")
+            ]
+            headers.append(("Cache-Control", "private, no-store"))
+
+        return start_response(status, headers, *args)
+
+    return start_response_without_caching
+
+
+# }
+
+
+# { Union of root directories
+
+
+class UnionXSendfileApplication(XSendfileApplication):
+    """
+    WSGI application which serves the files in several root directories (e.g.,
+    on different volumes) as if they were in a single one.
+
+    When a file exists in more than one root directory, the one in the first
+    of them is served. The files are located through an in-memory index of
+    the root directories, which is refreshed periodically in each process by
+    listing again only the directories modified since the previous refresh.
+    Files missing from the index (e.g., because they were created since the
+    previous refresh) are looked up in each root directory in turn.
+
+    Each root directory has the same requirements and the same containment
+    guarantees as the root directory of :class:`XSendfileApplication`.
+
+    """
+
+    def __init__(self, root_directories, file_sender=None,
+                 metadata_cache=None, cache_policy=None,
+                 file_system_guard=None, content_digest_store=None,
+                 hot_file_tracker=None, content_type_resolver=None,
+                 index_refresh_interval=60):
+        """
+
+        :param root_directories: The absolute paths to the root directories,
+            by order of precedence.
+        :type root_directories: :class:`list` of :class:`basestring`
+        :param index_refresh_interval: The time between the refreshes of the
+            index (in seconds).
+        :type index_refresh_interval: :class:`int`
+        :raises BadRootError: If there are no root directories or any of them
+            is not an existing directory or is contained in a symbolic link
+        :raises BadSenderError: If the ``file_sender`` is not valid.
+
+        The other parameters are the same as in :class:`XSendfileApplication`.
+
+        """
+        if not root_directories:
+            raise BadRootError("At least one root directory is required")
+
+        super(UnionXSendfileApplication, self).__init__(
+            root_directories[0],
+            file_sender,
+            metadata_cache,
+            cache_policy,
+            file_system_guard,
+            content_digest_store,
+            hot_file_tracker,
+            content_type_resolver,
+        )
+
+        # The lookups within each root directory are delegated to an
+        # application for that directory so that the same guarantees apply:
+        self._volume_applications = [
+            XSendfileApplication(root_directory, self._sender)
+            for root_directory in root_directories
+        ]
+        self._index_refresh_interval = index_refresh_interval
+
+        # The listing of each directory in each volume, indexed by the path to
+        # the directory relative to the root directory of the volume:
+        self._directory_listings = [{} for _ in self._volume_applications]
+        # The volume of each entry, indexed by its relative path:
+        self._location_index = {}
+
+        self._index_lock = threading.Lock()
+        self._process_id = None
+
+        self.refresh_index()
+
+    def refresh_index(self):
+        """
+        List again the directories modified since the previous refresh and
+        update the index accordingly.
+
+        """
+        with self._index_lock:
+            changed_paths = set()
+            for volume_index in range(len(self._volume_applications)):
+                changed_paths.update(self._refresh_listing(volume_index, ""))
+
+            for relative_path in changed_paths:
+                self._update_location(relative_path)
+
+    def _lookup_file_unguarded(self, relative_file_path):
+        self._start_refresh_thread()
+
+        normalized_path = path.normpath(relative_file_path.lstrip("/"))
+        if normalized_path in (".", "..") or normalized_path.startswith("../"):
+            # The file is outside of the roots or it's the roots themselves:
+            return None, None
+
+        volume_index = self._location_index.get(normalized_path)
+        if volume_index is not None:
+            volume_application = self._volume_applications[volume_index]
+            return volume_application._lookup_file_unguarded(
+                relative_file_path,
+            )
+
+        # The file may have been created since the index was refreshed:
+        first_lookup_result = None
+        for volume_application in self._volume_applications:
+            absolute_file_path, file_stat = \
+                volume_application._lookup_file_unguarded(relative_file_path)
+            if file_stat is not None:
+                return absolute_file_path, file_stat
+            if first_lookup_result is None:
+                first_lookup_result = (absolute_file_path, file_stat)
+        return first_lookup_result
+
+    def _get_cache_key(self, relative_file_path):
+        root_directories = [
+            volume_application._root_directory
+            for volume_application in self._volume_applications
+        ]
+        return "\0".join(
+            root_directories + [_normalize_path(relative_file_path)],
+        )
+
+    def _is_canonical_file_path(self, relative_file_path, absolute_file_path):
+        return any(
+            volume_application._is_canonical_file_path(
+                relative_file_path,
+                absolute_file_path,
+            )
+            for volume_application in self._volume_applications
+        )
+
+    def _refresh_directory(self, root_directory, relative_directory_path):
+        """
+        Refresh the listing of ``relative_directory_path`` in the volume with
+        ``root_directory``, without revisiting its known sub-directories.
+
+        """
+        for volume_index, volume_application in \
+                enumerate(self._volume_applications):
+            if volume_application._root_directory == root_directory:
+                break
+        else:
+            return
+
+        with self._index_lock:
+            changed_paths = self._refresh_listing(
+                volume_index,
+                relative_directory_path,
+                is_recursive=False,
+            )
+            for relative_path in changed_paths:
+                self._update_location(relative_path)
+
+    def _refresh_listing(self, volume_index, relative_directory_path,
+                         is_recursive=True):
+        """
+        Refresh the listing of ``relative_directory_path`` and its
+        sub-directories in the volume, if they were modified.
+
+        Unless ``is_recursive``, only the new sub-directories are listed.
+
+        :return: The relative paths to the entries added or removed.
+
+        """
+        root_directory = \
+            self._volume_applications[volume_index]._root_directory
+        directory_listings = self._directory_listings[volume_index]
+        previous_listing = directory_listings.get(relative_directory_path)
+
+        try:
+            directory_stat = os.lstat(
+                path.join(root_directory, relative_directory_path),
+            )
+        except OSError:
+            directory_stat = None
+
+        if directory_stat is None or not stat.S_ISDIR(directory_stat.st_mode):
+            return self._forget_listing(volume_index, relative_directory_path)
+
+        changed_paths = set()
+        if previous_listing is not None and \
+                previous_listing.mtime == directory_stat.st_mtime:
+            if not is_recursive:
+                return changed_paths
+
+            # Only its sub-directories may have been modified:
+            for sub_directory_path in previous_listing.sub_directory_paths:
+                changed_paths.update(
+                    self._refresh_listing(volume_index, sub_directory_path),
+                )
+            return changed_paths
+
+        entry_paths = set()
+        sub_directory_paths = set()
+        for entry_name in os.listdir(
+                path.join(root_directory, relative_directory_path)):
+            entry_path = path.join(relative_directory_path, entry_name)
+            entry_paths.add(entry_path)
+            try:
+                entry_stat = os.lstat(path.join(root_directory, entry_path))
+            except OSError:
+                continue
+            if stat.S_ISDIR(entry_stat.st_mode):
+                sub_directory_paths.add(entry_path)
+
+        directory_listings[relative_directory_path] = _DirectoryListing(
+            directory_stat.st_mtime,
+            frozenset(entry_paths),
+            frozenset(sub_directory_paths),
+        )
+
+        if previous_listing is None:
+            previous_sub_directory_paths = frozenset()
+            changed_paths.update(entry_paths)
+        else:
+            previous_sub_directory_paths = previous_listing.sub_directory_paths
+            changed_paths.update(
+                entry_paths.symmetric_difference(previous_listing.entry_paths),
+            )
+            for sub_directory_path in previous_listing.sub_directory_paths:
+                if sub_directory_path not in sub_directory_paths:
+                    changed_paths.update(
+                        self._forget_listing(volume_index, sub_directory_path),
+                    )
+
+        for sub_directory_path in sub_directory_paths:
+            if is_recursive or \
+                    sub_directory_path not in previous_sub_directory_paths:
+                changed_paths.update(
+                    self._refresh_listing(volume_index, sub_directory_path),
+                )
+
+        return changed_paths
+
+    def _forget_listing(self, volume_index, relative_directory_path):
+        """
+        Remove the listing of ``relative_directory_path`` and its
+        sub-directories in the volume.
+
+        :return: The relative paths to the entries removed.
+
+        """
+        directory_listing = self._directory_listings[volume_index].pop(
+            relative_directory_path,
+            None,
+        )
+        if directory_listing is None:
+            return set()
+
+        changed_paths = set(directory_listing.entry_paths)
+        for sub_directory_path in directory_listing.sub_directory_paths:
+            changed_paths.update(
+                self._forget_listing(volume_index, sub_directory_path),
+            )
+        return changed_paths
+
+    def _update_location(self, relative_path):
+        """Index ``relative_path`` in the first volume where it exists."""
+        relative_directory_path = path.dirname(relative_path)
+        for volume_index, directory_listings in \
+                enumerate(self._directory_listings):
+            directory_listing = directory_listings.get(relative_directory_path)
+            if directory_listing is not None and \
+                    relative_path in directory_listing.entry_paths:
+                self._location_index[relative_path] = volume_index
+                break
+        else:
+            self._location_index.pop(relative_path, None)
+
+    def _start_refresh_thread(self):
+        process_id = os.getpid()
+        if self._process_id == process_id:
+            return
+
+        # Threads don't survive a fork, so each process needs its own:
+        with self._index_lock:
+            if self._process_id != process_id:
+                refresh_thread = threading.Thread(target=self._run_refreshes)
+                refresh_thread.daemon = True
+                refresh_thread.start()
+                self._process_id = process_id
+
+    def _run_refreshes(self):
+        while True:
+            sleep(self._index_refresh_interval)
+            try:
+                self.refresh_index()
+            except OSError:  # pragma:no cover
+                # A directory was removed while it was being listed, so the
+                # next refresh will pick up the change:
+                pass
+
+
+class _DirectoryListing(object):
+    """The entries of a directory in a volume at a given modification time."""
+
+    def __init__(self, mtime, entry_paths, sub_directory_paths):
+        self.mtime = mtime
+        self.entry_paths = entry_paths
+        self.sub_directory_paths = sub_directory_paths
+
+
+# }
+
+
+# { Auth token application
+
+
+class TokenConfig(object):
+    """
+    Configuration object for a protected directory.
+
+    """
+
+    def __init__(self, secret, hash_algo="md5", timeout=120):
+        """
+
+        :param secret: The secret string shared by the application that
+            generates the links and the WSGI application that serves the files.
+        :type secret: :class:`basestring`
+        :param hash_algo: The name of the built-in hashing algorithm to use or
+            a callable that returns the required (hexadecimal) digest.
+        :type hash_algo: :class:`basestring` or callable
+        :param timeout: The time during which a token is valid (in seconds)
+        :type timeout: :class:`int`
+
+        .. versionchanged:: 1.0rc1
+
+            Removed ability to use a custom character encoding.
+
+        """
+        self._secret = secret
+        self._timeout = timedelta(seconds=timeout)
+
+        if callable(hash_algo):
+            self._hash_algo = hash_algo
+        else:
+            # It must be an string representing a built-in hashing algorithm,
+            # otherwise an exception would be raised:
+            hashlib.new(hash_algo)
+            self._hash_algo = _BuiltinHashWrapper(hash_algo)
+
+    def is_valid_digest(self, digest, file_name, time):
+        """
+        Report whether ``digest`` is the valid digest for ``file_name`` and
+        ``time``.
+
+        :param digest: The (hexadecimal) digest string.
+        :type digest: :class:`basestring`
+        :param file_name: The path to the file, which could not exist.
+        :type file_name: :class:`basestring`
+        :param time: The time supposedly associated to the ``digest``.
+        :type time: :class:`datetime.datetime`
+        :rtype: :class:`bool`
+
+        """
+        hex_timestamp = self._to_hex_timestamp(time)
+        expected_digest = self._get_digest(file_name, hex_timestamp)
+
+        return expected_digest == digest
+
+    def is_current(self, generation_time):
+        """
+        Report whether a token ``generation_time`` is considered as expired.
+
+        :param generation_time: The time when a URL was generated.
+        :type generation_time: :class:`datetime.datetime`
+        :rtype: :class:`bool`
+
+        """
+        deadline = self.get_deadline(generation_time)
+        now = datetime.now()
+
+        return now <= deadline
+
+    def get_deadline(self, generation_time):
+        """
+        Return the time when a token generated at ``generation_time`` expires.
+
+        :param generation_time: The time when a URL was generated.
+        :type generation_time: :class:`datetime.datetime`
+        :rtype: :class:`datetime.datetime`
+
+        """
+        return generation_time + self._timeout
+
+    def get_url_path(self, file_name):  # pragma:no cover
+        """
+        Get the protected URL path for ``file_name``.
+
+        :param file_name: The file to be served.
+        :type file_name: :class:`basestring`
+        :rtype: :class:`basestring`
+
+        """
+        # This method cannot be unit tested because its output depends on the
+        # time when it's called.
+        now = datetime.now()
+        return self._generate_url_path(file_name, now)
+
+    def get_archive_url_path(self, archive_name, file_names):
+        """
+        Get the protected URL path for an archive of ``file_names``.
+
+        :param archive_name: The name of the archive to be downloaded.
+        :type archive_name: :class:`basestring`
+        :param file_names: The files and directories to be archived.
+        :type file_names: :class:`list` of :class:`basestring`
+        :rtype: :class:`basestring`
+
+        """
+        now = datetime.now()
+        return self._generate_archive_url_path(archive_name, file_names, now)
+
+    # { Internal utilities
+
+    def _generate_archive_url_path(self, archive_name, file_names, time):
+        """Generate protected URL path for an archive of ``file_names``."""
+        hex_timestamp = self._to_hex_timestamp(time)
+        digest = self._get_digest("\n".join(file_names), hex_timestamp)
+
+        urlencoded_archive_name = _encode_path(archive_name)
+        query_string = urlencode([
+            ("file", file_name.encode("utf8")) for file_name in file_names
+        ])
+
+        url_path = "/%s-%s/%s?%s" % (
+            digest,
+            hex_timestamp,
+            urlencoded_archive_name,
+            query_string,
+        )
+        return url_path
+
+    def _generate_url_path(self, file_name, time):
+        """Generate protected URL path for ``file_name``."""
+        hex_timestamp = self._to_hex_timestamp(time)
+        digest = self._get_digest(file_name, hex_timestamp)
+
+        urlencoded_file_name = _encode_path(file_name)
+
+        url_path = "/%s-%s/%s" % (digest, hex_timestamp, urlencoded_file_name)
         return url_path
 
-    def _get_digest(self, file_name, hex_timestamp):
-        """Generate a digest message for ``file_name``."""
-        digest = self._hash_algo(self._secret + file_name + hex_timestamp)
-        return digest
+    def _get_digest(self, file_name, hex_timestamp):
+        """Generate a digest message for ``file_name``."""
+        digest = self._hash_algo(self._secret + file_name + hex_timestamp)
+        return digest
+
+    @staticmethod
+    def _to_hex_timestamp(time):
+        """
+        Convert :class:`datetime` ``time`` instance to a hexadecimal timestamp
+        string.
+
+        """
+        time_decimal = mktime(time.timetuple())
+        time_hex = "%x" % int(time_decimal)
+        return time_hex
+
+        # }
+
+
+class _BuiltinHashWrapper(object):
+    """Wrapper for the built-in hash functions in the standard library."""
+
+    def __init__(self, algorithm_name):
+        self._algorithm_name = algorithm_name
+
+    def __call__(self, contents):
+        encoded_contents = contents.encode('utf8')
+
+        hash = hashlib.new(self._algorithm_name)
+        hash.update(encoded_contents)
+
+        digest = hash.hexdigest()
+
+        return digest
+
+
+class AuthTokenApplication(XSendfileApplication):
+    """
+    WSGI application that serves static files at URL paths that are valid for
+    a determined time.
+
+    """
+
+    _PATH_RE = \
+        re.compile(r'^/(?P<digest>\w+)-(?P<timestamp>[a-f0-9]+)/(?P<file>.+)')
+
+    def __init__(self, root_directory, token_config, file_sender=None,
+                 token_usage_store=None, token_revocation_list=None,
+                 cache_policy=None, content_digest_store=None,
+                 hot_file_tracker=None, content_type_resolver=None):
+        """
+
+        :param root_directory: The absolute path to the root directory.
+        :type root_directory: :class:`basestring`
+        :param token_config: The token configuration object.
+        :type token_config: :class:`TokenConfig`
+        :param file_sender: The application to use to send the requested file;
+            defaults to the standard X-Sendfile.
+        :type file_sender: a string of ``standard``, ``nginx`` or ``serve``,
+            or a WSGI application.
+        :param token_usage_store: The store that limits the number of times
+            each token can be used, if any.
+        :type token_usage_store: :class:`SQLiteTokenUsageStore`
+        :param token_revocation_list: The list of tokens revoked before their
+            expiry, if any.
+        :type token_revocation_list: :class:`TokenRevocationList`
+        :param cache_policy: The rules for the ``Cache-Control`` header of the
+            files served, if any. The ``max-age`` never exceeds the remaining
+            lifetime of the token, and the files are sent with
+            ``Cache-Control: private, no-store`` instead when there's a
+            ``token_usage_store`` or a ``token_revocation_list``.
+        :type cache_policy: :class:`CachePolicy`
+        :param content_digest_store: The store of the digests of the files,
+            if the responses should have a strong ``ETag`` and a ``Digest``
+            header.
+        :type content_digest_store: :class:`ContentDigestStore`
+        :param hot_file_tracker: The tracker of the files requested most often,
+            if any.
+        :type hot_file_tracker: :class:`HotFileTracker`
+        :param content_type_resolver: The resolver of the MIME types of the
+            files served; defaults to one with the types built into Python.
+        :type content_type_resolver: :class:`ContentTypeResolver`
+
+        """
+        super(AuthTokenApplication, self).__init__(
+            root_directory,
+            file_sender,
+            cache_policy=cache_policy,
+            content_digest_store=content_digest_store,
+            hot_file_tracker=hot_file_tracker,
+            content_type_resolver=content_type_resolver,
+        )
+        self._token_config = token_config
+        self._token_usage_store = token_usage_store
+        self._token_revocation_list = token_revocation_list
+
+    def __call__(self, environ, start_response):
+        matches = self._PATH_RE.match(environ['PATH_INFO'])
+
+        if matches:
+            digest = matches.group("digest")
+            file_path_encoded = matches.group("file")
+            file_path = _decode_path(file_path_encoded)
+
+            timestamp_hexadecimal = matches.group("timestamp")
+            timestamp_decimal = int(timestamp_hexadecimal, 16)
+            time = datetime.fromtimestamp(timestamp_decimal)
+
+            environ['xsendfile.token_digest'] = digest
+            environ['xsendfile.token_time'] = timestamp_decimal
+
+            token_config = self._token_config
+            if not token_config.is_current(time):
+                response = _GONE_RESPONSE
+            elif not token_config.is_valid_digest(digest, file_path, time):
+                response = _NOT_FOUND_RESPONSE
+            elif self._is_token_revoked(digest):
+                response = _GONE_RESPONSE
+            else:
+                path_info = '/' + file_path_encoded
+                environ['PATH_INFO'] = path_info
+                environ['xsendfile.decoded_path_info'] = \
+                    (path_info, '/' + file_path)
+                environ['xsendfile.token_deadline'] = \
+                    token_config.get_deadline(time)
+                response = super(AuthTokenApplication, self).__call__
+
+                if self._token_usage_store is not None or \
+                        self._token_revocation_list is not None:
+                    # Files served from a cache would escape the limits:
+                    start_response = \
+                        _wrap_start_response_without_caching(start_response)
+
+        else:
+            # The request path didn't match our expected pattern:
+            response = _NOT_FOUND_RESPONSE
+
+        return response(environ, start_response)
+
+    def _is_token_revoked(self, digest):
+        token_revocation_list = self._token_revocation_list
+        if token_revocation_list is None:
+            return False
+
+        return token_revocation_list.is_revoked(digest)
+
+    def _get_denial_response(self, environ):
+        # The token is only used up once the method has been accepted and the
+        # file has been found:
+        token_usage_store = self._token_usage_store
+        if token_usage_store is None:
+            return None
+
+        if environ['REQUEST_METHOD'].upper() == "HEAD":
+            # The file isn't sent, so the token isn't used up:
+            return None
+
+        deadline = environ['xsendfile.token_deadline']
+        deadline_timestamp = mktime(deadline.timetuple())
+        try:
+            is_token_available = token_usage_store.consume(
+                environ['xsendfile.token_digest'],
+                deadline_timestamp,
+            )
+        except TokenUsageStoreUnavailableError:
+            return _SERVICE_UNAVAILABLE_RESPONSE
+
+        if not is_token_available:
+            # The token was used as many times as allowed:
+            return _GONE_RESPONSE
+        return None
+
+
+class SQLiteTokenUsageStore(object):
+    """
+    Store that limits the number of times each token can be used, backed by a
+    local SQLite database in WAL mode.
+
+    The database can be shared by several processes. Entries for expired tokens
+    are deleted periodically by a background thread in each process.
+
+    """
+
+    def __init__(self, database_path, max_uses=1, compaction_interval=60):
+        """
+
+        :param database_path: The path to the SQLite database.
+        :type database_path: :class:`basestring`
+        :param max_uses: The number of times each token can be used.
+        :type max_uses: :class:`int`
+        :param compaction_interval: The time between the removal of expired
+            tokens (in seconds).
+        :type compaction_interval: :class:`int`
+
+        """
+        self._database_path = database_path
+        self._max_uses = max_uses
+        self._compaction_interval = compaction_interval
+
+        self._lock = threading.Lock()
+        self._process_id = None
+        self._connections = None
+
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS token_uses ("
+                "digest TEXT PRIMARY KEY, "
+                "uses INTEGER NOT NULL, "
+                "deadline REAL NOT NULL)",
+            )
+        connection.close()
+
+    def consume(self, digest, deadline):
+        """
+        Record a use of the token with ``digest``.
+
+        :param digest: The (hexadecimal) digest of the token.
+        :type digest: :class:`basestring`
+        :param deadline: The time when the token expires (in seconds since the
+            epoch).
+        :type deadline: :class:`float`
+        :return: Whether the token can still be used.
+        :rtype: :class:`bool`
+        :raises TokenUsageStoreUnavailableError: If the database can't be
+            updated (e.g., it's locked).
+
+        """
+        import sqlite3
+
+        try:
+            connection = self._get_connection()
+            with connection:
+                connection.execute(
+                    "INSERT OR IGNORE INTO token_uses "
+                    "(digest, uses, deadline) VALUES (?, 0, ?)",
+                    (digest, deadline),
+                )
+                cursor = connection.execute(
+                    "UPDATE token_uses SET uses = uses + 1 "
+                    "WHERE digest = ? AND uses < ?",
+                    (digest, self._max_uses),
+                )
+        except sqlite3.Error as exc:
+            raise TokenUsageStoreUnavailableError(
+                "Could not record the use of the token: %s" % exc,
+            )
+        return cursor.rowcount == 1
+
+    def compact(self):
+        """Remove the tokens which have expired."""
+        connection = self._get_connection()
+        with connection:
+            connection.execute(
+                "DELETE FROM token_uses WHERE deadline < ?",
+                (get_current_time(), ),
+            )
+
+    # { Internal utilities
+
+    def _get_connection(self):
+        process_id = os.getpid()
+        if self._process_id != process_id:
+            # The connections and the compaction thread in the parent process
+            # (if any) cannot be used after a fork:
+            with self._lock:
+                if self._process_id != process_id:
+                    self._connections = threading.local()
+                    self._start_compaction_thread()
+                    self._process_id = process_id
+
+        connections = self._connections
+        connection = getattr(connections, "connection", None)
+        if connection is None:
+            connection = self._connect()
+            connections.connection = connection
+
+        return connection
+
+    def _connect(self):
+        import sqlite3
+        connection = sqlite3.connect(self._database_path, timeout=5)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _start_compaction_thread(self):
+        compaction_thread = threading.Thread(target=self._run_compactions)
+        compaction_thread.daemon = True
+        compaction_thread.start()
+
+    def _run_compactions(self):
+        import sqlite3
+
+        while True:
+            sleep(self._compaction_interval)
+            try:
+                self.compact()
+            except sqlite3.Error:  # pragma:no cover
+                # The database is busy, so try again later:
+                pass
+
+    # }
+
+
+class TokenRevocationList(object):
+    """
+    List of tokens revoked before their expiry, stored in a file of fixed-size
+    records.
+
+    Tokens are revoked by appending a record to the file, so any process can
+    revoke them. Each process loads the records into an in-memory set, which
+    is rebuilt when the file changes, so the lookups are done in constant
+    time.
+
+    The appends and the compactions are serialized with an exclusive lock on
+    a separate file next to the list (with the ``.lock`` suffix), so that no
+    revocation is lost while the list is being compacted.
+
+    """
+
+    # The MD5 digest of the token digest and the token generation timestamp:
+    _RECORD = struct.Struct("=16sQ")
+
+    def __init__(self, file_path, reload_interval=1):
+        """
+
+        :param file_path: The path to the file with the revoked tokens.
+        :type file_path: :class:`basestring`
+        :param reload_interval: The minimum time between checks for changes
+            in the file (in seconds).
+        :type reload_interval: :class:`int`
+
+        """
+        self._file_path = file_path
+        self._reload_interval = reload_interval
+
+        self._lock = threading.Lock()
+        self._next_reload_check = 0
+        self._file_signature = None
+        self._revoked_keys = frozenset()
+
+    def revoke(self, digest, generation_time):
+        """
+        Revoke the token with ``digest``.
+
+        :param digest: The (hexadecimal) digest of the token.
+        :type digest: :class:`basestring`
+        :param generation_time: The time when the token was generated.
+        :type generation_time: :class:`datetime.datetime`
+
+        """
+        record = self._RECORD.pack(
+            self._get_key(digest),
+            int(mktime(generation_time.timetuple())),
+        )
+        self._append_records([record])
+
+    def is_revoked(self, digest):
+        """
+        Report whether the token with ``digest`` has been revoked.
+
+        :param digest: The (hexadecimal) digest of the token.
+        :type digest: :class:`basestring`
+        :rtype: :class:`bool`
+
+        """
+        if self._next_reload_check <= get_current_time():
+            self._reload()
+
+        return self._get_key(digest) in self._revoked_keys
+
+    def compact(self, token_config):
+        """
+        Remove the tokens which have expired anyway according to
+        ``token_config``.
+
+        :param token_config: The configuration of the revoked tokens.
+        :type token_config: :class:`TokenConfig`
+
+        """
+        now = datetime.now()
+        lock_file_descriptor = self._lock_file()
+        try:
+            current_records = []
+            for key, timestamp in self._read_records():
+                generation_time = datetime.fromtimestamp(timestamp)
+                if now <= token_config.get_deadline(generation_time):
+                    current_records.append(self._RECORD.pack(key, timestamp))
+
+            temporary_file_path = \
+                "%s.%s.tmp" % (self._file_path, os.getpid())
+            with open(temporary_file_path, "wb") as temporary_file:
+                temporary_file.write(b"".join(current_records))
+            os.rename(temporary_file_path, self._file_path)
+        finally:
+            os.close(lock_file_descriptor)
+
+    # { Internal utilities
+
+    @staticmethod
+    def _get_key(digest):
+        return hashlib.md5(digest.encode("utf8")).digest()
+
+    def _append_records(self, records):
+        lock_file_descriptor = self._lock_file()
+        try:
+            file_descriptor = os.open(
+                self._file_path,
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0o644,
+            )
+            try:
+                os.write(file_descriptor, b"".join(records))
+            finally:
+                os.close(file_descriptor)
+        finally:
+            os.close(lock_file_descriptor)
+
+    def _lock_file(self):
+        """
+        Return a descriptor to the lock file, locked exclusively until it's
+        closed.
+
+        The list itself can't be locked because it's replaced on compaction.
+
+        """
+        lock_file_descriptor = os.open(
+            self._file_path + ".lock",
+            os.O_RDWR | os.O_CREAT,
+            0o644,
+        )
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file_descriptor, fcntl.LOCK_EX)
+            except (IOError, OSError):
+                os.close(lock_file_descriptor)
+                raise
+        return lock_file_descriptor
+
+    def _reload(self):
+        with self._lock:
+            self._next_reload_check = \
+                get_current_time() + self._reload_interval
+
+            try:
+                file_stat = os.stat(self._file_path)
+            except OSError:
+                file_stat = None
+
+            if file_stat is None:
+                file_signature = None
+            else:
+                file_signature = (
+                    file_stat.st_ino,
+                    file_stat.st_mtime,
+                    file_stat.st_size,
+                )
+
+            if file_signature != self._file_signature:
+                self._revoked_keys = frozenset(
+                    key for (key, _) in self._read_records())
+                self._file_signature = file_signature
+
+    def _read_records(self):
+        try:
+            records_file = open(self._file_path, "rb")
+        except IOError:
+            return []
+
+        with records_file:
+            file_size = os.fstat(records_file.fileno()).st_size
+            # Ignore any record still being written:
+            file_size -= file_size % self._RECORD.size
+            if not file_size:
+                return []
+
+            records_mmap = mmap.mmap(
+                records_file.fileno(),
+                file_size,
+                access=mmap.ACCESS_READ,
+            )
+            try:
+                records = [
+                    self._RECORD.unpack_from(records_mmap, offset)
+                    for offset in range(0, file_size, self._RECORD.size)
+                ]
+            finally:
+                records_mmap.close()
+
+        return records
+
+    # }
+
+
+# { Archive application
+
+
+class ZipArchiveApplication(XSendfileApplication):
+    """
+    WSGI application which streams a ZIP archive of several files in the root
+    directory.
+
+    The files and directories to be archived are given in the ``file``
+    parameters of the query string, and the name of the archive in the
+    ``PATH_INFO``. If a token configuration is set, the ``PATH_INFO`` must
+    follow the pattern ``/<token>-<timestamp-in-hex>/<archive-name>``, with
+    the token computed for the whole list of files.
+
+    The archive is generated on the fly and the memory used doesn't depend on
+    the size of the files. Its size is known in advance (and therefore set in
+    ``Content-Length``) unless it's compressed.
+
+    """
+
+    _CHUNK_SIZE = 64 * 1024
+
+    _DEFLATE_LEVEL = 6
+
+    # Version 4.5 of the ZIP specification introduced the ZIP64 format:
+    _ZIP_VERSION = 45
+
+    # Data descriptor and UTF-8 names:
+    _ZIP_FLAGS = 0x08 | 0x800
+
+    _ZIP_METHOD_STORED = 0
+
+    _ZIP_METHOD_DEFLATED = 8
+
+    _ZIP64_MARKER = 0xffffffff
+
+    _LOCAL_FILE_HEADER = struct.Struct("<IHHHHHIIIHH")
+
+    _LOCAL_FILE_ZIP64_EXTRA = struct.Struct("<HHQQ")
+
+    _DATA_DESCRIPTOR = struct.Struct("<IIQQ")
+
+    _CENTRAL_DIRECTORY_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+
+    _CENTRAL_DIRECTORY_ZIP64_EXTRA = struct.Struct("<HHQQQ")
+
+    _ZIP64_END_OF_CENTRAL_DIRECTORY = struct.Struct("<IQHHIIQQQQ")
+
+    _ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR = struct.Struct("<IIQI")
+
+    _END_OF_CENTRAL_DIRECTORY = struct.Struct("<IHHHHIIH")
+
+    def __init__(self, root_directory, token_config=None, compress=False,
+                 metadata_cache=None, file_system_guard=None):
+        """
+
+        :param root_directory: The absolute path to the root directory.
+        :type root_directory: :class:`basestring`
+        :param token_config: The token configuration object, if the URLs
+            should be protected.
+        :type token_config: :class:`TokenConfig`
+        :param compress: Whether the files should be deflated.
+        :type compress: :class:`bool`
+        :param metadata_cache: The cache for the resolved paths and the status
+            of the requested files, if any.
+        :type metadata_cache: :class:`SharedMetadataCache`
+        :param file_system_guard: The guard that bounds the time taken to
+            look up the requested files, if any.
+        :type file_system_guard: :class:`FileSystemGuard`
+        :raises BadRootError: If the root directory is not an existing directory
+            or is contained in a symbolic link
+
+        """
+        super(ZipArchiveApplication, self).__init__(
+            root_directory,
+            metadata_cache=metadata_cache,
+            file_system_guard=file_system_guard,
+        )
+        self._token_config = token_config
+        self._compress = compress
+
+    def __call__(self, environ, start_response):
+        """
+        Stream the archive if and only if the request method is GET, the token
+        (if required) is valid and all the files exist within the root
+        directory.
+
+        Otherwise, return an error response.
+
+        """
+        query_string_arguments = parse_qs(environ.get('QUERY_STRING', ""))
+        file_names = [
+            _decode_query_string_value(file_name)
+            for file_name in query_string_arguments.get("file", [])
+        ]
+
+        if environ['REQUEST_METHOD'].upper() != "GET":
+            response = _INVALID_ARCHIVE_METHOD_RESPONSE
+
+        elif not file_names:
+            response = _NOT_FOUND_RESPONSE
+
+        else:
+            response = self._check_token(environ, file_names)
+
+        if response is None:
+            try:
+                archive_members = self._get_archive_members(file_names)
+            except FileSystemUnavailableError:
+                return self._file_system_guard._unavailable_response(
+                    environ,
+                    start_response,
+                )
+
+            if archive_members is None:
+                response = _FORBIDDEN_RESPONSE
+            elif not archive_members:
+                response = _NOT_FOUND_RESPONSE
+            else:
+                archive_name = environ['xsendfile.archive_name']
+                return self._send_archive(
+                    archive_name,
+                    archive_members,
+                    start_response,
+                )
+
+        return response(environ, start_response)
+
+    def _check_token(self, environ, file_names):
+        """
+        Set the archive name in the ``environ`` if the URL path is valid, or
+        return the error response otherwise.
+
+        """
+        token_config = self._token_config
+        if token_config is None:
+            archive_name = _get_decoded_path_info(environ).strip("/")
+            if not archive_name:
+                return _NOT_FOUND_RESPONSE
+
+        else:
+            matches = AuthTokenApplication._PATH_RE.match(environ['PATH_INFO'])
+            if not matches:
+                return _NOT_FOUND_RESPONSE
+
+            digest = matches.group("digest")
+            timestamp_decimal = int(matches.group("timestamp"), 16)
+            time = datetime.fromtimestamp(timestamp_decimal)
+
+            if not token_config.is_current(time):
+                return _GONE_RESPONSE
+
+            file_names_joined = "\n".join(file_names)
+            if not token_config.is_valid_digest(
+                    digest, file_names_joined, time):
+                return _NOT_FOUND_RESPONSE
+
+            archive_name = _decode_path(matches.group("file"))
+
+        environ['xsendfile.archive_name'] = path.basename(archive_name)
+        return None
+
+    def _get_archive_members(self, file_names):
+        """
+        Return the name in the archive, absolute path and status of each file
+        to be archived, with the directories expanded.
+
+        :data:`None` is returned if any file is outside of the root directory,
+        and an empty list if any file doesn't exist.
+
+        The names are normalized (e.g., ``a//b/../c.txt`` becomes ``a/c.txt``)
+        and each file is only archived once, even if it's requested several
+        times.
+
+        """
+        archive_members = []
+        archive_member_names = set()
+        for file_name in file_names:
+            relative_file_path = "/" + file_name.lstrip("/")
+            absolute_file_path, file_stat = \
+                self._resolve_file(relative_file_path)
+
+            if absolute_file_path is None:
+                return None
+
+            if file_stat is None:
+                return []
+
+            if stat.S_ISDIR(file_stat.st_mode):
+                file_members = \
+                    self._get_directory_members(absolute_file_path)
+            elif stat.S_ISREG(file_stat.st_mode):
+                archive_member_name = \
+                    _normalize_path(relative_file_path).lstrip("/")
+                file_members = \
+                    [(archive_member_name, absolute_file_path, file_stat)]
+            else:
+                return []
+
+            for archive_member in file_members:
+                # Extractors reject duplicate entries or overwrite the files:
+                if archive_member[0] not in archive_member_names:
+                    archive_member_names.add(archive_member[0])
+                    archive_members.append(archive_member)
+
+        return archive_members
+
+    def _get_directory_members(self, absolute_directory_path):
+        root_directory_length = len(self._root_directory)
+        for directory_path, directory_names, file_names in \
+                os.walk(absolute_directory_path):
+            directory_names.sort()
+            for file_name in sorted(file_names):
+                relative_file_path = \
+                    path.join(directory_path, file_name)[root_directory_length:]
+                absolute_file_path, file_stat = \
+                    self._resolve_file(relative_file_path)
+
+                if file_stat is not None and stat.S_ISREG(file_stat.st_mode):
+                    archive_name = relative_file_path.lstrip("/")
+                    yield archive_name, absolute_file_path, file_stat
+
+    def _send_archive(self, archive_name, archive_members, start_response):
+        archive_name_encoded = _encode_path(archive_name)
+        headers = [
+            ("Content-Type", "application/zip"),
+            (
+                "Content-Disposition",
+                "attachment; filename*=UTF-8''%s" % archive_name_encoded,
+            ),
+        ]
+
+        if not self._compress:
+            archive_size = self._get_archive_size(archive_members)
+            headers.append(("Content-Length", str(archive_size)))
+
+        start_response("200 OK", headers)
+        return self._generate_archive(archive_members)
+
+    def _get_archive_size(self, archive_members):
+        archive_size = \
+            self._ZIP64_END_OF_CENTRAL_DIRECTORY.size + \
+            self._ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR.size + \
+            self._END_OF_CENTRAL_DIRECTORY.size
+
+        for archive_name, _, file_stat in archive_members:
+            archive_name_length = len(archive_name.encode("utf8"))
+            archive_size += \
+                self._LOCAL_FILE_HEADER.size + \
+                self._LOCAL_FILE_ZIP64_EXTRA.size + \
+                file_stat.st_size + \
+                self._DATA_DESCRIPTOR.size + \
+                self._CENTRAL_DIRECTORY_HEADER.size + \
+                self._CENTRAL_DIRECTORY_ZIP64_EXTRA.size + \
+                2 * archive_name_length
+
+        return archive_size
+
+    def _generate_archive(self, archive_members):
+        if self._compress:
+            method = self._ZIP_METHOD_DEFLATED
+        else:
+            method = self._ZIP_METHOD_STORED
+
+        offset = 0
+        central_directory_headers = []
+        for archive_name, absolute_file_path, file_stat in archive_members:
+            archive_name_encoded = archive_name.encode("utf8")
+            dos_time, dos_date = _get_dos_time_and_date(file_stat.st_mtime)
+
+            local_file_header = self._LOCAL_FILE_HEADER.pack(
+                0x04034b50,
+                self._ZIP_VERSION,
+                self._ZIP_FLAGS,
+                method,
+                dos_time,
+                dos_date,
+                0,
+                self._ZIP64_MARKER,
+                self._ZIP64_MARKER,
+                len(archive_name_encoded),
+                self._LOCAL_FILE_ZIP64_EXTRA.size,
+            )
+            local_file_zip64_extra = self._LOCAL_FILE_ZIP64_EXTRA.pack(
+                0x0001,
+                self._LOCAL_FILE_ZIP64_EXTRA.size - 4,
+                0,
+                0,
+            )
+            yield local_file_header + archive_name_encoded + \
+                local_file_zip64_extra
+
+            crc = 0
+            compressed_size = 0
+            if self._compress:
+                compressor = zlib.compressobj(
+                    self._DEFLATE_LEVEL,
+                    zlib.DEFLATED,
+                    -zlib.MAX_WBITS,
+                )
+            else:
+                compressor = None
+
+            for chunk in self._read_file(absolute_file_path, file_stat):
+                crc = zlib.crc32(chunk, crc)
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    compressed_size += len(chunk)
+                    yield chunk
+
+            if compressor is not None:
+                chunk = compressor.flush()
+                compressed_size += len(chunk)
+                yield chunk
+
+            crc &= 0xffffffff
+            yield self._DATA_DESCRIPTOR.pack(
+                0x08074b50,
+                crc,
+                compressed_size,
+                file_stat.st_size,
+            )
+
+            central_directory_header = self._CENTRAL_DIRECTORY_HEADER.pack(
+                0x02014b50,
+                self._ZIP_VERSION | (3 << 8),
+                self._ZIP_VERSION,
+                self._ZIP_FLAGS,
+                method,
+                dos_time,
+                dos_date,
+                crc,
+                self._ZIP64_MARKER,
+                self._ZIP64_MARKER,
+                len(archive_name_encoded),
+                self._CENTRAL_DIRECTORY_ZIP64_EXTRA.size,
+                0,
+                0,
+                0,
+                (file_stat.st_mode & 0xffff) << 16,
+                self._ZIP64_MARKER,
+            )
+            central_directory_zip64_extra = \
+                self._CENTRAL_DIRECTORY_ZIP64_EXTRA.pack(
+                    0x0001,
+                    self._CENTRAL_DIRECTORY_ZIP64_EXTRA.size - 4,
+                    file_stat.st_size,
+                    compressed_size,
+                    offset,
+                )
+            central_directory_headers.append(
+                central_directory_header + archive_name_encoded +
+                central_directory_zip64_extra
+            )
+
+            offset += \
+                self._LOCAL_FILE_HEADER.size + \
+                len(archive_name_encoded) + \
+                self._LOCAL_FILE_ZIP64_EXTRA.size + \
+                compressed_size + \
+                self._DATA_DESCRIPTOR.size
+
+        central_directory = b"".join(central_directory_headers)
+        yield central_directory
+
+        entry_count = len(central_directory_headers)
+        zip64_end_of_central_directory_offset = offset + len(central_directory)
+        yield self._ZIP64_END_OF_CENTRAL_DIRECTORY.pack(
+            0x06064b50,
+            self._ZIP64_END_OF_CENTRAL_DIRECTORY.size - 12,
+            self._ZIP_VERSION | (3 << 8),
+            self._ZIP_VERSION,
+            0,
+            0,
+            entry_count,
+            entry_count,
+            len(central_directory),
+            offset,
+        )
+        yield self._ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR.pack(
+            0x07064b50,
+            0,
+            zip64_end_of_central_directory_offset,
+            1,
+        )
+        yield self._END_OF_CENTRAL_DIRECTORY.pack(
+            0x06054b50,
+            0,
+            0,
+            0xffff,
+            0xffff,
+            self._ZIP64_MARKER,
+            self._ZIP64_MARKER,
+            0,
+        )
+
+    def _read_file(self, absolute_file_path, file_stat):
+        """
+        Read exactly the number of bytes in ``file_stat``, so that the archive
+        matches its ``Content-Length``.
+
+        """
+        remaining_size = file_stat.st_size
+        with open(absolute_file_path, "rb") as file_:
+            while 0 < remaining_size:
+                chunk = file_.read(min(self._CHUNK_SIZE, remaining_size))
+                if not chunk:
+                    raise IOError(
+                        "File %s was truncated while being archived" %
+                        absolute_file_path,
+                    )
+                remaining_size -= len(chunk)
+                yield chunk
+
+
+def _get_dos_time_and_date(timestamp):
+    time_tuple = localtime(timestamp)
+    dos_time = \
+        (time_tuple.tm_hour << 11) | \
+        (time_tuple.tm_min << 5) | \
+        (time_tuple.tm_sec // 2)
+    dos_date = \
+        ((max(time_tuple.tm_year, 1980) - 1980) << 9) | \
+        (time_tuple.tm_mon << 5) | \
+        time_tuple.tm_mday
+    return dos_time, dos_date
+
+
+def _decode_query_string_value(value):
+    if isinstance(value, bytes):
+        # Python 2:
+        value = value.decode("utf8")
+    return value
+
+
+# }
+
+
+# { Profiling
+
+
+class ProfilingMiddleware(object):
+    """
+    WSGI middleware which profiles a sample of the requests to the wrapped
+    application and periodically dumps the merged statistics.
+
+    The requests are profiled until their response is closed, including the
+    iteration over the response body. The statistics are written by a
+    background thread in each process, in the :mod:`pstats` format, to files
+    named ``profile-<pid>-<timestamp>-<sequence>.pstats``, which can be merged
+    further with :meth:`pstats.Stats.add`.
+
+    """
+
+    def __init__(self, app, output_directory, sample_rate=100,
+                 slow_request_threshold=0, dump_interval=60):
+        """
+
+        :param app: The WSGI application to be profiled.
+        :param output_directory: The directory where the statistics are
+            dumped.
+        :type output_directory: :class:`basestring`
+        :param sample_rate: The number of requests for each request profiled.
+        :type sample_rate: :class:`int`
+        :param slow_request_threshold: The minimum time (in seconds) taken by
+            the requests profiled for their statistics to be kept.
+        :type slow_request_threshold: :class:`float`
+        :param dump_interval: The time (in seconds) between dumps.
+        :type dump_interval: :class:`float`
+
+        """
+        self._app = app
+        self._output_directory = output_directory
+        self._sample_rate = sample_rate
+        self._slow_request_threshold = slow_request_threshold
+        self._dump_interval = dump_interval
+
+        self._request_counter = itertools.count()
+        self._dump_counter = itertools.count()
+
+        self._stats = None
+        self._stats_lock = threading.Lock()
+        self._process_id = None
+
+    def __call__(self, environ, start_response):
+        # Incrementing the counter is atomic, so no lock is needed here:
+        if next(self._request_counter) % self._sample_rate:
+            return self._app(environ, start_response)
+
+        self._start_dump_thread()
+        return self._profile_request(environ, start_response)
+
+    def dump(self):
+        """
+        Write the statistics gathered since the last dump, if any.
+
+        :return: The path to the file written, or :data:`None` if no request
+            was profiled.
+
+        """
+        with self._stats_lock:
+            stats = self._stats
+            self._stats = None
+
+        if stats is None:
+            return None
+
+        file_name = "profile-%s-%d-%s.pstats" % (
+            os.getpid(),
+            get_current_time(),
+            next(self._dump_counter),
+        )
+        file_path = path.join(self._output_directory, file_name)
+        stats.dump_stats(file_path)
+        return file_path
+
+    def _profile_request(self, environ, start_response):
+        from cProfile import Profile
+
+        profile = Profile()
+        start_time = get_current_time()
+        try:
+            profile.enable()
+        except ValueError:  # pragma:no cover
+            # Another profiler is active:
+            return self._app(environ, start_response)
+
+        try:
+            app_iter = self._app(environ, start_response)
+        finally:
+            profile.disable()
+
+        return _ProfiledResponse(self, app_iter, profile, start_time)
+
+    def _add_profile(self, profile, start_time):
+        from pstats import Stats
+
+        if get_current_time() - start_time < self._slow_request_threshold:
+            return
+
+        with self._stats_lock:
+            if self._stats is None:
+                self._stats = Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    def _start_dump_thread(self):
+        process_id = os.getpid()
+        if self._process_id == process_id:
+            return
+
+        # Threads don't survive a fork, so each process needs its own:
+        with self._stats_lock:
+            if self._process_id != process_id:
+                # The statistics inherited from the parent process (if any)
+                # are left to the parent:
+                self._stats = None
+                dump_thread = threading.Thread(target=self._run_dumps)
+                dump_thread.daemon = True
+                dump_thread.start()
+                self._process_id = process_id
+
+    def _run_dumps(self):
+        while True:
+            sleep(self._dump_interval)
+            try:
+                self.dump()
+            except (IOError, OSError):  # pragma:no cover
+                # The disk may be full, so try again later:
+                pass
+
+
+class _ProfiledResponse(object):
+    """
+    WSGI response body which keeps profiling the request while the body is
+    iterated over, until it's closed.
+
+    """
+
+    def __init__(self, middleware, app_iter, profile, start_time):
+        self._middleware = middleware
+        self._app_iter = app_iter
+        self._profile = profile
+        self._start_time = start_time
+        self._is_closed = False
+
+    def __iter__(self):
+        profile = self._profile
+        profile.enable()
+        try:
+            app_iter = iter(self._app_iter)
+        finally:
+            profile.disable()
+
+        while True:
+            profile.enable()
+            try:
+                chunk = next(app_iter)
+            except StopIteration:
+                return
+            finally:
+                profile.disable()
+            yield chunk
+
+    def close(self):
+        if self._is_closed:
+            return
+        self._is_closed = True
+
+        try:
+            if hasattr(self._app_iter, "close"):
+                self._profile.enable()
+                try:
+                    self._app_iter.close()
+                finally:
+                    self._profile.disable()
+        finally:
+            self._middleware._add_profile(self._profile, self._start_time)
+
+
+# }
+
+
+# { Access log
+
+
+class AccessLogMiddleware(object):
+    """
+    WSGI middleware which records each request to the wrapped application in a
+    log file of JSON lines, without writing to disk on the request path.
+
+    The records are queued in a bounded buffer and written in batches by a
+    background thread in each process. When the buffer is full, new records
+    are dropped and counted, and so are the records in a batch that couldn't
+    be written; the number of records dropped since the previous batch is
+    written as ``{"dropped_records": <count>, "time": <timestamp>}``.
+
+    Each record has the following fields:
+
+    - ``time``: The time when the request started (in seconds since the
+      epoch).
+    - ``method`` and ``path``: The request method and the ``PATH_INFO``, as
+      received.
+    - ``file``: The absolute path to the file served, if any.
+    - ``digest`` and ``token_age``: The digest of the token and the time
+      elapsed since it was generated (in seconds), for the requests to
+      :class:`AuthTokenApplication` with a well-formed token.
+    - ``status``: The status code, if the response was started.
+    - ``bytes``: The ``Content-Length`` of the response, if set to a valid
+      number.
+    - ``latency``: The time taken until the response was returned by the
+      wrapped application (in seconds).
+
+    The requests are also recorded when the wrapped application raises an
+    exception.
+
+    """
+
+    _FIELD_NAMES = (
+        "time",
+        "method",
+        "path",
+        "file",
+        "digest",
+        "token_age",
+        "status",
+        "bytes",
+        "latency",
+    )
+
+    def __init__(self, app, log_file_path, buffer_size=64 * 1024,
+                 flush_interval=1):
+        """
+
+        :param app: The WSGI application whose requests should be logged.
+        :param log_file_path: The path to the log file, which can be shared
+            by several processes.
+        :type log_file_path: :class:`basestring`
+        :param buffer_size: The maximum number of records waiting to be
+            written.
+        :type buffer_size: :class:`int`
+        :param flush_interval: The time between writes (in seconds).
+        :type flush_interval: :class:`float`
 
-    @staticmethod
-    def _to_hex_timestamp(time):
         """
-        Convert :class:`datetime` ``time`` instance to a hexadecimal timestamp
-        string.
+        self._app = app
+        self._log_file_path = log_file_path
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
 
+        self._records = deque()
+        self._lock = threading.Lock()
+        self._process_id = None
+        self._dropped_record_count = 0
+        self._unreported_dropped_record_count = 0
+
+    @property
+    def dropped_record_count(self):
         """
-        time_decimal = mktime(time.timetuple())
-        time_hex = "%x" % int(time_decimal)
-        return time_hex
+        The number of records dropped because the buffer was full or they
+        couldn't be written.
 
-        # }
+        """
+        return self._dropped_record_count
 
+    def __call__(self, environ, start_response):
+        start_time = get_current_time()
+        method = environ.get('REQUEST_METHOD')
+        path_info = environ.get('PATH_INFO')
+        response_metadata = []
 
-class _BuiltinHashWrapper(object):
-    """Wrapper for the built-in hash functions in the standard library."""
+        def start_response_with_logging(status, headers, exc_info=None):
+            response_metadata[:] = [status, headers]
+            return start_response(status, headers, exc_info)
 
-    def __init__(self, algorithm_name):
-        self._algorithm_name = algorithm_name
+        try:
+            return self._app(environ, start_response_with_logging)
+        finally:
+            end_time = get_current_time()
+            if response_metadata:
+                status, headers = response_metadata
+                status_code = int(status[:3])
+                content_length = _get_content_length(headers)
+            else:
+                # The response will be started while the body is iterated
+                # over, or the application failed:
+                status_code = None
+                content_length = None
 
-    def __call__(self, contents):
-        encoded_contents = contents.encode('utf8')
+            token_time = environ.get('xsendfile.token_time')
+            if token_time is None:
+                token_age = None
+            else:
+                token_age = start_time - token_time
 
-        hash = hashlib.new(self._algorithm_name)
-        hash.update(encoded_contents)
+            record = (
+                start_time,
+                method,
+                path_info,
+                environ.get('xsendfile.requested_file'),
+                environ.get('xsendfile.token_digest'),
+                token_age,
+                status_code,
+                content_length,
+                end_time - start_time,
+            )
+            self._enqueue(record)
 
-        digest = hash.hexdigest()
+    def flush(self):
+        """Write the records in the buffer."""
+        import json
 
-        return digest
+        records = self._records
+        log_lines = []
+        while records:
+            record = records.popleft()
+            record_dict = dict(zip(self._FIELD_NAMES, record))
+            log_lines.append(json.dumps(record_dict, sort_keys=True))
 
+        with self._lock:
+            dropped_record_count = self._unreported_dropped_record_count
+            self._unreported_dropped_record_count = 0
+        if dropped_record_count:
+            log_lines.append(json.dumps(
+                {
+                    'dropped_records': dropped_record_count,
+                    'time': get_current_time(),
+                },
+                sort_keys=True,
+            ))
 
-class AuthTokenApplication(XSendfileApplication):
+        if not log_lines:
+            return
+
+        log_contents = ("\n".join(log_lines) + "\n").encode("utf8")
+        try:
+            log_file_descriptor = os.open(
+                self._log_file_path,
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0o644,
+            )
+            try:
+                # Single writes in append mode don't interleave with the ones
+                # in other processes:
+                os.write(log_file_descriptor, log_contents)
+            finally:
+                os.close(log_file_descriptor)
+        except (IOError, OSError):
+            # The records in the batch are lost, so they're reported along
+            # with the next batch:
+            lost_record_count = len(log_lines)
+            if dropped_record_count:
+                lost_record_count -= 1
+            with self._lock:
+                self._dropped_record_count += lost_record_count
+                self._unreported_dropped_record_count += \
+                    dropped_record_count + lost_record_count
+            raise
+
+    # { Internal utilities
+
+    def _enqueue(self, record):
+        process_id = os.getpid()
+        if self._process_id != process_id:
+            # The writer thread in the parent process (if any) is gone after a
+            # fork:
+            with self._lock:
+                if self._process_id != process_id:
+                    self._records = deque()
+                    self._start_writer_thread()
+                    self._process_id = process_id
+
+        records = self._records
+        if len(records) < self._buffer_size:
+            records.append(record)
+        else:
+            with self._lock:
+                self._dropped_record_count += 1
+                self._unreported_dropped_record_count += 1
+
+    def _start_writer_thread(self):
+        writer_thread = threading.Thread(target=self._run_writes)
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    def _run_writes(self):
+        while True:
+            sleep(self._flush_interval)
+            try:
+                self.flush()
+            except (IOError, OSError):  # pragma:no cover
+                # The disk may be full, so try again later:
+                pass
+
+    # }
+
+
+def _get_content_length(headers):
+    for header_name, header_value in headers:
+        if header_name.lower() == "content-length":
+            try:
+                return int(header_value)
+            except ValueError:
+                return None
+    return None
+
+
+# }
+
+
+# { Hot files
+
+
+class HotFileTracker(object):
     """
-    WSGI application that serves static files at URL paths that are valid for
-    a determined time.
+    Tracker of the files requested most often, in a fixed amount of memory.
+
+    The number of requests and the bytes served for each file are estimated
+    with count-min sketches, and only the ``capacity`` files with the highest
+    estimates are remembered. The counts are multiplied by ``decay_factor``
+    every ``decay_interval`` seconds, so that files which are no longer
+    requested fall out of the hot list eventually.
+
+    The tracker is also a WSGI application which returns the hot files as
+    JSON, so it can be mounted at an internal URL.
 
     """
 
-    _PATH_RE = \
-        re.compile(r'^/(?P<digest>\w+)-(?P<timestamp>[a-f0-9]+)/(?P<file>.+)')
+    def __init__(self, capacity=100, sketch_width=4096, sketch_depth=4,
+                 decay_interval=3600, decay_factor=0.5):
+        """
+
+        :param capacity: The number of hot files to remember.
+        :type capacity: :class:`int`
+        :param sketch_width: The number of counters in each row of the
+            sketches. The error of the estimates is inversely proportional to
+            it.
+        :type sketch_width: :class:`int`
+        :param sketch_depth: The number of rows in the sketches. The
+            probability that an estimate exceeds the error decreases
+            exponentially with it.
+        :type sketch_depth: :class:`int`
+        :param decay_interval: The time between the decays of the counts (in
+            seconds), or :data:`None` to never decay them.
+        :type decay_interval: :class:`int`
+        :param decay_factor: The factor by which the counts are multiplied on
+            each decay.
+        :type decay_factor: :class:`float`
 
-    def __init__(self, root_directory, token_config, file_sender=None):
         """
+        self._capacity = capacity
+        self._sketch_width = sketch_width
+        self._sketch_depth = sketch_depth
+        self._decay_interval = decay_interval
+        self._decay_factor = decay_factor
 
-        :param root_directory: The absolute path to the root directory.
-        :type root_directory: :class:`basestring`
-        :param token_config: The token configuration object.
-        :type token_config: :class:`TokenConfig`
-        :param file_sender: The application to use to send the requested file;
-            defaults to the standard X-Sendfile.
-        :type file_sender: a string of ``standard``, ``nginx`` or ``serve``,
-            or a WSGI application.
+        self._request_count_sketch = \
+            [[0] * sketch_width for _ in range(sketch_depth)]
+        self._byte_count_sketch = \
+            [[0] * sketch_width for _ in range(sketch_depth)]
+
+        # The estimated request count of each hot file, along with a min-heap
+        # of the same counts to find the coldest hot file. Entries in the heap
+        # may be outdated, in which case they're lower than the actual count:
+        self._hot_file_request_counts = {}
+        self._hot_file_heap = []
+
+        self._lock = threading.Lock()
+        self._last_decay_time = get_current_time()
 
+    def record(self, relative_file_path, byte_count):
+        """Record a request for ``relative_file_path``."""
+        counter_indices = self._get_counter_indices(relative_file_path)
+
+        with self._lock:
+            if self._decay_interval is not None:
+                current_time = get_current_time()
+                if self._decay_interval <= \
+                        current_time - self._last_decay_time:
+                    self._decay()
+                    self._last_decay_time = current_time
+
+            request_count = _increment_sketch(
+                self._request_count_sketch,
+                counter_indices,
+                1,
+            )
+            _increment_sketch(
+                self._byte_count_sketch,
+                counter_indices,
+                byte_count,
+            )
+            self._update_hot_files(relative_file_path, request_count)
+
+    def get_hot_files(self, limit=None):
         """
-        super(AuthTokenApplication, self).__init__(root_directory, file_sender)
-        self._token_config = token_config
+        Return the hot files, starting with the file requested most often.
+
+        :param limit: The maximum number of files to return, if any.
+        :type limit: :class:`int`
+        :return: The relative path to each file, with the estimated number of
+            requests and bytes served.
+        :rtype: :class:`list` of :class:`tuple`
+
+        """
+        with self._lock:
+            hot_file_paths = list(self._hot_file_request_counts)
+            hot_files = []
+            for relative_file_path in hot_file_paths:
+                counter_indices = self._get_counter_indices(relative_file_path)
+                hot_files.append((
+                    relative_file_path,
+                    self._hot_file_request_counts[relative_file_path],
+                    _estimate_from_sketch(
+                        self._byte_count_sketch,
+                        counter_indices,
+                    ),
+                ))
+
+        hot_files.sort(key=lambda hot_file: (-hot_file[1], hot_file[0]))
+        return hot_files[:limit]
 
     def __call__(self, environ, start_response):
-        matches = self._PATH_RE.match(environ['PATH_INFO'])
+        """
+        Return the hot files as JSON, limited to the number of files in the
+        ``limit`` query string argument if any.
 
-        if matches:
-            digest = matches.group("digest")
-            file_path_encoded = matches.group("file")
-            file_path = _decode_path(file_path_encoded)
+        """
+        import json
 
-            timestamp_hexadecimal = matches.group("timestamp")
-            timestamp_decimal = int(timestamp_hexadecimal, 16)
-            time = datetime.fromtimestamp(timestamp_decimal)
+        query_string_arguments = parse_qs(environ.get('QUERY_STRING', ""))
+        limit = query_string_arguments.get('limit', [None])[0]
+        try:
+            limit = int(limit) if limit else None
+        except ValueError:
+            limit = None
 
-            token_config = self._token_config
-            if not token_config.is_current(time):
-                response = _GONE_RESPONSE
-            elif not token_config.is_valid_digest(digest, file_path, time):
-                response = _NOT_FOUND_RESPONSE
+        hot_files = [
+            {'path': path_, 'requests': request_count, 'bytes': byte_count}
+            for path_, request_count, byte_count in self.get_hot_files(limit)
+        ]
+        body = json.dumps(hot_files).encode("utf8")
+        start_response("200 OK", [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(body))),
+            ("Cache-Control", "no-store"),
+        ])
+        return [body]
+
+    def _get_counter_indices(self, relative_file_path):
+        # Each row gets a different index from two independent hashes, as
+        # described by Kirsch and Mitzenmacher:
+        file_path_hash = hashlib.md5(
+            _encode_file_system_path(relative_file_path),
+        ).digest()
+        first_hash, second_hash = struct.unpack("<QQ", file_path_hash)
+        sketch_width = self._sketch_width
+        return [
+            (first_hash + row_index * second_hash) % sketch_width
+            for row_index in range(self._sketch_depth)
+        ]
+
+    def _update_hot_files(self, relative_file_path, request_count):
+        hot_file_request_counts = self._hot_file_request_counts
+        hot_file_heap = self._hot_file_heap
+
+        if relative_file_path in hot_file_request_counts:
+            hot_file_request_counts[relative_file_path] = request_count
+            return
+
+        if len(hot_file_request_counts) < self._capacity:
+            hot_file_request_counts[relative_file_path] = request_count
+            heapq.heappush(hot_file_heap, (request_count, relative_file_path))
+            return
+
+        # Bring the coldest hot file to the top of the heap:
+        while True:
+            heap_request_count, coldest_file_path = hot_file_heap[0]
+            current_request_count = \
+                hot_file_request_counts[coldest_file_path]
+            if heap_request_count == current_request_count:
+                break
+            heapq.heapreplace(
+                hot_file_heap,
+                (current_request_count, coldest_file_path),
+            )
+
+        if heap_request_count < request_count:
+            del hot_file_request_counts[coldest_file_path]
+            heapq.heapreplace(
+                hot_file_heap,
+                (request_count, relative_file_path),
+            )
+            hot_file_request_counts[relative_file_path] = request_count
+
+    def _decay(self):
+        decay_factor = self._decay_factor
+        for sketch in (self._request_count_sketch, self._byte_count_sketch):
+            for row in sketch:
+                row[:] = [int(counter * decay_factor) for counter in row]
+
+        hot_file_request_counts = self._hot_file_request_counts
+        for relative_file_path, request_count in \
+                list(hot_file_request_counts.items()):
+            request_count = int(request_count * decay_factor)
+            if request_count:
+                hot_file_request_counts[relative_file_path] = request_count
             else:
-                environ['PATH_INFO'] = '/' + file_path_encoded
-                response = super(AuthTokenApplication, self).__call__
+                del hot_file_request_counts[relative_file_path]
 
-        else:
-            # The request path didn't match our expected pattern:
-            response = _NOT_FOUND_RESPONSE
+        self._hot_file_heap = [
+            (request_count, relative_file_path)
+            for relative_file_path, request_count in
+            hot_file_request_counts.items()
+        ]
+        heapq.heapify(self._hot_file_heap)
 
-        return response(environ, start_response)
 
+def _increment_sketch(sketch, counter_indices, increment):
+    """
+    Increment the counters of a key in ``sketch`` and return its new
+    estimate.
+
+    Only the counters equal to the current estimate are incremented (i.e.,
+    conservative update), which reduces the overestimation.
+
+    """
+    estimate = _estimate_from_sketch(sketch, counter_indices) + increment
+    for row, counter_index in zip(sketch, counter_indices):
+        if row[counter_index] < estimate:
+            row[counter_index] = estimate
+    return estimate
+
+
+def _estimate_from_sketch(sketch, counter_indices):
+    return min(
+        row[counter_index]
+        for row, counter_index in zip(sketch, counter_indices)
+    )
+
+
+# }
+
+
+# { Prewarming
+
+
+def prewarm(application, relative_file_paths, readahead_size=0):
+    """
+    Resolve the files in ``relative_file_paths`` through ``application`` and
+    load them into its caches and into the page cache.
+
+    This is meant to be run after a deployment (e.g., in each worker once it's
+    been forked), with the list of files that are requested most often. The
+    files whose lookup fails because of the :class:`FileSystemGuard` of
+    ``application`` are skipped.
+
+    :param application: The application that serves the files.
+    :type application: :class:`XSendfileApplication`
+    :param relative_file_paths: The paths to the files relative to the root
+        directory of ``application``.
+    :type relative_file_paths: iterable of :class:`basestring`
+    :param readahead_size: The number of bytes at the start of each file to
+        read into the page cache; the whole file by default.
+    :type readahead_size: :class:`int`
+    :return: The number of files found.
+    :rtype: :class:`int`
+
+    """
+    prewarm_sender = getattr(application._sender, "prewarm", None)
+
+    file_count = 0
+    for relative_file_path in relative_file_paths:
+        relative_file_path = "/" + relative_file_path.lstrip("/")
+        try:
+            absolute_file_path, file_stat = \
+                application._resolve_file(relative_file_path)
+        except FileSystemUnavailableError:
+            # The file will be looked up again when it's requested:
+            continue
+        if absolute_file_path is None or file_stat is None or \
+                not stat.S_ISREG(file_stat.st_mode):
+            continue
+
+        _prefetch_file(absolute_file_path, readahead_size)
+        if prewarm_sender is not None:
+            prewarm_sender(absolute_file_path, file_stat)
+
+        file_count += 1
+
+    return file_count
+
+
+_ACCESS_LOG_REQUEST_RE = \
+    re.compile(r'"GET (?P<path>[^ ?"]+)[^ "]* HTTP/[0-9.]+" (?P<status>\d{3}) ')
+
+
+def get_hot_paths_from_access_log(log_lines, limit=1000, path_prefix="",
+                                  strip_tokens=False):
+    """
+    Return the paths to the files requested most often in ``log_lines``, in
+    the Common or Combined Log Format.
+
+    :param log_lines: The lines in the access log.
+    :type log_lines: iterable of :class:`basestring`
+    :param limit: The maximum number of paths to return.
+    :type limit: :class:`int`
+    :param path_prefix: The prefix of the URL paths served by the application,
+        which is removed from the paths returned. Requests for other URL paths
+        are ignored.
+    :type path_prefix: :class:`basestring`
+    :param strip_tokens: Whether the URL paths were protected by
+        :class:`AuthTokenApplication`, so the tokens must be removed.
+    :type strip_tokens: :class:`bool`
+    :return: The paths relative to the root directory, from the most to the
+        least requested.
+    :rtype: :class:`list` of :class:`basestring`
+
+    """
+    request_counts = Counter()
+    for log_line in log_lines:
+        matches = _ACCESS_LOG_REQUEST_RE.search(log_line)
+        if not matches or matches.group("status") not in ("200", "304"):
+            continue
+
+        url_path = matches.group("path")
+        if not url_path.startswith(path_prefix):
+            continue
+        url_path = url_path[len(path_prefix):]
+
+        if strip_tokens:
+            token_matches = AuthTokenApplication._PATH_RE.match(url_path)
+            if not token_matches:
+                continue
+            url_path = "/" + token_matches.group("file")
+
+        request_counts[url_path] += 1
+
+    hot_paths = []
+    for url_path, _ in request_counts.most_common(limit):
+        try:
+            hot_paths.append(unquote_to_bytes(url_path).decode("utf8"))
+        except UnicodeDecodeError:
+            # The URL path was not valid UTF-8, so the file can't be served:
+            pass
+
+    return hot_paths
+
+
+# }
+
+
+# { Command line utility
+
+
+def main(arguments=None):
+    """Run the command line utility, as in ``python -m xsendfile``."""
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(prog="python -m xsendfile")
+    subparsers = parser.add_subparsers(dest="command")
+
+    prewarm_parser = subparsers.add_parser(
+        "prewarm",
+        help="Load the files requested most often into the page cache and, "
+             "optionally, a shared metadata cache. The paths are read from "
+             "the standard input unless an access log is given.",
+    )
+    prewarm_parser.add_argument("root_directory")
+    prewarm_parser.add_argument("--access-log")
+    prewarm_parser.add_argument("--limit", type=int, default=1000)
+    prewarm_parser.add_argument("--path-prefix", default="")
+    prewarm_parser.add_argument("--strip-tokens", action="store_true")
+    prewarm_parser.add_argument("--metadata-cache")
+    prewarm_parser.add_argument(
+        "--slot-count",
+        type=int,
+        help="The number of entries in a new metadata cache; existing caches "
+             "keep their own.",
+    )
+    prewarm_parser.add_argument(
+        "--slot-size",
+        type=int,
+        help="The size of the entries in a new metadata cache; existing "
+             "caches keep their own.",
+    )
+    prewarm_parser.add_argument(
+        "--timeout",
+        type=int,
+        default=5,
+        help="The time during which the entries in the metadata cache are "
+             "valid (in seconds), which should match that of the workers.",
+    )
+    prewarm_parser.add_argument("--readahead-size", type=int, default=0)
+
+    digest_parser = subparsers.add_parser(
+        "digest",
+        help="Compute the digests of the files in a directory whose digest "
+             "is missing or stale.",
+    )
+    digest_parser.add_argument("root_directory")
+    digest_parser.add_argument("--algorithm", default="sha256")
+    digest_parser.add_argument("--sidecar-directory")
+
+    arguments = parser.parse_args(arguments)
+
+    if arguments.command == "prewarm":
+        _prewarm_from_command_line(arguments)
+    elif arguments.command == "digest":
+        _update_digests_from_command_line(arguments)
+    else:
+        parser.print_usage()
+
+
+def _prewarm_from_command_line(arguments):
+    if arguments.metadata_cache:
+        metadata_cache = SharedMetadataCache(
+            arguments.metadata_cache,
+            arguments.slot_count,
+            arguments.slot_size,
+            arguments.timeout,
+        )
+    else:
+        metadata_cache = None
+    # The sender is irrelevant: Only the shared caches outlive this process.
+    application = XSendfileApplication(
+        path.abspath(arguments.root_directory),
+        XSendfile(),
+        metadata_cache,
+    )
+
+    if arguments.access_log:
+        with open(arguments.access_log) as access_log:
+            relative_file_paths = get_hot_paths_from_access_log(
+                access_log,
+                arguments.limit,
+                arguments.path_prefix,
+                arguments.strip_tokens,
+            )
+    else:
+        relative_file_paths = [
+            _decode_query_string_value(line).rstrip("\n")
+            for line in sys.stdin
+        ]
+
+    file_count = \
+        prewarm(application, relative_file_paths, arguments.readahead_size)
+    sys.stdout.write("Prewarmed %s files\n" % file_count)
+
+
+def _update_digests_from_command_line(arguments):
+    content_digest_store = ContentDigestStore(
+        arguments.algorithm,
+        arguments.sidecar_directory,
+        compute_missing=False,
+    )
+
+    file_count = 0
+    for directory_path, _, file_names in os.walk(arguments.root_directory):
+        for file_name in file_names:
+            file_path = path.join(directory_path, file_name)
+            file_stat = os.lstat(file_path)
+            if not stat.S_ISREG(file_stat.st_mode):
+                continue
+
+            if content_digest_store.get_digest(file_path, file_stat) is None:
+                content_digest_store.update(file_path)
+                file_count += 1
+
+    sys.stdout.write("Computed the digests of %s files\n" % file_count)
+
+
+# }
+
+
+# { Path resolution beneath the root directory
+
+
+_SYS_OPENAT2 = 437
+
+_RESOLVE_BENEATH = 0x08
+
+_OPENAT2_FLAGS = getattr(os, "O_PATH", 0o10000000) | \
+    getattr(os, "O_CLOEXEC", 0o2000000)
+
+
+if ctypes is not None:
+
+    class _OpenHow(ctypes.Structure):
+        _fields_ = [
+            ("flags", ctypes.c_uint64),
+            ("mode", ctypes.c_uint64),
+            ("resolve", ctypes.c_uint64),
+        ]
+
+
+def _open_resolution_root(root_directory):
+    """
+    Open ``root_directory`` so that the requested files can be resolved with
+    ``openat2()``, or return :data:`None` if it's not supported.
+
+    """
+    if not sys.platform.startswith("linux") or ctypes is None:
+        return None
+
+    try:
+        root_directory_descriptor = os.open(
+            root_directory,
+            _OPENAT2_FLAGS | getattr(os, "O_DIRECTORY", 0),
+        )
+    except OSError:
+        return None
+
+    try:
+        file_descriptor = _openat2(root_directory_descriptor, b".")
+        os.close(file_descriptor)
+        proc_file_path = "/proc/self/fd/%s" % root_directory_descriptor
+        is_supported = os.readlink(proc_file_path) == root_directory
+    except (AttributeError, OSError):
+        # The kernel is older than Linux 5.6, the system call is filtered
+        # or /proc is not mounted:
+        is_supported = False
+
+    if not is_supported:
+        os.close(root_directory_descriptor)
+        root_directory_descriptor = None
+
+    return root_directory_descriptor
+
+
+def _openat2(directory_descriptor, relative_file_path_bytes):
+    open_how = _OpenHow(_OPENAT2_FLAGS, 0, _RESOLVE_BENEATH)
+    file_descriptor = _LIBC.syscall(
+        _SYS_OPENAT2,
+        ctypes.c_int(directory_descriptor),
+        ctypes.c_char_p(relative_file_path_bytes),
+        ctypes.byref(open_how),
+        ctypes.c_size_t(ctypes.sizeof(open_how)),
+    )
+    if file_descriptor < 0:
+        error_number = ctypes.get_errno()
+        raise OSError(error_number, os.strerror(error_number))
+    return file_descriptor
+
+
+def _get_libc():
+    if ctypes is None:  # pragma:no cover
+        return None
 
-def _decode_path(path_encoded):
-    path_unquoted = unquote(path_encoded)
     try:
-        path_bytes = path_unquoted.encode('latin1')
-    except UnicodeDecodeError:
-        # "path_encoded" was already in bytes (Python 2).
-        path_bytes = path_unquoted
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:  # pragma:no cover
+        return None
+
+    libc.syscall.restype = ctypes.c_long
+    return libc
+
+
+_LIBC = _get_libc()
+
+
+def _encode_file_system_path(file_path):
+    if isinstance(file_path, bytes):
+        # Python 2:
+        return file_path
+
+    fsencode = getattr(os, "fsencode", None)
+    if fsencode is None:  # pragma:no cover
+        return file_path.encode(sys.getfilesystemencoding() or "utf8")
+    return fsencode(file_path)
+
+
+def _decode_file_system_path(file_path_bytes):
+    fsdecode = getattr(os, "fsdecode", None)
+    if fsdecode is None:  # pragma:no cover
+        # Python 2:
+        return file_path_bytes.decode(sys.getfilesystemencoding() or "utf8")
+    return fsdecode(file_path_bytes)
+
+
+# }
+
+
+# { Path codec
+
+
+_MAX_MEMOIZED_PATHS = 4096
+
+# The characters that quote() leaves as is in all the supported versions of
+# Python:
+_UNQUOTED_PATH_RE = re.compile(r"^[A-Za-z0-9_.\-/]*$")
+
+
+def _memoize_path_codec(codec_function):
+    """
+    Memoize ``codec_function`` for the most recent paths.
+
+    The memo is emptied once it's full, which keeps it bounded without the
+    bookkeeping of an LRU cache.
+
+    """
+    results_by_path = {}
+
+    def memoized_codec_function(path_to_convert):
+        result = results_by_path.get(path_to_convert)
+        if result is None:
+            result = codec_function(path_to_convert)
+            if len(results_by_path) >= _MAX_MEMOIZED_PATHS:
+                results_by_path.clear()
+            results_by_path[path_to_convert] = result
+        return result
+
+    memoized_codec_function.clear = results_by_path.clear
+    return memoized_codec_function
+
+
+def _decode_path(path_encoded):
+    if "%" not in path_encoded:
+        # Short-circuit for the common case of ASCII paths without escapes:
+        try:
+            if isinstance(path_encoded, bytes):
+                # Python 2:
+                return path_encoded.decode('ascii')
+            path_encoded.encode('ascii')
+            return path_encoded
+        except UnicodeError:
+            pass
+
+    return _decode_escaped_path(path_encoded)
+
+
+@_memoize_path_codec
+def _decode_escaped_path(path_encoded):
+    if not isinstance(path_encoded, bytes):
+        # Python 3 decodes the raw path as latin1 in the WSGI environ:
+        path_encoded = path_encoded.encode('latin1')
+    path_bytes = unquote_to_bytes(path_encoded)
     path_unicode = path_bytes.decode('utf8')
     return path_unicode
 
 
 def _encode_path(path_decoded):
+    if _UNQUOTED_PATH_RE.match(path_decoded):
+        return str(path_decoded)
+
+    return _encode_unsafe_path(path_decoded)
+
+
+@_memoize_path_codec
+def _encode_unsafe_path(path_decoded):
     path_bytes = path_decoded.encode('utf8')
     path_quoted = quote(path_bytes)
     return path_quoted
 
 
+_unquote_script_name = _memoize_path_codec(unquote)
+
+
+def _get_decoded_path_info(environ):
+    """
+    Return the decoded ``PATH_INFO`` in ``environ``, which is decoded once per
+    request unless ``PATH_INFO`` is changed.
+
+    """
+    path_info = environ['PATH_INFO']
+    decoded_path_info = environ.get('xsendfile.decoded_path_info')
+    if decoded_path_info is None or decoded_path_info[0] != path_info:
+        decoded_path_info = (path_info, _decode_path(path_info))
+        environ['xsendfile.decoded_path_info'] = decoded_path_info
+    return decoded_path_info[1]
+
+
+def _normalize_path(relative_file_path):
+    """
+    Return ``relative_file_path`` with a single leading slash and without any
+    ``.`` or ``..`` segments or repeated slashes.
+
+    ``..`` segments can't go above the root directory, which is consistent
+    with the paths that can be served.
+
+    """
+    return posixpath.normpath("/" + relative_file_path.lstrip("/"))
+
+
+# }
+
+
 # { Exceptions
 
 
@@ -438,4 +5912,35 @@ class BadSenderError(XSendfileException):
     """Exception raised when given a bad file sendeing application."""
     pass
 
+
+class BadCacheFileError(XSendfileException):
+    """
+    Exception raised when the file backing a :class:`SharedMetadataCache` is
+    not a metadata cache, or it has a different layout.
+
+    """
+    pass
+
+
+class FileSystemUnavailableError(XSendfileException):
+    """
+    Exception raised when a file system call guarded by
+    :class:`FileSystemGuard` didn't complete in time.
+
+    """
+    pass
+
+
+class TokenUsageStoreUnavailableError(XSendfileException):
+    """
+    Exception raised when the use of a token can't be recorded in the
+    :class:`SQLiteTokenUsageStore`.
+
+    """
+    pass
+
 # }
+
+
+if __name__ == "__main__":
+    main()